@@ -1,4 +1,4 @@
-#!/usr/bin/python
+#!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
 # Copyright (c) 2018 Iñaki Garitano (igaritano@garitano.org)
@@ -18,12 +18,36 @@
 
 
 import os
-import subprocess
-import pyinotify
+import sys
+import errno
+import array
 import time
+import signal
+import stat
+import asyncio
+import collections
+import functools
+import itertools
+import hashlib
+import io
+import json
+import queue
+import random
+import socket
+import ctypes
+import concurrent.futures
+import contextlib
+import contextvars
+import cProfile
+import pstats
+import tracemalloc
+import pyinotify
+import threading
 import argparse
 import logging
 from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler
+from logging.handlers import QueueListener
 from systemd.journal import JournalHandler
 
 
@@ -41,14 +65,106 @@ logger_format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 logger_maxBytes = 10240
 logger_backupCount = 10
 logger_filename = '/var/log/dropbox/dropbox_include.log'
+logger_queue = 'yes'
+logger_sample = 10
+logger_listener = None
 config_file = '~/.config/dropbox/dropbox_include.conf'
 dropbox_path = '~/Dropbox'
 dropbox_cache = '.dropbox.cache'
 dropbox_exclude_add_command = 'dropbox exclude add'
 dropbox_exclude_list_command = 'dropbox exclude list'
 dropbox_exclude_remove_command = 'dropbox exclude remove'
+walker_threads = 8
+event_batch_window = 1.0
+event_batch_size = 1000
+event_backlog_limit = 100000
+exclude_list_refresh_interval = 300
+command_timeout = 60
+command_retries = 2
+command_retry_delay = 1.0
+command_workers = 4
+command_latency_target = 5.0
+dropbox_command_method = 'cli'
+dropbox_command_socket = '~/.dropbox/command_socket'
+metrics_textfile = ''
+metrics_interval = 15
+metrics_listen = ''
+state_file = '~/.cache/dropbox/dropbox_include.state'
+control_socket = '~/.cache/dropbox/dropbox_include.socket'
+control_request = []
+poll_interval_min = 2.0
+poll_interval_max = 60.0
+profile = 0
+profile_directory = '~/.cache/dropbox/profile'
+priority_depth = 1
 include_directory_config_files = []
 include_directory_list = []
+root_config_files = []
+dropbox_roots = []
+include_tries = {}
+unexclude_indexes = {}
+config_snapshot = None
+config_changed = threading.Event()
+config_watch_manager = None
+config_watched_directories = set()
+command_limiter = None
+command_priority = contextvars.ContextVar('command_priority', default=False)
+profiler = None
+walker_cancel = threading.Event()
+pending_moves = {}
+metric_definitions = {
+    'dropbox_include_events_received_total': (
+        'counter', 'New directory events received'),
+    'dropbox_include_events_merged_total': (
+        'counter', 'New directory events covered by a queued ancestor'),
+    'dropbox_include_events_dropped_total': (
+        'counter', 'New directory events within an excluded directory'),
+    'dropbox_include_events_expedited_total': (
+        'counter', 'New directories evaluated ahead of the queued ones'),
+    'dropbox_include_events_processed_total': (
+        'counter', 'Queued directories whose batch was applied'),
+    'dropbox_include_events_failed_total': (
+        'counter', 'Queued directories whose batch failed'),
+    'dropbox_include_events_retried_total': (
+        'counter', 'Directories queued again after their batch failed'),
+    'dropbox_include_intake_pauses_total': (
+        'counter', 'Times inotify events were not read because of the '
+        'backlog'),
+    'dropbox_include_overflows_total': (
+        'counter', 'Inotify event queue overflows'),
+    'dropbox_include_moves_total': (
+        'counter', 'Directories moved, by whether they were relocated within '
+        'the watched directories, moved in or moved out'),
+    'dropbox_include_backlog': (
+        'gauge', 'Directories and batches waiting to be evaluated or applied'),
+    'dropbox_include_event_latency_seconds': (
+        'histogram', 'Seconds from queueing a directory until its batch is '
+        'applied'),
+    'dropbox_include_command_duration_seconds': (
+        'histogram', 'Seconds each dropbox command took'),
+    'dropbox_include_commands_total': (
+        'counter', 'Dropbox commands run, by exit status'),
+    'dropbox_include_command_workers': (
+        'gauge', 'Dropbox commands allowed to run at once'),
+    'dropbox_include_config_reloads_total': (
+        'counter', 'Configuration file reloads'),
+    'dropbox_include_watches': (
+        'gauge', 'Directories watched by inotify'),
+    'dropbox_include_polled_directories': (
+        'gauge', 'Directories polled as they could not be watched'),
+    'dropbox_include_excluded_directories': (
+        'gauge', 'Entries of the in memory exclude list'),
+    'dropbox_include_cycles_total': (
+        'counter', 'Exclude and unexclude sequences run'),
+    'dropbox_include_cycle_exclude_directories': (
+        'gauge', 'Directories to exclude found by the last sequence'),
+    'dropbox_include_cycle_unexclude_directories': (
+        'gauge', 'Directories to unexclude found by the last sequence')}
+metric_buckets = (0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+                  30.0, 60.0, 120.0, 300.0)
+metric_values = {}
+metric_callbacks = {}
+metric_lock = threading.Lock()
 old_config_file = ''
 
 
@@ -64,6 +180,8 @@ def setLogger():
     global logger_filename
     global logger_maxBytes
     global logger_backupCount
+    global logger_queue
+    global logger_listener
 
     formatter = logging.Formatter(logger_format)
 
@@ -72,23 +190,33 @@ def setLogger():
     else:
         logger.debug('logger reconfiguration')
 
+        stopLogger()
+
         for logger_handler in logger.handlers[:]:
             logger.removeHandler(logger_handler)
         logger = logging.getLogger(logger_name)
 
     if logger_method == 'journal':
-        logger.addHandler(JournalHandler())
-        logger.handlers[-1].setFormatter(formatter)
+        handler = JournalHandler()
     elif logger_method == 'file':
         handler = RotatingFileHandler(
             logger_filename,
-            maxBytes=logger_maxBytes,
-            backupCount=logger_backupCount)
-        handler.setFormatter(formatter)
-        logger.addHandler(handler)
+            maxBytes=int(logger_maxBytes),
+            backupCount=int(logger_backupCount))
     else:
-        logger.addHandler(logging.StreamHandler())
-        logger.handlers[-1].setFormatter(formatter)
+        handler = logging.StreamHandler()
+
+    handler.setFormatter(formatter)
+
+    # Records are written to the journal or the file by a background thread,
+    # so that writing them never delays the event loop.
+    if str(logger_queue).lower() == 'yes':
+        records = queue.SimpleQueue()
+        logger_listener = QueueListener(records, handler)
+        logger_listener.start()
+        logger.addHandler(QueueHandler(records))
+    else:
+        logger.addHandler(handler)
 
     logger.setLevel(logger_level)
 
@@ -98,6 +226,23 @@ def setLogger():
     # -----------------------------
 
 
+def stopLogger():
+    '''
+    This function writes the log records still queued and stops the
+    background thread writing them, if any.
+    '''
+
+    # Global variables
+    global logger_listener
+
+    if logger_listener is not None:
+        logger_listener.stop()
+        logger_listener = None
+
+    # stopLogger function ends here.
+    # ------------------------------
+
+
 def confInclude(line, begin_line):
     '''
     This function returns the file path of the include option.
@@ -173,6 +318,28 @@ def configuration(config_file):
     global dropbox_exclude_add_command
     global dropbox_exclude_list_command
     global dropbox_exclude_remove_command
+    global walker_threads
+    global event_batch_window
+    global event_batch_size
+    global exclude_list_refresh_interval
+    global command_timeout
+    global command_retries
+    global command_retry_delay
+    global command_workers
+    global dropbox_command_method
+    global dropbox_command_socket
+    global metrics_textfile
+    global metrics_interval
+    global metrics_listen
+    global state_file
+    global command_latency_target
+    global event_backlog_limit
+    global control_socket
+    global poll_interval_min
+    global poll_interval_max
+    global profile_directory
+    global profile
+    global priority_depth
     global logger_method
     global logger_name
     global logger_level
@@ -180,13 +347,16 @@ def configuration(config_file):
     global logger_filename
     global logger_maxBytes
     global logger_backupCount
+    global logger_queue
+    global logger_sample
+    global root_config_files
 
     include_directory_config_files = []
     include_directory_list = []
+    root_config_files = []
 
     # Local variables
     content = ''
-    directory = ''
     begin_line = 0
 
     if os.path.exists(os.path.expanduser(config_file)):
@@ -210,6 +380,8 @@ def configuration(config_file):
                 if line[begin_line:].startswith('include'):
                     include_directory_config_files.append(confInclude(
                         line, begin_line))
+                elif line[begin_line:].startswith('root'):
+                    root_config_files.append(confInclude(line, begin_line))
                 elif line[begin_line:].startswith('dropbox_path'):
                     dropbox_path = confAssign(line, begin_line)
                 elif line[begin_line:].startswith('dropbox_cache'):
@@ -224,6 +396,52 @@ def configuration(config_file):
                         .startswith('dropbox_exclude_remove_command'):
                     dropbox_exclude_remove_command = confAssign(
                         line, begin_line)
+                elif line[begin_line:].startswith('walker_threads'):
+                    walker_threads = confAssign(line, begin_line)
+                elif line[begin_line:].startswith('event_batch_window'):
+                    event_batch_window = confAssign(line, begin_line)
+                elif line[begin_line:].startswith('event_batch_size'):
+                    event_batch_size = confAssign(line, begin_line)
+                elif line[begin_line:].startswith(
+                        'exclude_list_refresh_interval'):
+                    exclude_list_refresh_interval = confAssign(line,
+                                                               begin_line)
+                elif line[begin_line:].startswith('command_timeout'):
+                    command_timeout = confAssign(line, begin_line)
+                elif line[begin_line:].startswith('command_retries'):
+                    command_retries = confAssign(line, begin_line)
+                elif line[begin_line:].startswith('command_retry_delay'):
+                    command_retry_delay = confAssign(line, begin_line)
+                elif line[begin_line:].startswith('command_workers'):
+                    command_workers = confAssign(line, begin_line)
+                elif line[begin_line:].startswith('dropbox_command_method'):
+                    dropbox_command_method = confAssign(line, begin_line)
+                elif line[begin_line:].startswith('dropbox_command_socket'):
+                    dropbox_command_socket = confAssign(line, begin_line)
+                elif line[begin_line:].startswith('metrics_textfile'):
+                    metrics_textfile = confAssign(line, begin_line)
+                elif line[begin_line:].startswith('metrics_interval'):
+                    metrics_interval = confAssign(line, begin_line)
+                elif line[begin_line:].startswith('metrics_listen'):
+                    metrics_listen = confAssign(line, begin_line)
+                elif line[begin_line:].startswith('state_file'):
+                    state_file = confAssign(line, begin_line)
+                elif line[begin_line:].startswith('command_latency_target'):
+                    command_latency_target = confAssign(line, begin_line)
+                elif line[begin_line:].startswith('event_backlog_limit'):
+                    event_backlog_limit = confAssign(line, begin_line)
+                elif line[begin_line:].startswith('control_socket'):
+                    control_socket = confAssign(line, begin_line)
+                elif line[begin_line:].startswith('poll_interval_min'):
+                    poll_interval_min = confAssign(line, begin_line)
+                elif line[begin_line:].startswith('poll_interval_max'):
+                    poll_interval_max = confAssign(line, begin_line)
+                elif line[begin_line:].startswith('profile_directory'):
+                    profile_directory = confAssign(line, begin_line)
+                elif line[begin_line:].startswith('profile'):
+                    profile = confAssign(line, begin_line)
+                elif line[begin_line:].startswith('priority_depth'):
+                    priority_depth = confAssign(line, begin_line)
                 elif line[begin_line:].startswith('logger_method'):
                     logger_method = confAssign(line, begin_line)
                 elif line[begin_line:].startswith('logger_name'):
@@ -238,10 +456,79 @@ def configuration(config_file):
                     logger_maxBytes = confAssign(line, begin_line)
                 elif line[begin_line:].startswith('logger_backupCount'):
                     logger_backupCount = confAssign(line, begin_line)
+                elif line[begin_line:].startswith('logger_queue'):
+                    logger_queue = confAssign(line, begin_line)
+                elif line[begin_line:].startswith('logger_sample'):
+                    logger_sample = confAssign(line, begin_line)
                 else:
                     logger.debug(str(line))
 
+    include_directory_list = readIncludeDirectories(
+        config_file, include_directory_config_files, dropbox_path)
+
+    logger.debug('Configuration file settings:')
+    logger.debug('logger_level: ' + str(logger_level))
+    logger.debug('logger_method: ' + str(logger_method))
+    logger.debug('logger_name: ' + str(logger_name))
+    logger.debug('logger_format: ' + str(logger_format))
+    logger.debug('logger_maxBytes: ' + str(logger_maxBytes))
+    logger.debug('logger_backupCount: ' + str(logger_backupCount))
+    logger.debug('logger_filename: ' + str(logger_filename))
+    logger.debug('logger_queue: ' + str(logger_queue))
+    logger.debug('logger_sample: ' + str(logger_sample))
+    logger.debug('config_file: ' + str(config_file))
+    logger.debug('dropbox_path: ' + str(dropbox_path))
+    logger.debug('dropbox_cache: ' + str(dropbox_cache))
+    logger.debug('dropbox_exclude_add_command: ' +
+                 str(dropbox_exclude_add_command))
+    logger.debug('dropbox_exclude_list_command: ' +
+                 str(dropbox_exclude_list_command))
+    logger.debug('dropbox_exclude_remove_command: ' +
+                 str(dropbox_exclude_remove_command))
+    logger.debug('walker_threads: ' + str(walker_threads))
+    logger.debug('event_batch_window: ' + str(event_batch_window))
+    logger.debug('event_batch_size: ' + str(event_batch_size))
+    logger.debug('exclude_list_refresh_interval: '
+                 + str(exclude_list_refresh_interval))
+    logger.debug('command_timeout: ' + str(command_timeout))
+    logger.debug('command_retries: ' + str(command_retries))
+    logger.debug('command_retry_delay: ' + str(command_retry_delay))
+    logger.debug('command_workers: ' + str(command_workers))
+    logger.debug('dropbox_command_method: ' + str(dropbox_command_method))
+    logger.debug('dropbox_command_socket: ' + str(dropbox_command_socket))
+    logger.debug('metrics_textfile: ' + str(metrics_textfile))
+    logger.debug('metrics_interval: ' + str(metrics_interval))
+    logger.debug('metrics_listen: ' + str(metrics_listen))
+    logger.debug('state_file: ' + str(state_file))
+    logger.debug('command_latency_target: ' + str(command_latency_target))
+    logger.debug('event_backlog_limit: ' + str(event_backlog_limit))
+    logger.debug('control_socket: ' + str(control_socket))
+    logger.debug('poll_interval_min: ' + str(poll_interval_min))
+    logger.debug('poll_interval_max: ' + str(poll_interval_max))
+    logger.debug('profile_directory: ' + str(profile_directory))
+    logger.debug('profile: ' + str(profile))
+    logger.debug('priority_depth: ' + str(priority_depth))
+    logger.debug('include_directory_config_files: ' +
+                 str(include_directory_config_files))
+    logger.debug('root_config_files: ' + str(root_config_files))
+
+    # configuration function ends here.
+    # ---------------------------------
+
+
+def readIncludeDirectories(config_file,
+                           include_directory_config_files,
+                           path):
+    '''
+    This function reads the given include directories configuration files,
+    placed next to the given configuration file, and returns the sorted
+    list of include directories under the given dropbox path.
+    '''
+
+    # Local variables
     content = ''
+    directory = ''
+    include_directory_list = []
 
     for include_directory_config_file in include_directory_config_files:
 
@@ -266,33 +553,294 @@ def configuration(config_file):
                        and not line.startswith('#') \
                        and not line.startswith(';'):
                         directory = os.path.join(
-                            os.path.expanduser(dropbox_path), line)
+                            os.path.expanduser(path), line)
                         include_directory_list.append(directory)
 
     include_directory_list.sort()
 
-    logger.debug('Configuration file settings:')
-    logger.debug('logger_level: ' + str(logger_level))
-    logger.debug('logger_method: ' + str(logger_method))
-    logger.debug('logger_name: ' + str(logger_name))
-    logger.debug('logger_format: ' + str(logger_format))
-    logger.debug('logger_maxBytes: ' + str(logger_maxBytes))
-    logger.debug('logger_backupCount: ' + str(logger_backupCount))
-    logger.debug('logger_filename: ' + str(logger_filename))
-    logger.debug('config_file: ' + str(config_file))
-    logger.debug('dropbox_path: ' + str(dropbox_path))
-    logger.debug('dropbox_cache: ' + str(dropbox_cache))
-    logger.debug('dropbox_exclude_add_command: ' +
-                 str(dropbox_exclude_add_command))
-    logger.debug('dropbox_exclude_list_command: ' +
-                 str(dropbox_exclude_list_command))
-    logger.debug('dropbox_exclude_remove_command: ' +
-                 str(dropbox_exclude_remove_command))
-    logger.debug('include_directory_config_files: ' +
-                 str(include_directory_config_files))
+    return include_directory_list
 
-    # configuration function ends here.
-    # ---------------------------------
+    # readIncludeDirectories function ends here.
+    # ------------------------------------------
+
+
+def rootConfiguration(config_file):
+    '''
+    This function evaluates the configuration file of a dropbox root and
+    returns its configuration snapshot. A root configuration file has the
+    format of the main one, but only the settings of a dropbox path are
+    read from it: dropbox_path, dropbox_cache, the dropbox commands, the
+    dropbox command method and socket, state_file and include lines. The
+    settings it does not set are taken from the main configuration file,
+    but for state_file, which defaults to one file per dropbox path.
+    '''
+
+    logger.debug('Root configuration file: ' + str(config_file))
+
+    # Local variables
+    settings = {
+        'dropbox_path': dropbox_path,
+        'dropbox_cache': dropbox_cache,
+        'dropbox_exclude_add_command': dropbox_exclude_add_command,
+        'dropbox_exclude_list_command': dropbox_exclude_list_command,
+        'dropbox_exclude_remove_command': dropbox_exclude_remove_command,
+        'dropbox_command_method': dropbox_command_method,
+        'dropbox_command_socket': dropbox_command_socket,
+        'state_file': None}
+    include_files = []
+    content = ''
+    begin_line = 0
+    name = ''
+    files = []
+
+    if os.path.exists(os.path.expanduser(config_file)):
+        with open(os.path.expanduser(config_file), 'r') as file:
+            try:
+                content = file.read()
+            except IOError:
+                print("IOError")
+
+    for line in content.split('\n'):
+        begin_line = len(line) - len(line.lstrip(' '))
+
+        if line[begin_line:].startswith('include'):
+            include_files.append(confInclude(line, begin_line))
+            continue
+
+        for name in settings:
+            if line[begin_line:].startswith(name):
+                settings[name] = confAssign(line, begin_line)
+                break
+
+    if settings['state_file'] is None:
+        settings['state_file'] = state_file + '.' + hashlib.sha1(
+            os.path.normpath(os.path.expanduser(settings['dropbox_path']))
+            .encode('utf-8')).hexdigest()[:12] if state_file else ''
+
+    include_directory_list = readIncludeDirectories(
+        config_file, include_files, settings['dropbox_path'])
+
+    files = [os.path.expanduser(config_file)] + [
+        os.path.join(os.path.dirname(os.path.expanduser(config_file)), file)
+        for file in include_files]
+
+    logger.debug('Root configuration file settings: %s '
+                 'include_directory_list: %s', settings,
+                 LogSummary(include_directory_list))
+
+    return ConfigSnapshot(
+        config_file=config_file,
+        include_directory_list=tuple(include_directory_list),
+        include_trie=getDropboxIncludeTrie(include_directory_list,
+                                           settings['dropbox_path'],
+                                           settings['dropbox_cache']),
+        files=tuple(files),
+        signature=configurationSignature(files),
+        digest=configurationDigest(files),
+        **settings)
+
+    # rootConfiguration function ends here.
+    # -------------------------------------
+
+
+def configurationFiles(config_file):
+    '''
+    This function returns the paths of the configuration file and of the
+    include directories configuration files it includes.
+    '''
+
+    # Global variables
+    global include_directory_config_files
+
+    # Local variables
+    directory = os.path.dirname(os.path.expanduser(config_file))
+    files = [os.path.expanduser(config_file)]
+
+    for include_directory_config_file in include_directory_config_files:
+        files.append(os.path.join(directory, include_directory_config_file))
+
+    return files
+
+    # configurationFiles function ends here.
+    # --------------------------------------
+
+
+def configurationSignature(files):
+    '''
+    This function returns the modification time and size of each given file,
+    or None for files which do not exist.
+    '''
+
+    # Local variables
+    signature = []
+
+    for file in files:
+        try:
+            stat = os.stat(file)
+            signature.append((file, stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            signature.append((file, None, None))
+
+    return tuple(signature)
+
+    # configurationSignature function ends here.
+    # ------------------------------------------
+
+
+def configurationDigest(files):
+    '''
+    This function returns a hash of the content of the given files.
+    '''
+
+    # Local variables
+    digest = hashlib.sha1()
+
+    for file in files:
+        digest.update(file.encode('utf-8') + b'\0')
+        try:
+            with open(file, 'rb') as content:
+                digest.update(content.read())
+        except (IOError, OSError):
+            digest.update(b'\0')
+        digest.update(b'\0')
+
+    return digest.hexdigest()
+
+    # configurationDigest function ends here.
+    # ---------------------------------------
+
+
+def takeConfigurationSnapshot():
+    '''
+    This function returns an immutable snapshot of the current configuration
+    settings, with the include directories compiled into an include trie.
+    '''
+
+    # Global variables
+    global config_file
+    global dropbox_path
+    global dropbox_cache
+    global dropbox_exclude_add_command
+    global dropbox_exclude_list_command
+    global dropbox_exclude_remove_command
+    global dropbox_command_method
+    global dropbox_command_socket
+    global state_file
+    global include_directory_list
+
+    # Local variables
+    files = configurationFiles(config_file)
+
+    return ConfigSnapshot(
+        config_file=config_file,
+        dropbox_path=dropbox_path,
+        dropbox_cache=dropbox_cache,
+        dropbox_exclude_add_command=dropbox_exclude_add_command,
+        dropbox_exclude_list_command=dropbox_exclude_list_command,
+        dropbox_exclude_remove_command=dropbox_exclude_remove_command,
+        dropbox_command_method=dropbox_command_method,
+        dropbox_command_socket=dropbox_command_socket,
+        state_file=state_file,
+        include_directory_list=tuple(include_directory_list),
+        include_trie=getDropboxIncludeTrie(include_directory_list),
+        files=tuple(files),
+        signature=configurationSignature(files),
+        digest=configurationDigest(files))
+
+    # takeConfigurationSnapshot function ends here.
+    # ---------------------------------------------
+
+
+def watchConfiguration():
+    '''
+    This function adds a watch on each directory holding configuration files,
+    so that changes on them invalidate the configuration snapshot.
+    '''
+
+    # Global variables
+    global config_snapshot
+    global config_watch_manager
+    global config_watched_directories
+    global dropbox_roots
+
+    # Local variables
+    mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO \
+        | pyinotify.IN_MOVED_FROM | pyinotify.IN_CREATE \
+        | pyinotify.IN_DELETE | pyinotify.IN_ATTRIB
+    files = []
+
+    if config_watch_manager is None or config_snapshot is None:
+        return
+
+    files = list(config_snapshot.files)
+    for root in dropbox_roots:
+        files.extend(root.snapshot.files)
+
+    for file in files:
+        directory = os.path.dirname(file)
+        if directory in config_watched_directories \
+           or not os.path.isdir(directory):
+            continue
+
+        logger.debug('Watch configuration directory: ' + str(directory))
+
+        config_watch_manager.add_watch(directory, mask,
+                                       proc_fun=ConfigEventHandler())
+        config_watched_directories.add(directory)
+
+    # watchConfiguration function ends here.
+    # --------------------------------------
+
+
+def loadConfiguration():
+    '''
+    This function returns the configuration snapshot, reloading the
+    configuration files only if they changed. While configuration
+    directories are watched the files are only checked after a change
+    notification, otherwise their modification time and size are checked
+    on each call. Files whose content did not change are not parsed again.
+    '''
+
+    # Global variables
+    global config_file
+    global config_snapshot
+    global config_changed
+    global config_watched_directories
+
+    # Local variables
+    files = []
+    signature = ()
+
+    if config_snapshot is not None and config_watched_directories \
+       and not config_changed.is_set():
+        return config_snapshot
+
+    config_changed.clear()
+
+    if config_snapshot is not None:
+        files = configurationFiles(config_file)
+        signature = configurationSignature(files)
+
+        if signature == config_snapshot.signature:
+            return config_snapshot
+
+        if configurationDigest(files) == config_snapshot.digest:
+            logger.debug('Configuration files touched but not changed')
+            config_snapshot = config_snapshot._replace(signature=signature)
+            return config_snapshot
+
+    logger.info('Load configuration file: ' + str(config_file))
+
+    countMetric('dropbox_include_config_reloads_total')
+
+    configuration(config_file)
+    config_snapshot = takeConfigurationSnapshot()
+    watchConfiguration()
+
+    return config_snapshot
+
+    # loadConfiguration function ends here.
+    # -------------------------------------
 
 
 def parse_arguments():
@@ -310,10 +858,35 @@ def parse_arguments():
     global dropbox_exclude_add_command
     global dropbox_exclude_list_command
     global dropbox_exclude_remove_command
+    global walker_threads
+    global event_batch_window
+    global event_batch_size
+    global exclude_list_refresh_interval
+    global command_timeout
+    global command_retries
+    global command_retry_delay
+    global command_workers
+    global dropbox_command_method
+    global dropbox_command_socket
+    global metrics_textfile
+    global metrics_interval
+    global metrics_listen
+    global state_file
+    global command_latency_target
+    global event_backlog_limit
+    global control_socket
+    global control_request
+    global poll_interval_min
+    global poll_interval_max
+    global profile_directory
+    global profile
+    global priority_depth
     global logger_method
     global logger_level
     global logger_format
     global logger_filename
+    global logger_queue
+    global logger_sample
 
     parser = argparse.ArgumentParser()
 
@@ -354,6 +927,85 @@ def parse_arguments():
     parser.add_argument('--exclude_remove', action='store',
                         dest='dropbox_exclude_remove_command',
                         help='Dropbox exclude remove command')
+    parser.add_argument('--walker_threads', action='store',
+                        dest='walker_threads',
+                        help='Number of threads scanning directories')
+    parser.add_argument('--event_batch_window', action='store',
+                        dest='event_batch_window',
+                        help='Seconds new directories are collected before '
+                             'being evaluated')
+    parser.add_argument('--event_batch_size', action='store',
+                        dest='event_batch_size',
+                        help='Maximum number of new directories evaluated '
+                             'together')
+    parser.add_argument('--exclude_list_refresh_interval', action='store',
+                        dest='exclude_list_refresh_interval',
+                        help='Seconds between checks of the in memory '
+                             'exclude list against dropbox')
+    parser.add_argument('--command_timeout', action='store',
+                        dest='command_timeout',
+                        help='Seconds a dropbox command may run before being '
+                             'killed')
+    parser.add_argument('--command_retries', action='store',
+                        dest='command_retries',
+                        help='Times a failed dropbox command is retried')
+    parser.add_argument('--command_retry_delay', action='store',
+                        dest='command_retry_delay',
+                        help='Seconds to wait before retrying a failed '
+                             'dropbox command')
+    parser.add_argument('--command_workers', action='store',
+                        dest='command_workers',
+                        help='Number of dropbox commands run at once')
+    parser.add_argument('--dropbox_command_method', action='store',
+                        dest='dropbox_command_method',
+                        help='Dropbox command method: cli, socket')
+    parser.add_argument('--dropbox_command_socket', action='store',
+                        dest='dropbox_command_socket',
+                        help='Dropbox daemon command socket path')
+    parser.add_argument('--metrics_textfile', action='store',
+                        dest='metrics_textfile',
+                        help='Prometheus textfile the metrics are written to')
+    parser.add_argument('--metrics_interval', action='store',
+                        dest='metrics_interval',
+                        help='Seconds between writes of the metrics textfile')
+    parser.add_argument('--metrics_listen', action='store',
+                        dest='metrics_listen',
+                        help='Metrics HTTP endpoint: host:port or unix:path')
+    parser.add_argument('--state_file', action='store',
+                        dest='state_file',
+                        help='File keeping the scanned directories and the '
+                             'exclude list across restarts')
+    parser.add_argument('--command_latency_target', action='store',
+                        dest='command_latency_target',
+                        help='Seconds a dropbox command may take before '
+                             'fewer commands are run at once')
+    parser.add_argument('--event_backlog_limit', action='store',
+                        dest='event_backlog_limit',
+                        help='Queued directories above which inotify events '
+                             'are not read until they are evaluated')
+    parser.add_argument('--control_socket', action='store',
+                        dest='control_socket',
+                        help='Unix socket answering path queries and '
+                             'reconcile requests')
+    parser.add_argument('--poll_interval_min', action='store',
+                        dest='poll_interval_min',
+                        help='Seconds between polls of a changing directory '
+                             'which could not be watched')
+    parser.add_argument('--poll_interval_max', action='store',
+                        dest='poll_interval_max',
+                        help='Seconds between polls of an unchanged '
+                             'directory which could not be watched')
+    parser.add_argument('--profile_directory', action='store',
+                        dest='profile_directory',
+                        help='Directory the profiles are written to')
+    parser.add_argument('--profile', action='store',
+                        dest='profile',
+                        help='Profile one in every given number of cycles '
+                             'with cProfile and tracemalloc. 0 disables it')
+    parser.add_argument('--priority_depth', action='store',
+                        dest='priority_depth',
+                        help='Depth below the dropbox path up to which new '
+                             'directories are evaluated right away')
     parser.add_argument('--logger_method', action='store',
                         dest='logger_method',
                         help='Logger method: journal, file')
@@ -368,6 +1020,19 @@ def parse_arguments():
     parser.add_argument('--logger_filename', action='store',
                         dest='logger_filename',
                         help='Logger filename. Full path.')
+    parser.add_argument('--logger_queue', action='store',
+                        dest='logger_queue',
+                        help='Write log records from a background thread. \
+                        yes or no')
+    parser.add_argument('--logger_sample', action='store',
+                        dest='logger_sample',
+                        help='Number of items logged from a long list. 0 \
+                        logs them all')
+    parser.add_argument('--control', action='store', nargs='+',
+                        dest='control_request', metavar='COMMAND',
+                        help='Send a request to the running daemon and print \
+                        the answer: classify PATH, excluded [PATH], \
+                        reconcile PATH, status or stats')
     parser.add_argument('--version', action='version',
                         version='%(prog)s' + ' ' + str(__version__))
 
@@ -394,6 +1059,75 @@ def parse_arguments():
     if args.dropbox_exclude_remove_command:
         dropbox_exclude_remove_command = args.dropbox_exclude_remove_command
 
+    if args.walker_threads:
+        walker_threads = args.walker_threads
+
+    if args.event_batch_window:
+        event_batch_window = args.event_batch_window
+
+    if args.event_batch_size:
+        event_batch_size = args.event_batch_size
+
+    if args.exclude_list_refresh_interval:
+        exclude_list_refresh_interval = args.exclude_list_refresh_interval
+
+    if args.command_timeout:
+        command_timeout = args.command_timeout
+
+    if args.command_retries:
+        command_retries = args.command_retries
+
+    if args.command_retry_delay:
+        command_retry_delay = args.command_retry_delay
+
+    if args.command_workers:
+        command_workers = args.command_workers
+
+    if args.dropbox_command_method:
+        dropbox_command_method = args.dropbox_command_method
+
+    if args.dropbox_command_socket:
+        dropbox_command_socket = args.dropbox_command_socket
+
+    if args.metrics_textfile:
+        metrics_textfile = args.metrics_textfile
+
+    if args.metrics_interval:
+        metrics_interval = args.metrics_interval
+
+    if args.metrics_listen:
+        metrics_listen = args.metrics_listen
+
+    if args.state_file:
+        state_file = args.state_file
+
+    if args.command_latency_target:
+        command_latency_target = args.command_latency_target
+
+    if args.event_backlog_limit:
+        event_backlog_limit = args.event_backlog_limit
+
+    if args.control_socket:
+        control_socket = args.control_socket
+
+    if args.control_request:
+        control_request = args.control_request
+
+    if args.poll_interval_min:
+        poll_interval_min = args.poll_interval_min
+
+    if args.poll_interval_max:
+        poll_interval_max = args.poll_interval_max
+
+    if args.profile_directory:
+        profile_directory = args.profile_directory
+
+    if args.profile:
+        profile = args.profile
+
+    if args.priority_depth:
+        priority_depth = args.priority_depth
+
     if args.logger_method:
         logger_method = args.logger_method
 
@@ -406,6 +1140,12 @@ def parse_arguments():
     if args.logger_filename:
         logger_filename = args.logger_filename
 
+    if args.logger_queue:
+        logger_queue = args.logger_queue
+
+    if args.logger_sample:
+        logger_sample = args.logger_sample
+
     logger.debug('Command line arguments parse:')
     logger.debug('logger_level: ' + str(logger_level))
     logger.debug('logger_method: ' + str(logger_method))
@@ -414,6 +1154,8 @@ def parse_arguments():
     logger.debug('logger_maxBytes: ' + str(logger_maxBytes))
     logger.debug('logger_backupCount: ' + str(logger_backupCount))
     logger.debug('logger_filename: ' + str(logger_filename))
+    logger.debug('logger_queue: ' + str(logger_queue))
+    logger.debug('logger_sample: ' + str(logger_sample))
     logger.debug('config_file: ' + str(config_file))
     logger.debug('dropbox_path: ' + str(dropbox_path))
     logger.debug('dropbox_cache: ' + str(dropbox_cache))
@@ -423,6 +1165,29 @@ def parse_arguments():
                  str(dropbox_exclude_list_command))
     logger.debug('dropbox_exclude_remove_command: ' +
                  str(dropbox_exclude_remove_command))
+    logger.debug('walker_threads: ' + str(walker_threads))
+    logger.debug('event_batch_window: ' + str(event_batch_window))
+    logger.debug('event_batch_size: ' + str(event_batch_size))
+    logger.debug('exclude_list_refresh_interval: '
+                 + str(exclude_list_refresh_interval))
+    logger.debug('command_timeout: ' + str(command_timeout))
+    logger.debug('command_retries: ' + str(command_retries))
+    logger.debug('command_retry_delay: ' + str(command_retry_delay))
+    logger.debug('command_workers: ' + str(command_workers))
+    logger.debug('dropbox_command_method: ' + str(dropbox_command_method))
+    logger.debug('dropbox_command_socket: ' + str(dropbox_command_socket))
+    logger.debug('metrics_textfile: ' + str(metrics_textfile))
+    logger.debug('metrics_interval: ' + str(metrics_interval))
+    logger.debug('metrics_listen: ' + str(metrics_listen))
+    logger.debug('state_file: ' + str(state_file))
+    logger.debug('command_latency_target: ' + str(command_latency_target))
+    logger.debug('event_backlog_limit: ' + str(event_backlog_limit))
+    logger.debug('control_socket: ' + str(control_socket))
+    logger.debug('poll_interval_min: ' + str(poll_interval_min))
+    logger.debug('poll_interval_max: ' + str(poll_interval_max))
+    logger.debug('profile_directory: ' + str(profile_directory))
+    logger.debug('profile: ' + str(profile))
+    logger.debug('priority_depth: ' + str(priority_depth))
     logger.debug('include_directory_config_files: ' +
                  str(include_directory_config_files))
 
@@ -430,515 +1195,4996 @@ def parse_arguments():
     # -----------------------------------
 
 
-def evalCurrentDirectories(path):
+def countMetric(name, value=1, **labels):
     '''
-    This function evaluates current directories and subdirectories in a given
-    directory path.
+    This function adds the given value to a counter metric.
     '''
 
-    logger.debug('Evaluate subdirectories in a given path: '
-                 + str(path))
+    # Global variables
+    global metric_values
+    global metric_lock
 
     # Local variables
-    current_directories = []
+    key = (name, tuple(sorted(labels.items())))
 
-    for directory, subdirectories, files in os.walk(os.path.expanduser(path),
-                                                    followlinks=True):
-        current_directories.append(directory)
+    with metric_lock:
+        metric_values[key] = metric_values.get(key, 0) + value
 
-    current_directories.sort()
+    # countMetric function ends here.
+    # -------------------------------
 
-    return current_directories
 
-    # evalCurrentDirectories function ends here.
-    # ------------------------------------------
+def setMetric(name, value, **labels):
+    '''
+    This function sets the value of a gauge metric.
+    '''
+
+    # Global variables
+    global metric_values
+    global metric_lock
+
+    with metric_lock:
+        metric_values[(name, tuple(sorted(labels.items())))] = value
+
+    # setMetric function ends here.
+    # -----------------------------
 
 
-def pathToDict(path):
+def observeMetric(name, value, **labels):
     '''
-    This function returns a path converted into a dictionary.
-    For example: '/home/user/Documents' -> {1:'home', 2:'user', 3:'Documents'}
+    This function records a value on a histogram metric.
     '''
 
+    # Global variables
+    global metric_values
+    global metric_buckets
+    global metric_lock
+
     # Local variables
-    counter = 1
-    basename = ''
-    basenames_list = []
-    pathtodict = {}
+    key = (name, tuple(sorted(labels.items())))
+    histogram = None
+
+    with metric_lock:
+        histogram = metric_values.setdefault(
+            key, [[0] * len(metric_buckets), 0.0, 0])
+        for position, bucket in enumerate(metric_buckets):
+            if value <= bucket:
+                histogram[0][position] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+    # observeMetric function ends here.
+    # ---------------------------------
 
-    while os.path.basename(path):
-        basename = os.path.basename(path)
-        basenames_list.append(basename)
-        path = os.path.dirname(path)
 
-    basenames_list.reverse()
-    for basename in basenames_list:
-        pathtodict[counter] = basename
-        counter += 1
+def watchMetric(name, function):
+    '''
+    This function sets a gauge metric whose value is read from the given
+    function whenever the metrics are rendered, or removes it if the
+    function is None.
+    '''
 
-    return pathtodict
+    # Global variables
+    global metric_callbacks
+    global metric_lock
 
-    # pathToDict function ends here.
-    # ------------------------------
+    with metric_lock:
+        if function is None:
+            metric_callbacks.pop(name, None)
+        else:
+            metric_callbacks[name] = function
+
+    # watchMetric function ends here.
+    # -------------------------------
 
 
-def directoriesListToDicts(directorieslist):
+def formatMetric(name, labels, value):
     '''
-    This function returns a list of path converted into dictionaries.
+    This function returns a sample line of the Prometheus text format.
     '''
 
     # Local variables
-    directoriesDictList = []
+    text = ''
 
-    for directory in directorieslist:
-        directoriesDictList.append(pathToDict(directory))
+    if labels:
+        text = ','.join(key + '="' + str(label).replace('\\', '\\\\')
+                        .replace('"', '\\"').replace('\n', '\\n') + '"'
+                        for key, label in labels)
+        return name + '{' + text + '} ' + repr(float(value))
 
-    return directoriesDictList
+    return name + ' ' + repr(float(value))
 
-    # directoriesListToDicts function ends here.
-    # ------------------------------------------
+    # formatMetric function ends here.
+    # --------------------------------
 
 
-def evalToExcludeDirectories2(include_directories, current_directories):
+def collectMetrics():
     '''
-    This function evaluates directories to be excluded comparing each current
-    directory with included directories.
+    This function returns a copy of every metric value, the gauges read from
+    functions included, keyed by metric name and labels.
     '''
 
-    logger.debug('Evaluate directories not present on a given list:'
-                 + '\nInclude directory list: ' + str(include_directories)
-                 + '\nDirectory list to evaluate: ' + str(current_directories))
-
     # Global variables
-    global dropbox_path
-    global dropbox_cache
+    global metric_values
+    global metric_callbacks
+    global metric_lock
 
     # Local variables
-    include_directory_list_of_dicts = []
-    current_directory_list_of_dicts = []
-    aux_dict = {}
-    exclude_directory_list_of_dicts = []
-    exclude_directory_set = set()
-    exclude_directory_list = []
+    values = {}
+    callbacks = {}
 
-    include_directory_list_of_dicts = directoriesListToDicts(
-        include_directories)
+    with metric_lock:
+        values = dict((key, value if not isinstance(value, list)
+                       else [list(value[0]), value[1], value[2]])
+                      for key, value in metric_values.items())
+        callbacks = dict(metric_callbacks)
 
-    include_directory_list_of_dicts.append(directoriesListToDicts(
-        [os.path.join(os.path.expanduser(dropbox_path), dropbox_cache)])[0])
+    for name, function in callbacks.items():
+        try:
+            values[(name, ())] = function()
+        except Exception:
+            logger.exception('Unable to read metric ' + str(name))
 
-    current_directory_list_of_dicts = directoriesListToDicts(
-        current_directories)
+    return values
 
-    for current_directory in current_directory_list_of_dicts:
+    # collectMetrics function ends here.
+    # ----------------------------------
 
-        mainsubdirectory = []
 
-        for include_directory in include_directory_list_of_dicts:
+def renderMetrics():
+    '''
+    This function returns every metric in the Prometheus text format.
+    '''
 
-            maxcounter = 0
+    # Global variables
+    global metric_definitions
+    global metric_buckets
 
-            for counter in range(1, min(len(current_directory),
-                                        len(include_directory)) + 1):
+    # Local variables
+    values = collectMetrics()
+    lines = []
+    kind = ''
+    description = ''
+
+    for name in sorted(metric_definitions):
+        kind, description = metric_definitions[name]
+        lines.append('# HELP ' + name + ' ' + description)
+        lines.append('# TYPE ' + name + ' ' + kind)
+
+        for key in sorted(key for key in values if key[0] == name):
+            if kind == 'histogram':
+                for bucket, bucket_count in zip(metric_buckets,
+                                                values[key][0]):
+                    lines.append(formatMetric(
+                        name + '_bucket', key[1] + (('le', bucket),),
+                        bucket_count))
+                lines.append(formatMetric(name + '_bucket',
+                                          key[1] + (('le', '+Inf'),),
+                                          values[key][2]))
+                lines.append(formatMetric(name + '_sum', key[1],
+                                          values[key][1]))
+                lines.append(formatMetric(name + '_count', key[1],
+                                          values[key][2]))
+            else:
+                lines.append(formatMetric(name, key[1], values[key]))
 
-                if current_directory[counter] == include_directory[counter]:
+    return '\n'.join(lines) + '\n'
 
-                    maxcounter = counter
+    # renderMetrics function ends here.
+    # ---------------------------------
 
-                else:
 
-                    break
+def writeMetrics(path):
+    '''
+    This function writes the metrics into the given file. The file is
+    replaced at once, so that it is never read half written.
+    '''
 
-            mainsubdirectory.append(maxcounter)
+    # Local variables
+    path = os.path.expanduser(path)
 
-        # commonalities = (number_of_in_common_directories,
-        #                 (number_of_include_directory_directories,
-        #                   position_in_include_directory_list_of_dicts),
-        #                  number_of_current_directory_directories)
-        commonalities = (max(mainsubdirectory),
-                         min([(len(include_directory_list_of_dicts[position]),
-                               position)
-                              for position, value in
-                              enumerate(mainsubdirectory)
-                              if value == max(mainsubdirectory)]),
-                         len(current_directory))
+    try:
+        with open(path + '.tmp', 'w') as file:
+            file.write(renderMetrics())
+        os.rename(path + '.tmp', path)
+    except (IOError, OSError) as error:
+        logger.error('Unable to write metrics file ' + str(path) + ': '
+                     + str(error))
 
-        if commonalities[0] == 0:
+    # writeMetrics function ends here.
+    # --------------------------------
 
-            aux_dict = {}
-            aux_dict['directory'] = current_directory
-            aux_dict['length'] = commonalities[2]
-            exclude_directory_list_of_dicts.append(aux_dict)
 
-        else:
+async def writeMetricsLoop(path, interval):
+    '''
+    This function writes the metrics into the given file every interval
+    seconds, and once more when it is cancelled.
+    '''
 
-            if commonalities[1][0] < commonalities[2]:
-                if commonalities[0] < commonalities[1][0]:
-                    aux_dict = {}
-                    aux_dict['directory'] = current_directory
-                    aux_dict['length'] = commonalities[0] + 1
-                    exclude_directory_list_of_dicts.append(aux_dict)
+    try:
+        while True:
+            writeMetrics(path)
+            await asyncio.sleep(float(interval))
+    finally:
+        writeMetrics(path)
 
-            elif commonalities[1][0] == commonalities[2]:
-                if commonalities[0] < commonalities[2]:
-                    aux_dict = {}
-                    aux_dict['directory'] = current_directory
-                    aux_dict['length'] = commonalities[2]
-                    exclude_directory_list_of_dicts.append(aux_dict)
+    # writeMetricsLoop function ends here.
+    # ------------------------------------
 
-            else:
-                if commonalities[0] < commonalities[2]:
-                    aux_dict = {}
-                    aux_dict['directory'] = current_directory
-                    aux_dict['length'] = commonalities[2]
-                    exclude_directory_list_of_dicts.append(aux_dict)
 
-        for entry in exclude_directory_list_of_dicts:
-            print(entry)
-            directory = os.sep
-            for index in range(1, entry['length'] + 1):
-                directory = os.path.join(directory, entry['directory'][index])
-            exclude_directory_set.add(directory)
+async def answerMetrics(reader, writer):
+    '''
+    This function answers an HTTP request on the metrics endpoint with the
+    metrics, whatever the requested path.
+    '''
 
-    exclude_directory_list = list(exclude_directory_set)
-    exclude_directory_list.sort()
+    # Local variables
+    body = b''
+    line = b''
 
-    logger.debug('To exclude directories: ' + str(exclude_directory_list))
+    try:
+        while True:
+            line = await asyncio.wait_for(reader.readline(), 5.0)
+            if not line.strip():
+                break
+
+        body = renderMetrics().encode('utf-8')
+
+        writer.write(b'HTTP/1.0 200 OK\r\n'
+                     b'Content-Type: text/plain; version=0.0.4\r\n'
+                     b'Content-Length: ' + str(len(body)).encode('ascii')
+                     + b'\r\n\r\n' + body)
+        await writer.drain()
+    except (OSError, asyncio.TimeoutError) as error:
+        logger.debug('Metrics request failed: ' + str(error))
+    finally:
+        writer.close()
+
+    # answerMetrics function ends here.
+    # ---------------------------------
 
-    return exclude_directory_list
 
-    # evalToExcludeDirectories2 function ends here.
-    # ---------------------------------------------
+def unlinkSocket(path):
+    '''
+    This function removes the unix socket left at the given path by a
+    previous run. Anything else found there is left alone and an OSError is
+    raised instead.
+    '''
+
+    try:
+        if not stat.S_ISSOCK(os.lstat(path).st_mode):
+            raise OSError(errno.EEXIST, 'Not a socket', path)
+    except FileNotFoundError:
+        return
+
+    os.unlink(path)
 
+    # unlinkSocket function ends here.
+    # --------------------------------
 
-def executeCommand(command,
-                   argument_list,
-                   child_working_directory):
+
+async def serveMetrics(address):
     '''
-    This function takes the command, the argument list and the
-    child_working_directory path and executes the given command with the
-    given arguments on the given cwd path.
+    This function starts serving the metrics over HTTP on the given address,
+    either host:port or unix:path, and returns the server.
     '''
 
-    logger.debug('Execute command: '
-                 + str(command)
-                 + ' '
-                 + str(argument_list))
-
     # Local variables
-    args = []
+    path = ''
+    host = ''
+    port = ''
 
-    # Split the command and add to args list
-    args.extend(command.split())
+    logger.info('Serve metrics on ' + str(address))
 
-    # For each argument in the list, include it in the args list.
-    for argument in argument_list:
-        args.append(argument)
+    if address.startswith('unix:'):
+        path = os.path.expanduser(address[len('unix:'):])
+        unlinkSocket(path)
+        return await asyncio.start_unix_server(answerMetrics, path=path)
 
-    # Execute the command with the given argument list on the given cwd path
+    host, port = address.rsplit(':', 1)
 
-    logger.info(str(args))
+    return await asyncio.start_server(answerMetrics,
+                                      host.strip('[]') or '127.0.0.1',
+                                      int(port))
 
-    p = subprocess.Popen(args,
-                         cwd=child_working_directory,
-                         stdout=subprocess.PIPE)
-    out, err = p.communicate()
+    # serveMetrics function ends here.
+    # --------------------------------
 
-    # Return the output of the executed command.
-    return out
 
-    # executeCommand function ends here.
-    # ----------------------------------
+def scanDirectory(path):
+    '''
+    This function returns the subdirectories of a given directory path,
+    following symbolic links. Directories which can not be read are
+    considered empty, as os.walk does.
+    '''
+
+    # Local variables
+    subdirectories = []
+
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir():
+                        subdirectories.append(entry.path)
+                except OSError:
+                    pass
+    except OSError as error:
+        logger.debug('Unable to scan directory: %s', error)
 
+    return subdirectories
 
-def evalDropboxExcludeList():
+    # scanDirectory function ends here.
+    # ---------------------------------
+
+
+def evalCurrentDirectories(path, trie=None, table=None, paths=None):
     '''
-    This function evaluates the list of excluded directories.
+    This function evaluates current directories and subdirectories in a given
+    directory path. Directories are scanned by a bounded pool of threads and,
+    when an include trie is given, only directories which may contain
+    something to exclude are scanned: excluded directories and directories
+    placed under an include directory are listed but not entered, the given
+    directory path included. When a directory table is given, directories
+    which did not change since they were last scanned are not scanned again.
+    The directories are added to the given path table, or to a new one, which
+    is returned.
     '''
 
-    logger.debug('Evaluate dropbox excluded directory list')
+    logger.debug('Evaluate subdirectories in a given path: '
+                 + str(path))
 
     # Global variables
-    global dropbox_exclude_list_command
-    global dropbox_path
+    global walker_threads
+    global walker_cancel
 
     # Local variables
-    dropbox_exclude_list = []
-    args = []
+    top = os.path.normpath(os.path.expanduser(path))
+    pending = {}
+    done = set()
+    parent = 0
+    scan = scanDirectory if table is None else table.scan
 
-    dropbox_exclude_list = executeCommand(
-        dropbox_exclude_list_command, args, os.path.expanduser(dropbox_path))
+    if paths is None:
+        paths = PathTable()
 
-    # Split the list considering each line as an independent directory.
-    dropbox_exclude_list_aux = dropbox_exclude_list.split('\n')
+    parent = paths.addPath(top)
 
-    # Remove the first and the last list members which are 'Excluded: ' and ''
-    try:
-        dropbox_exclude_list_aux.pop(0)
-        dropbox_exclude_list_aux.pop(-1)
-    except IndexError:
-        print("IndexError")
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, int(walker_threads))) as executor:
 
-    # Return the list of directories.
-    return dropbox_exclude_list_aux
+        if trie is None or trie.classify(pathToList(top))[1]:
+            pending[executor.submit(scan, top)] = parent
 
-    # evalDropboxExcludeList function ends here.
+        while pending:
+            if walker_cancel.is_set():
+                for future in pending:
+                    future.cancel()
+                break
+
+            done = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)[0]
+
+            for future in done:
+                parent = pending.pop(future)
+                for subdirectory in future.result():
+                    if trie is None or trie.classify(
+                            pathToList(subdirectory))[1]:
+                        pending[executor.submit(scan, subdirectory)] = \
+                            paths.add(parent, os.path.basename(subdirectory))
+                    else:
+                        paths.add(parent, os.path.basename(subdirectory))
+
+    return paths
+
+    # evalCurrentDirectories function ends here.
     # ------------------------------------------
 
 
-def evalToUnexcludeDirectories(excluded_directories, include_directory_list):
+def pathToList(path):
     '''
-    This function evaluates each excluded directory against include
-    directories and devices whether the directory should be unexcluded or not.
+    This function returns a path converted into a list of its components.
+    For example: '/home/user/Documents' -> ['home', 'user', 'Documents']
+    A path which ends with a separator has no basename, so it is converted
+    into an empty list.
     '''
 
-    logger.debug('Evaluate directories which should not be excluded')
+    if not path or path.endswith(os.sep):
+        return []
+
+    return [component for component in path.split(os.sep) if component]
+
+    # pathToList function ends here.
+    # ------------------------------
+
+
+def getIncludeTrie(include_directories, path=None):
+    '''
+    This function returns the include trie compiled from the given include
+    directories. The last compiled trie of each given dropbox path is kept
+    and reused as long as its include directories do not change, so that
+    several dropbox roots do not replace each other's trie.
+    '''
+
+    # Global variables
+    global include_tries
+
+    # Local variables
+    key = tuple(include_directories)
+    cached = include_tries.get(path)
+
+    if cached is None or not key == cached[0]:
+        logger.debug('Compile include trie with '
+                     + str(len(key)) + ' include directories')
+        cached = (key, IncludeTrie(key))
+        include_tries[path] = cached
+
+    return cached[1]
+
+    # getIncludeTrie function ends here.
+    # ----------------------------------
+
+
+def getDropboxIncludeTrie(include_directories, path=None, cache=None):
+    '''
+    This function returns the include trie of the given include directories
+    plus the dropbox cache directory, which is never excluded. The dropbox
+    path and cache default to dropbox_path and dropbox_cache.
+    '''
 
     # Global variables
     global dropbox_path
+    global dropbox_cache
+
+    if path is None:
+        path = dropbox_path
+
+    if cache is None:
+        cache = dropbox_cache
+
+    path = os.path.normpath(os.path.expanduser(path))
+
+    return getIncludeTrie(list(include_directories)
+                          + [os.path.join(path, cache)], path)
+
+    # getDropboxIncludeTrie function ends here.
+    # -----------------------------------------
+
+
+def evalToExcludeDirectories2(include_directories, current_directories,
+                              trie=None):
+    '''
+    This function evaluates directories to be excluded comparing each current
+    directory, given as a path table or a list of paths, with included
+    directories. The include trie defaults to the one of the given include
+    directories under dropbox_path.
+    '''
+
+    logger.debug('Evaluate directories not present on a given list:'
+                 '\nInclude directory list: %s'
+                 '\nDirectory list to evaluate: %s',
+                 LogSummary(include_directories),
+                 LogSummary(current_directories))
 
     # Local variables
-    include_list = []
-    directories = []
-    in_common = ''
-    unexclude_set = set()
-    unexclude_list = []
+    exclude_directory_list = []
 
-    for include in include_directory_list:
-        include_list.append(
-            include[len(os.path.expanduser(dropbox_path))+1:].lower())
+    if trie is None:
+        trie = getDropboxIncludeTrie(include_directories)
 
-    include_list.sort()
+    if not isinstance(current_directories, PathTable):
+        current_directories = PathTable(current_directories)
 
-    for directory in excluded_directories:
+    exclude_directory_list = current_directories.excludePaths(trie)
+
+    logger.debug('To exclude directories: %s',
+                 LogSummary(exclude_directory_list))
+
+    return exclude_directory_list
 
-        for include_directory in include_list:
+    # evalToExcludeDirectories2 function ends here.
+    # ---------------------------------------------
 
-            directories = []
-            directories.append(directory.lower())
-            directories.append(include_directory)
 
-            in_common = os.path.commonprefix(directories)
+def commandArgumentLimit():
+    '''
+    This function returns how many bytes the arguments of a command may take,
+    which is the kernel ARG_MAX limit less the environment and a safety
+    margin.
+    '''
 
-            if len(in_common):
+    # Local variables
+    limit = 131072
+    environment = 0
 
-                if len(directories[0]) >= len(directories[1]):
+    try:
+        limit = os.sysconf('SC_ARG_MAX')
+    except (ValueError, OSError):
+        pass
 
-                    if directories[0][:len(directories[1])] == directories[1]:
+    for key, value in os.environ.items():
+        environment += len(key) + len(value) + 2 + 8
 
-                        if directories[0].startswith(directories[1] + os.sep) \
-                           or (directories[0] + os.sep).startswith(
-                                directories[1] + os.sep):
+    return max(4096, limit - environment - 4096)
 
-                            unexclude_set.add(directories[0])
+    # commandArgumentLimit function ends here.
+    # ----------------------------------------
 
-                else:
 
-                    if directories[0] == directories[1][:len(directories[0])]:
+def splitArguments(args, argument_list, limit):
+    '''
+    This function splits the argument list into chunks which, appended to the
+    given command args, do not exceed the given limit in bytes. Each argument
+    takes its length, its terminating null byte and its pointer.
+    '''
 
-                        if directories[1].startswith(directories[0] + os.sep) \
-                           or (directories[1] + os.sep).startswith(
-                                directories[0] + os.sep):
+    # Local variables
+    base = 0
+    size = 0
+    chunk = []
+    chunks = []
 
-                            unexclude_set.add(directories[0])
+    for arg in args:
+        base += len(os.fsencode(arg)) + 1 + 8
 
-    unexclude_list = list(unexclude_set)
+    size = base
 
-    unexclude_list.sort()
+    for argument in argument_list:
+        length = len(os.fsencode(argument)) + 1 + 8
+        if chunk and size + length > limit:
+            chunks.append(chunk)
+            chunk = []
+            size = base
+        chunk.append(argument)
+        size += length
 
-    logger.debug('Directories to unexclude: '
-                 + str(unexclude_list))
+    if chunk:
+        chunks.append(chunk)
 
-    return unexclude_list
+    return chunks
 
-    # evalToUnexcludeDirectories function ends here.
-    # ----------------------------------------------
+    # splitArguments function ends here.
+    # ----------------------------------
 
 
-def evalExcludeInclude(directory_list):
+def getCommandLimiter():
     '''
-    Function that inotify calls whenever a new directory is created under
-    monitored directory path.
+    This function returns the limiter of the number of dropbox commands
+    running at once, up to command_workers, of the running event loop.
     '''
 
-    logger.debug('Configure the entire environment, and go through include exclude \
-                 sequence')
+    # Global variables
+    global command_limiter
+    global command_workers
+    global command_latency_target
+
+    if command_limiter is None \
+       or not command_limiter.loop is asyncio.get_running_loop():
+        command_limiter = CommandLimiter(command_workers,
+                                         command_latency_target)
+
+    return command_limiter
+
+    # getCommandLimiter function ends here.
+    # -------------------------------------
 
-    logger.info('Directory(ies) to check: '
-                + str(directory_list))
+
+def retryDelay(attempt, limit=None):
+    '''
+    This function returns the seconds to wait before the given retry of a
+    failed operation: command_retry_delay doubled on each attempt, up to the
+    given limit, of which a random half is waited, so that operations which
+    failed together are not retried together.
+    '''
+
+    # Global variables
+    global command_retry_delay
 
     # Local variables
-    exclude_directories = []
+    delay = float(command_retry_delay) * 2 ** max(0, attempt - 1)
 
-    configuration(config_file)
+    if limit is not None:
+        delay = min(delay, float(limit))
 
-    exclude_directories = evalToExcludeDirectories2(
-        include_directory_list, directory_list)
+    return random.uniform(delay / 2, delay)
 
-    if len(exclude_directories):
-        out = executeCommand(dropbox_exclude_add_command,
-                             exclude_directories,
-                             os.path.expanduser(dropbox_path))
+    # retryDelay function ends here.
+    # ------------------------------
 
-    logger.info('Entering exclude and unexclude sequence')
 
-    dropbox_exclude_list = evalDropboxExcludeList()
+async def runCommandOnce(args, child_working_directory):
+    '''
+    This function executes the given args on the given cwd path, killing the
+    command if it runs longer than command_timeout seconds or if it is
+    cancelled.
+    '''
 
-    unexclude_list = evalToUnexcludeDirectories(
-        dropbox_exclude_list, include_directory_list)
+    # Global variables
+    global command_timeout
 
-    if unexclude_list:
-        out = executeCommand(dropbox_exclude_remove_command,
-                             unexclude_list,
-                             os.path.expanduser(dropbox_path))
+    # Local variables
+    process = None
+    out = b''
+    err = b''
 
-    # evalExcludeInclude function ends here.
-    # --------------------------------------
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *args,
+            cwd=child_working_directory,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE)
+    except OSError as error:
+        return CommandResult(args, None, '', str(error))
 
-# Functions - END
-# ---------------
+    try:
+        out, err = await asyncio.wait_for(process.communicate(),
+                                          float(command_timeout))
+    except asyncio.TimeoutError:
+        return CommandResult(args, None, '',
+                             'Timed out after ' + str(command_timeout)
+                             + ' seconds')
+    finally:
+        if process.returncode is None:
+            process.kill()
+            await asyncio.shield(process.wait())
+
+    return CommandResult(args,
+                         process.returncode,
+                         out.decode('utf-8', 'replace'),
+                         err.decode('utf-8', 'replace'))
+
+    # runCommandOnce function ends here.
+    # ----------------------------------
 
 
-# Classes
-class EventHandler(pyinotify.ProcessEvent):
+async def runCommand(args, child_working_directory, kind='other'):
     '''
-    Class which is called by inotify.
+    This function executes the given args on the given cwd path once the
+    number of running commands allows it. Failed commands are retried
+    command_retries times, waiting about twice as long each time. The kind
+    of command, add, list or remove, labels its metrics.
     '''
 
-    # Define a function for folder and file creation process
-    def process_IN_CREATE(self, event):
-        '''
-        Function which is called by inotify whenever a new directory is
-        created.
-        '''
+    # Global variables
+    global command_retries
 
-        logger.debug('New directory detected: '
-                     + str(event.pathname))
+    # Local variables
+    limiter = getCommandLimiter()
+    attempt = 0
+    delay = 0.0
+    result = None
+    start = 0.0
 
-        # Local variables
-        directory_list = []
+    while True:
 
-        directory_list.append(event.pathname)
+        async with limiter:
+            logger.info('%s', LogSummary(args))
+            start = time.monotonic()
+            result = await runCommandOnce(args, child_working_directory)
+            limiter.observe(time.monotonic() - start,
+                            result.returncode is not None)
+            observeMetric('dropbox_include_command_duration_seconds',
+                          time.monotonic() - start,
+                          command=kind, method='cli')
+            countMetric('dropbox_include_commands_total',
+                        command=kind, method='cli',
+                        status=('error' if result.returncode is None
+                                else str(result.returncode)))
+
+        if result.returncode == 0 or attempt >= int(command_retries):
+            break
 
-        evalExcludeInclude(directory_list)
+        attempt += 1
+        delay = retryDelay(attempt)
+        logger.warning('Command failed, retry %d in %.1f seconds: %s',
+                       attempt, delay, str(result.error).strip())
+        await asyncio.sleep(delay)
 
-    # process_IN_CREATE function ends here.
-    # -------------------------------------
+    if not result.returncode == 0:
+        logger.error('Command failed: %s %s', LogSummary(args),
+                     str(result.error).strip())
 
+    return result
 
-# EventHandler class definition ends here.
-# ----------------------------------------
+    # runCommand function ends here.
+    # ------------------------------
 
 
-# -----------------------------------------------------------------------------
-#                                     Main
-# -----------------------------------------------------------------------------
+async def executeCommandChunks(command,
+                               argument_list,
+                               child_working_directory,
+                               kind='other'):
+    '''
+    This function takes the command, the argument list and the
+    child_working_directory path and executes the given command with the
+    given arguments on the given cwd path. The argument list is split into
+    chunks which respect the kernel argument limit, which are executed at
+    once as far as command_workers allows. It returns the result of each
+    chunk, in order, with the arguments of the chunk.
+    '''
 
-def main():
+    logger.debug('Execute command: %s %s', command,
+                 LogSummary(argument_list))
 
-    setLogger()
+    # Local variables
+    args = []
+    chunks = []
+    results = []
 
-    logger.warning('Starting ' + __app_name__ + ' ' + __version__)
+    # Split the command and add to args list
+    args.extend(command.split())
 
-    # Parse configuration file
+    if not argument_list:
+        return [(await runCommand(args, child_working_directory, kind))
+                ._replace(arguments=[])]
 
-    logger.debug('Parse ' + str(config_file) + ' configuration file if exists')
+    chunks = splitArguments(args, argument_list, commandArgumentLimit())
 
-    configuration(config_file)
+    if len(chunks) > 1:
+        logger.info('Split ' + str(len(argument_list)) + ' arguments into '
+                    + str(len(chunks)) + ' commands')
 
-    logger.debug('Set logger with default settings')
-    setLogger()
+    results = await asyncio.gather(*[
+        runCommand(args + chunk, child_working_directory, kind)
+        for chunk in chunks])
 
-    # argparse section
+    return [result._replace(arguments=chunk)
+            for chunk, result in zip(chunks, results)]
 
-    logger.debug('Parse command line arguments')
-    old_config_file = config_file
-    parse_arguments()
+    # executeCommandChunks function ends here.
+    # ----------------------------------------
 
-    if not config_file == old_config_file:
-        logger.debug('Set logger with configuration file settings')
-        configuration(config_file)
-        setLogger()
 
-    # end of argparse section
+def succeededArguments(results):
+    '''
+    This function returns the arguments of the chunks which succeeded.
+    '''
 
-    logger.info('Entering initial exclude and unexclude sequence')
+    # Local variables
+    arguments = []
 
-    current_directories = evalCurrentDirectories(dropbox_path)
+    for result in results:
+        if result.returncode == 0:
+            arguments.extend(result.arguments)
 
-    logger.debug('Initial dropbox_path directories: '
-                 + str(current_directories))
+    return arguments
 
-    exclude_directories = evalToExcludeDirectories2(
-        include_directory_list,
-        current_directories)
+    # succeededArguments function ends here.
+    # --------------------------------------
 
-    logger.debug('To exclude directories: '
-                 + str(exclude_directories))
 
-    if len(exclude_directories):
-        out = executeCommand(dropbox_exclude_add_command,
-                             exclude_directories,
-                             os.path.expanduser(dropbox_path))
+async def executeCommand(command,
+                         argument_list,
+                         child_working_directory):
+    '''
+    This function takes the command, the argument list and the
+    child_working_directory path and executes the given command with the
+    given arguments on the given cwd path. It returns the output of all
+    the chunks the argument list has been split into.
+    '''
 
-    dropbox_exclude_list = evalDropboxExcludeList()
+    # Local variables
+    results = await executeCommandChunks(command,
+                                         argument_list,
+                                         child_working_directory)
+
+    # Return the output of the executed command.
+    return ''.join(result.output for result in results)
 
-    logger.debug('Initial already excluded directories: '
-                 + str(dropbox_exclude_list))
+    # executeCommand function ends here.
+    # ----------------------------------
 
-    unexclude_list = evalToUnexcludeDirectories(
-        dropbox_exclude_list,
-        include_directory_list)
 
-    logger.debug('Initial directories to unexclude: '
-                 + str(unexclude_list))
+async def evalDropboxExcludeList(command, path, client=None):
+    '''
+    This function evaluates the list of excluded directories of the given
+    dropbox path, through the given dropbox command socket client if any or
+    by executing the given command otherwise. It returns None if the exclude
+    list command fails.
+    '''
 
-    if unexclude_list:
-        out = executeCommand(dropbox_exclude_remove_command,
-                             unexclude_list,
-                             os.path.expanduser(dropbox_path))
+    logger.debug('Evaluate dropbox excluded directory list')
 
-    logger.info('Leaving initial exclude and unexclude sequence')
+    # Local variables
+    result = None
+    args = []
 
-    # -------------------------------------------------------------------------
+    if client is not None:
+        try:
+            return [client.relativePath(directory, path)
+                    for directory in sorted(
+                        await asyncio.get_running_loop().run_in_executor(
+                            None, client.getIgnoreSet))]
+        except (OSError, DropboxCommandError) as error:
+            logger.warning('Dropbox command socket failed, run '
+                           + str(command) + ': ' + str(error))
 
-    logger.info('Entering inotify setup')
+    result = (await executeCommandChunks(
+        command, args, os.path.expanduser(path), 'list'))[0]
 
-    # Continue running until user stops it
-    # If dropbox creates a new directory or subdirectory inside the main
-    # dropbox folder, check whether it should be excluded or not and do
-    # it so.
+    if not result.returncode == 0:
+        return None
 
-    # The watch manager stores the watches and provides operations on watches
-    wm = pyinotify.WatchManager()
+    # Split the list considering each line as an independent directory.
+    dropbox_exclude_list_aux = result.output.split('\n')
 
-    # Watched events: watch whether a new directory is created
-    mask = pyinotify.IN_CREATE | pyinotify.IN_ISDIR
+    # Remove the first and the last list members which are 'Excluded: ' and ''
+    try:
+        dropbox_exclude_list_aux.pop(0)
+        dropbox_exclude_list_aux.pop(-1)
+    except IndexError:
+        print("IndexError")
 
-    # Associate this WatchManager with a ThreadedNotifier
-    notifier = pyinotify.ThreadedNotifier(wm, EventHandler())
+    # Return the list of directories.
+    return dropbox_exclude_list_aux
 
-    # Start the notifier from a new thread, without doing anything as no
-    # directory or file are currently monitored yet.
-    notifier.start()
+    # evalDropboxExcludeList function ends here.
+    # ------------------------------------------
 
-    # Add a new watch on folder to monitor for watched events.
-    wm.add_watch(os.path.expanduser(dropbox_path),
-                 mask, rec=True, auto_add=True)
 
-    logger.info('Entering inotify loop')
+async def dropboxExcludeAdd(command, directory_list, path, client=None):
+    '''
+    This function adds the given directories to the dropbox exclude list,
+    through the given dropbox command socket client if any or by executing
+    the given command otherwise. It returns the directories which were
+    added.
+    '''
 
-    while True:
+    if client is not None:
         try:
-            time.sleep(5)
-        except KeyboardInterrupt:
-            logger.warning('Leaving due to KeyboardInterrupt')
-            notifier.stop()
-            break
-        except:
-            logger.warning('Leaving due to kill signal')
-            notifier.stop()
-            raise
+            await asyncio.get_running_loop().run_in_executor(
+                None, client.ignoreSetAdd, directory_list)
+            return list(directory_list)
+        except (OSError, DropboxCommandError) as error:
+            logger.warning('Dropbox command socket failed, run '
+                           + str(command) + ': ' + str(error))
+
+    return succeededArguments(await executeCommandChunks(
+        command, directory_list, path, 'add'))
+
+    # dropboxExcludeAdd function ends here.
+    # -------------------------------------
+
+
+async def dropboxExcludeRemove(command, directory_list, path,
+                               client=None):
+    '''
+    This function removes the given directories, relative to the given path,
+    from the dropbox exclude list, through the given dropbox command socket
+    client if any or by executing the given command otherwise. It returns
+    the directories which were removed.
+    '''
+
+    if client is not None:
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                None, client.ignoreSetRemove,
+                [os.path.join(path, directory)
+                 for directory in directory_list])
+            return list(directory_list)
+        except (OSError, DropboxCommandError) as error:
+            logger.warning('Dropbox command socket failed, run '
+                           + str(command) + ': ' + str(error))
+
+    return succeededArguments(await executeCommandChunks(
+        command, directory_list, path, 'remove'))
+
+    # dropboxExcludeRemove function ends here.
+    # ----------------------------------------
+
+
+async def excludeDirectories(root, snapshot, directory_list):
+    '''
+    This function adds the given directories to the dropbox exclude list of
+    the given dropbox root and to its in memory exclude list. The operation
+    is written and synced to the journal of the root before the command
+    runs and marked as done, with the directories which were added, once it
+    finished. It returns the directories which were added.
+    '''
+
+    # Local variables
+    operation = None
+    excluded_directories = []
+
+    if root.journal is not None:
+        operation = root.journal.plan('add', directory_list)
+        await asyncio.get_running_loop().run_in_executor(
+            None, root.journal.sync)
+
+    excluded_directories = await dropboxExcludeAdd(
+        snapshot.dropbox_exclude_add_command,
+        directory_list,
+        os.path.expanduser(snapshot.dropbox_path),
+        root.client)
+    root.exclude_state.add(excluded_directories)
+
+    if root.journal is not None:
+        root.journal.complete(operation, excluded_directories)
+        await asyncio.get_running_loop().run_in_executor(
+            None, root.journal.sync)
+
+    return excluded_directories
+
+    # excludeDirectories function ends here.
+    # --------------------------------------
+
+
+async def unexcludeDirectories(root, snapshot, directory_list):
+    '''
+    This function removes the given exclude list entries from the dropbox
+    exclude list of the given dropbox root and from its in memory exclude
+    list, writing the operation to the journal of the root in the same way
+    excludeDirectories does. It returns the entries which were removed.
+    '''
+
+    # Local variables
+    operation = None
+    unexcluded_directories = []
+
+    if root.journal is not None:
+        operation = root.journal.plan('remove', directory_list)
+        await asyncio.get_running_loop().run_in_executor(
+            None, root.journal.sync)
+
+    unexcluded_directories = await dropboxExcludeRemove(
+        snapshot.dropbox_exclude_remove_command,
+        directory_list,
+        os.path.expanduser(snapshot.dropbox_path),
+        root.client)
+    root.exclude_state.remove(unexcluded_directories)
+
+    if root.journal is not None:
+        root.journal.complete(operation, unexcluded_directories)
+        await asyncio.get_running_loop().run_in_executor(
+            None, root.journal.sync)
+
+    return unexcluded_directories
+
+    # unexcludeDirectories function ends here.
+    # ----------------------------------------
+
+
+def replayJournal(root):
+    '''
+    This function brings the in memory exclude list of the given dropbox
+    root, seeded from the saved state, up to date with the operations its
+    journal recorded since the state was saved, without running any dropbox
+    command. It returns the existing directories which operations that never
+    finished were to exclude. Entries which such operations were to
+    unexclude are not returned, as the unexclude sequence finds them again.
+    '''
+
+    # Local variables
+    operations = root.journal.load()
+    unfinished = 0
+    replay_directories = []
+
+    for operation, directory_list, done_list in operations:
+        if done_list is None:
+            unfinished += 1
+            done_list = []
+        elif operation == 'add':
+            root.exclude_state.add(done_list)
+        else:
+            root.exclude_state.remove(done_list)
+
+        if operation == 'add' and not len(done_list) == len(directory_list):
+            done_list = set(done_list)
+            replay_directories.extend(
+                directory for directory in directory_list
+                if directory not in done_list and os.path.isdir(directory))
+
+    if operations:
+        logger.info('Replayed %d journal operations, %d unfinished, %d '
+                    'directories still to exclude', len(operations),
+                    unfinished, len(replay_directories))
+
+    return replay_directories
+
+    # replayJournal function ends here.
+    # ---------------------------------
+
+
+def getUnexcludeIndex(include_directory_list, path):
+    '''
+    This function returns the include directories relative to the given
+    dropbox path and in lower case, as exclude list entries are, together
+    with every ancestor of them. The last index of each dropbox path is kept
+    and reused as long as its include directories do not change, so that
+    several dropbox roots do not replace each other's index.
+    '''
+
+    # Global variables
+    global unexclude_indexes
+
+    # Local variables
+    key = tuple(include_directory_list)
+    cached = unexclude_indexes.get(path)
+    includes = set()
+    ancestors = set()
+    include = ''
+
+    if cached is not None and key == cached[0]:
+        return cached[1]
+
+    for include in include_directory_list:
+        include = include[len(os.path.expanduser(path))+1:].lower()
+        if not include:
+            continue
+        includes.add(include)
+        for position, character in enumerate(include):
+            if character == os.sep and position:
+                ancestors.add(include[:position])
+
+    cached = (key, (frozenset(includes), frozenset(ancestors)))
+    unexclude_indexes[path] = cached
+
+    return cached[1]
+
+    # getUnexcludeIndex function ends here.
+    # -------------------------------------
+
+
+def evalToUnexcludeDirectories(excluded_directories, include_directory_list,
+                               path=None):
+    '''
+    This function evaluates each excluded directory against include
+    directories and devices whether the directory should be unexcluded or not.
+    An excluded directory is unexcluded if it is an include directory, lies
+    under one or holds one. The dropbox path defaults to dropbox_path.
+    '''
+
+    logger.debug('Evaluate directories which should not be excluded')
+
+    # Global variables
+    global dropbox_path
+
+    # Local variables
+    includes, ancestors = getUnexcludeIndex(
+        include_directory_list, dropbox_path if path is None else path)
+    directory = ''
+    unexclude_set = set()
+    unexclude_list = []
+
+    for directory in excluded_directories:
+
+        directory = directory.lower()
+
+        if not directory:
+            continue
+
+        # The excluded directory holds an include directory.
+        if directory in ancestors or directory in includes:
+            unexclude_set.add(directory)
+            continue
+
+        # The excluded directory lies under an include directory.
+        for position, character in enumerate(directory):
+            if character == os.sep and directory[:position] in includes:
+                unexclude_set.add(directory)
+                break
+
+    unexclude_list = list(unexclude_set)
+
+    unexclude_list.sort()
+
+    logger.debug('Directories to unexclude: %s', LogSummary(unexclude_list))
+
+    return unexclude_list
+
+    # evalToUnexcludeDirectories function ends here.
+    # ----------------------------------------------
+
+
+def evalToExcludeDelta(exclude_state, exclude_directories, unexclude_list):
+    '''
+    This function compares the directories which should be excluded, the
+    exclusion frontier, with the given in memory exclude list as it is left
+    once the given entries are unexcluded. It returns only the directories
+    which still have to be excluded: directories already excluded, by
+    themselves or by an ancestor, and directories under another directory
+    to exclude are left out, so that each excluded tree is sent once.
+    '''
+
+    # Local variables
+    ignored = frozenset(unexclude_list)
+    delta_set = set()
+    directory = ''
+    ancestor = ''
+
+    # Ancestors sort before their subdirectories.
+    for directory in sorted(set(exclude_directories),
+                            key=lambda directory: directory.count(os.sep)):
+
+        ancestor = os.path.dirname(directory)
+        while not ancestor == os.path.dirname(ancestor) \
+                and ancestor not in delta_set:
+            ancestor = os.path.dirname(ancestor)
+
+        if ancestor in delta_set \
+           or exclude_state.isExcluded(directory, ignored):
+            continue
+
+        delta_set.add(directory)
+
+    logger.debug('Exclude delta: %d of %d directories', len(delta_set),
+                 len(exclude_directories))
+
+    return sorted(delta_set)
+
+    # evalToExcludeDelta function ends here.
+    # --------------------------------------
+
+
+def evalCurrentDirectoriesList(directory_list, trie, table=None):
+    '''
+    This function evaluates current directories and subdirectories in each
+    given directory path, and returns them in a single path table.
+    '''
+
+    # Local variables
+    current_directories = PathTable()
+
+    for directory in directory_list:
+        evalCurrentDirectories(directory, trie, table, current_directories)
+
+    return current_directories
+
+    # evalCurrentDirectoriesList function ends here.
+    # ----------------------------------------------
+
+
+def loadStateSnapshot(path, dropbox_path):
+    '''
+    This function loads the state of the given dropbox path saved by the
+    last run from the given file. It returns None if there is no usable
+    state.
+    '''
+
+    # Local variables
+    path = os.path.expanduser(path)
+    state = None
+
+    if not os.path.exists(path):
+        return None
+
+    try:
+        with open(path, 'r') as file:
+            state = json.load(file)
+    except (IOError, OSError, ValueError) as error:
+        logger.warning('Unable to load state file ' + str(path) + ': '
+                       + str(error))
+        return None
+
+    if not isinstance(state, dict) or not state.get('version') == 1 \
+       or not state.get('dropbox_path') == os.path.normpath(
+           os.path.expanduser(dropbox_path)):
+        logger.info('Ignore state file of another dropbox path or version: '
+                    + str(path))
+        return None
+
+    return state
+
+    # loadStateSnapshot function ends here.
+    # -------------------------------------
+
+
+def saveStateSnapshot(root):
+    '''
+    This function saves the scanned directories, the include directories and
+    the in memory exclude list of the given dropbox root into its state
+    file, so that the next run only scans the directories which changed. The
+    file is replaced at once, so that it is never read half written.
+    '''
+
+    # Local variables
+    path = os.path.expanduser(root.snapshot.state_file)
+    state = {}
+
+    if root.exclude_state is None or root.directory_table is None:
+        return
+
+    state = {
+        'version': 1,
+        'dropbox_path': root.path,
+        'include_directories': sorted(root.snapshot.include_directory_list),
+        'exclude_list': root.exclude_state.list(),
+        'directories': root.directory_table.dump()}
+
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path + '.tmp', 'w') as file:
+            json.dump(state, file, separators=(',', ':'))
+        os.rename(path + '.tmp', path)
+    except (IOError, OSError) as error:
+        logger.error('Unable to save state file ' + str(path) + ': '
+                     + str(error))
+        return
+
+    # The saved state already holds the operations of the journal.
+    if root.journal is not None:
+        root.journal.reset()
+
+    logger.debug('State saved: ' + str(path))
+
+    # saveStateSnapshot function ends here.
+    # -------------------------------------
+
+
+def evalChangedDirectories(root, since):
+    '''
+    This function returns the subdirectories created under the watched
+    directories of the given dropbox root since the given time, in
+    nanoseconds. Only watched directories modified since then are scanned
+    again, through the root directory table, and their subdirectories which
+    were not known or whose inode changed are returned, unless they are
+    already excluded. It only scans, so it may run in an executor thread.
+    '''
+
+    # Local variables
+    changed = 0
+    stat = None
+    known = None
+    inode = None
+    new_directories = []
+
+    for directory in root.watch_registry.directories():
+        try:
+            stat = os.stat(directory)
+        except OSError:
+            continue
+
+        if stat.st_mtime_ns < since:
+            continue
+
+        changed += 1
+        known = root.directory_table.names(directory)
+
+        for subdirectory in root.directory_table.scan(directory):
+            if known is not None \
+               and os.path.basename(subdirectory) in known:
+                inode = root.directory_table.inode(subdirectory)
+                try:
+                    if inode is None \
+                       or os.stat(subdirectory).st_ino == inode:
+                        continue
+                except OSError:
+                    continue
+
+            if root.exclude_state.isExcluded(subdirectory):
+                continue
+
+            new_directories.append(subdirectory)
+
+    logger.info('Scanned ' + str(changed) + ' changed watched directories, '
+                + str(len(new_directories)) + ' new subdirectories found')
+
+    return new_directories
+
+    # evalChangedDirectories function ends here.
+    # ------------------------------------------
+
+
+def countCycleMetrics(exclude_directories, unexclude_directories):
+    '''
+    This function records the size of the exclude and unexclude lists of an
+    exclude and unexclude sequence.
+    '''
+
+    countMetric('dropbox_include_cycles_total')
+    setMetric('dropbox_include_cycle_exclude_directories',
+              len(exclude_directories))
+    setMetric('dropbox_include_cycle_unexclude_directories',
+              len(unexclude_directories))
+
+    # countCycleMetrics function ends here.
+    # -------------------------------------
+
+
+async def profileCall(name, function, *args):
+    '''
+    This function awaits the given coroutine function called with the given
+    arguments, profiling it under the given name if profiling is enabled.
+    '''
+
+    # Global variables
+    global profiler
+
+    if profiler is None:
+        return await function(*args)
+
+    with profiler.section(name):
+        return await function(*args)
+
+    # profileCall function ends here.
+    # -------------------------------
+
+
+async def reconcileExcludeList(root, snapshot, exclude_directories):
+    '''
+    Function which brings the exclude list of the given dropbox root to the
+    desired one, running dropbox only for the difference. Exclude list
+    entries which lie on an include directory path are unexcluded first,
+    and the subdirectories they covered are evaluated, as they may need to
+    be excluded on their own. Then only the directories to exclude which
+    the exclude list left does not cover yet are excluded. Directories to
+    exclude are never on an include directory path, so nothing excluded is
+    unexcluded by the next sequence. It returns the directories which could
+    not be excluded. Entries which could not be unexcluded stay on the in
+    memory exclude list, so the next sequence tries again.
+    '''
+
+    # Local variables
+    loop = asyncio.get_running_loop()
+    path = os.path.normpath(os.path.expanduser(snapshot.dropbox_path))
+    unexclude_list = []
+    include_paths = {}
+    directory = ''
+    exclude_list = []
+    excluded_directories = []
+    unexcluded_directories = []
+
+    # Runs for the same root, from the urgent batches, the queued ones or
+    # the control socket, are applied one at a time, so that each one
+    # evaluates the exclude list the previous one left.
+    async with root.reconciling:
+        unexclude_list = evalToUnexcludeDirectories(
+            root.exclude_state.list(), snapshot.include_directory_list,
+            snapshot.dropbox_path)
+
+        if unexclude_list:
+
+            # Exclude list entries are lower case, so the directories they
+            # stand for are looked up among the include directory paths.
+            for directory in snapshot.include_directory_list:
+                directory = os.path.normpath(directory)
+                while directory.startswith(path + os.sep):
+                    include_paths.setdefault(
+                        os.path.relpath(directory, path).lower(), directory)
+                    directory = os.path.dirname(directory)
+
+            exclude_directories = list(exclude_directories) \
+                + evalToExcludeDirectories2(
+                    snapshot.include_directory_list,
+                    await loop.run_in_executor(
+                        None, evalCurrentDirectoriesList,
+                        [include_paths[entry] for entry in unexclude_list
+                         if entry in include_paths],
+                        snapshot.include_trie, root.directory_table),
+                    snapshot.include_trie)
+
+        exclude_list = evalToExcludeDelta(root.exclude_state,
+                                          exclude_directories, unexclude_list)
+
+        logger.debug('Directories to exclude: %s Directories to unexclude: %s',
+                     LogSummary(exclude_list), LogSummary(unexclude_list))
+
+        countCycleMetrics(exclude_list, unexclude_list)
+
+        if unexclude_list:
+            unexcluded_directories = await unexcludeDirectories(
+                root, snapshot, unexclude_list)
+
+            # Unexcluded directories may lie on include directory paths.
+            if root.watch_registry is not None and unexcluded_directories:
+                await root.watch_registry.watch(root.watch_registry.path)
+
+        if exclude_list:
+            excluded_directories = await excludeDirectories(
+                root, snapshot, exclude_list)
+
+            if root.watch_registry is not None:
+                for directory in excluded_directories:
+                    root.watch_registry.remove(directory)
+
+        return sorted(set(exclude_list).difference(excluded_directories))
+
+    # reconcileExcludeList function ends here.
+    # ----------------------------------------
+
+
+async def evalExcludeIncludePlan(root, directory_list):
+    '''
+    Function which evaluates a batch of new directories created under the
+    given dropbox root and returns the configuration snapshot it was
+    evaluated with together with the directories to exclude.
+    '''
+
+    logger.debug('Configure the entire environment, and go through include exclude \
+                 sequence')
+
+    logger.info('Directory(ies) to check: %s', LogSummary(directory_list))
+
+    # Local variables
+    loop = asyncio.get_running_loop()
+    snapshot = None
+    excluded_list = []
+    current_directories = []
+    exclude_directories = []
+
+    snapshot = root.loadConfiguration()
+
+    # Directories created within a directory which was excluded after they
+    # were queued, and which stays excluded, need not be evaluated.
+    excluded_list = [
+        directory for directory in directory_list
+        if snapshot.include_trie.excludePath(directory) is not None
+        and root.exclude_state.isExcluded(directory)]
+    if excluded_list:
+        logger.debug('Directories within an excluded directory: %s',
+                     LogSummary(excluded_list))
+        countMetric('dropbox_include_events_dropped_total',
+                    len(excluded_list))
+        directory_list = sorted(set(directory_list).difference(
+            excluded_list))
+
+    # Watch the directories which should be watched with the new settings.
+    if root.watch_registry is not None \
+       and root.watch_registry.trie is not snapshot.include_trie:
+        await root.watch_registry.update(snapshot.include_trie)
+
+    # New directories may already hold subdirectories which need to be
+    # evaluated too, as only the topmost ones are queued. Directories moved
+    # within the dropbox path keep their scanned entries, so only the ones
+    # which changed are scanned again.
+    current_directories = await loop.run_in_executor(
+        None, evalCurrentDirectoriesList, directory_list,
+        snapshot.include_trie, root.directory_table)
+
+    exclude_directories = evalToExcludeDirectories2(
+        snapshot.include_directory_list, current_directories,
+        snapshot.include_trie)
+
+    return snapshot, exclude_directories
+
+    # evalExcludeIncludePlan function ends here.
+    # ------------------------------------------
+
+
+async def evalExcludeIncludeApply(root, plan):
+    '''
+    Function which reconciles the exclude list of the given dropbox root
+    with an evaluated batch. It returns the directories which could not be
+    excluded.
+    '''
+
+    # Local variables
+    snapshot, exclude_directories = plan
+    failed_directories = []
+
+    logger.info('Entering exclude and unexclude sequence')
+
+    failed_directories = await reconcileExcludeList(
+        root, snapshot, exclude_directories)
+
+    # The journal only grows until the state is saved again.
+    if root.journal is not None and root.journal.isFull():
+        await asyncio.get_running_loop().run_in_executor(
+            None, saveStateSnapshot, root)
+
+    return failed_directories
+
+    # evalExcludeIncludeApply function ends here.
+    # -------------------------------------------
+
+
+async def evalExcludeInclude(root, directory_list):
+    '''
+    Function which goes through the include exclude sequence for the given
+    directories created under the given dropbox root. It returns the
+    directories which could not be excluded.
+    '''
+
+    return await evalExcludeIncludeApply(
+        root, await evalExcludeIncludePlan(root, directory_list))
+
+    # evalExcludeInclude function ends here.
+    # --------------------------------------
+
+# Functions - END
+# ---------------
+
+
+# Classes
+CommandResult = collections.namedtuple('CommandResult', [
+    'arguments',
+    'returncode',
+    'output',
+    'error'])
+
+ConfigSnapshot = collections.namedtuple('ConfigSnapshot', [
+    'config_file',
+    'dropbox_path',
+    'dropbox_cache',
+    'dropbox_exclude_add_command',
+    'dropbox_exclude_list_command',
+    'dropbox_exclude_remove_command',
+    'dropbox_command_method',
+    'dropbox_command_socket',
+    'state_file',
+    'include_directory_list',
+    'include_trie',
+    'files',
+    'signature',
+    'digest'])
+
+
+class LogSummary(object):
+    '''
+    Class which stands for a list of items in a log message. The list is
+    only turned into text if the message is written, and a list longer than
+    logger_sample is written as its first logger_sample items followed by
+    its length.
+    '''
+
+    def __init__(self, items):
+
+        self.items = items
+
+    # __init__ function ends here.
+    # ----------------------------
+
+    def __str__(self):
+
+        # Local variables
+        sample = int(logger_sample)
+        items = []
+
+        if sample <= 0 or len(self.items) <= sample:
+            return str(list(self.items))
+
+        items = [repr(item) for item in itertools.islice(self.items, sample)]
+
+        return '[' + ', '.join(items) + ', ... ' + str(len(self.items)) \
+            + ' items]'
+
+    # __str__ function ends here.
+    # ---------------------------
+
+
+# LogSummary class definition ends here.
+# --------------------------------------
+
+
+class Profiler(object):
+    '''
+    Class which profiles one in every given number of runs of each named
+    section with cProfile and tracemalloc. The statistics of each profiled
+    run are written into the given directory, as a pstats file and a
+    tracemalloc snapshot, and their top entries are logged. cProfile only
+    sees the event loop thread, so directory scans run by the worker threads
+    show up as time spent waiting for them, whereas tracemalloc traces the
+    memory allocated by every thread. Only one section is profiled at once,
+    so runs overlapping a profiled one are not sampled.
+    '''
+
+    def __init__(self, sample, directory, top=10):
+
+        self.sample = max(0, int(sample))
+        self.directory = os.path.expanduser(directory)
+        self.top = top
+        self.counts = {}
+        self.active = None
+
+    # __init__ function ends here.
+    # ----------------------------
+
+    @contextlib.contextmanager
+    def section(self, name):
+        '''
+        Function which profiles the run of the named section it wraps, if it
+        is sampled.
+        '''
+
+        # Local variables
+        count = self.counts.get(name, 0) + 1
+        profile = None
+        tracing = False
+        start = 0.0
+
+        self.counts[name] = count
+
+        if not self.sample or self.active is not None \
+           or (count - 1) % self.sample:
+            yield
+            return
+
+        self.active = name
+        tracing = tracemalloc.is_tracing()
+
+        if not tracing:
+            tracemalloc.start()
+
+        tracemalloc.reset_peak()
+        profile = cProfile.Profile()
+        start = time.monotonic()
+        profile.enable()
+
+        try:
+            yield
+        finally:
+            profile.disable()
+            self.write(name, count, profile, tracemalloc.take_snapshot(),
+                       time.monotonic() - start,
+                       tracemalloc.get_traced_memory()[1])
+            if not tracing:
+                tracemalloc.stop()
+            self.active = None
+
+    # section function ends here.
+    # ---------------------------
+
+    def write(self, name, count, profile, snapshot, elapsed, peak):
+        '''
+        Function which writes the statistics of a profiled run and logs
+        their top entries.
+        '''
+
+        # Local variables
+        path = os.path.join(self.directory, name + '-' + str(count) + '-'
+                            + time.strftime('%Y%m%d%H%M%S'))
+        stream = io.StringIO()
+
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            profile.dump_stats(path + '.pstats')
+            snapshot.dump(path + '.tracemalloc')
+        except (IOError, OSError) as error:
+            logger.error('Unable to write profile ' + str(path) + ': '
+                         + str(error))
+            path = None
+
+        pstats.Stats(profile, stream=stream).sort_stats(
+            'cumulative').print_stats(self.top)
+
+        logger.info('Profile of %s run %d: %.3f seconds, peak memory %d '
+                    'KiB, written to %s\n%s\nTop memory allocations:\n%s',
+                    name, count, elapsed, peak // 1024, path,
+                    stream.getvalue().strip(),
+                    '\n'.join(str(statistic) for statistic in
+                              snapshot.statistics('lineno')[:self.top]))
+
+    # write function ends here.
+    # -------------------------
+
+
+# Profiler class definition ends here.
+# ------------------------------------
+
+
+class IncludeTrie(object):
+    '''
+    Class which compiles include directories into a tree of path components.
+    Each node is a list holding its children dictionary and the depth of the
+    shortest include directory found under it, so a directory is classified
+    walking the tree once, in O(path depth), instead of comparing it against
+    every include directory.
+    '''
+
+    def __init__(self, include_directories):
+
+        # Local variables
+        node = None
+        components = []
+
+        self.root = [{}, None]
+
+        for include_directory in include_directories:
+
+            components = pathToList(include_directory)
+
+            # An include directory without components never matches anything.
+            if not components:
+                continue
+
+            node = self.root
+
+            for component in components:
+                if node[1] is None or len(components) < node[1]:
+                    node[1] = len(components)
+                node = node[0].setdefault(component, [{}, None])
+
+            if node[1] is None or len(components) < node[1]:
+                node[1] = len(components)
+
+    # __init__ function ends here.
+    # ----------------------------
+
+    def match(self, components):
+        '''
+        Function which returns the number of leading components shared with
+        the closest include directories and the deepest node reached.
+        '''
+
+        # Local variables
+        node = self.root
+        matched = 0
+        child = None
+
+        for component in components:
+            child = node[0].get(component)
+            if child is None:
+                break
+            node = child
+            matched += 1
+
+        return matched, node
+
+    # match function ends here.
+    # -------------------------
+
+    def classify(self, components):
+        '''
+        Function which returns how many leading components of a directory
+        must be excluded, or None if the directory should not be excluded,
+        together with whether its subdirectories may need to be excluded.
+        Only directories lying on an include directory path, with deeper
+        include directories under them, have to be looked into.
+        '''
+
+        # Local variables
+        matched = 0
+        node = None
+        length = len(components)
+
+        matched, node = self.match(components)
+
+        # No include directory shares any component.
+        if matched == 0:
+            return length, False
+
+        # The shortest include directory among the closest ones is shorter than
+        # the directory, so exclude the first non matching component.
+        if node[1] < length:
+            if matched < node[1]:
+                return matched + 1, False
+
+        # Otherwise exclude the directory unless it is fully matched.
+        elif matched < length:
+            return length, False
+
+        return None, matched == length and len(node[0]) > 0
+
+    # classify function ends here.
+    # ----------------------------
+
+    def excludeLength(self, components):
+        '''
+        Function which returns how many leading components of a directory
+        must be excluded, or None if the directory should not be excluded.
+        '''
+
+        return self.classify(components)[0]
+
+    # excludeLength function ends here.
+    # ---------------------------------
+
+    def excludePath(self, path):
+        '''
+        Function which returns the directory path to be excluded because of
+        the given directory, or None if nothing should be excluded.
+        '''
+
+        # Local variables
+        components = pathToList(path)
+        length = self.excludeLength(components)
+
+        if length is None:
+            return None
+
+        return os.sep + os.sep.join(components[:length])
+
+    # excludePath function ends here.
+    # -------------------------------
+
+
+# IncludeTrie class definition ends here.
+# ---------------------------------------
+
+
+class PathTable(object):
+    '''
+    Class which keeps a list of directory paths compactly. Each distinct
+    path component is stored once, and each directory as the index of its
+    parent directory plus the id of its last component, in arrays of machine
+    integers, instead of as a string of its own. Directories without a
+    parent in the table store their whole path as a single component. A
+    parent is always added before its subdirectories, so directories are
+    classified in a single pass, subdirectories of an excluded directory
+    taking its result, and only the directories to exclude are turned into
+    path strings.
+    '''
+
+    def __init__(self, paths=()):
+
+        self.names = []
+        self.ids = {}
+        self.parents = array.array('l')
+        self.components = array.array('l')
+        self.tops = {}
+
+        for path in paths:
+            self.addPath(path)
+
+    # __init__ function ends here.
+    # ----------------------------
+
+    def __len__(self):
+
+        return len(self.parents)
+
+    # __len__ function ends here.
+    # ---------------------------
+
+    def __iter__(self):
+
+        for index in range(len(self.parents)):
+            yield self.path(index)
+
+    # __iter__ function ends here.
+    # ----------------------------
+
+    def add(self, parent, name):
+        '''
+        Function which adds the directory with the given name under the
+        directory with the given index, or as a directory without parent if
+        the index is negative. It returns the index of the new directory.
+        '''
+
+        # Local variables
+        component = self.ids.get(name)
+
+        if component is None:
+            component = len(self.names)
+            self.names.append(name)
+            self.ids[name] = component
+
+        self.parents.append(parent)
+        self.components.append(component)
+
+        return len(self.parents) - 1
+
+    # add function ends here.
+    # -----------------------
+
+    def addPath(self, path):
+        '''
+        Function which adds the given directory path without parent and
+        returns its index.
+        '''
+
+        return self.add(-1, os.path.normpath(path))
+
+    # addPath function ends here.
+    # ---------------------------
+
+    def componentList(self, index):
+        '''
+        Function which returns the path components of the directory with the
+        given index, as pathToList does.
+        '''
+
+        # Local variables
+        components = []
+        component = 0
+
+        while self.parents[index] >= 0:
+            components.append(self.names[self.components[index]])
+            index = self.parents[index]
+
+        component = self.components[index]
+
+        if component not in self.tops:
+            self.tops[component] = pathToList(self.names[component])
+
+        components.extend(reversed(self.tops[component]))
+        components.reverse()
+
+        return components
+
+    # componentList function ends here.
+    # ---------------------------------
+
+    def path(self, index):
+        '''
+        Function which returns the path of the directory with the given
+        index.
+        '''
+
+        # Local variables
+        components = []
+
+        while index >= 0:
+            components.append(self.names[self.components[index]])
+            index = self.parents[index]
+
+        return os.path.join(*reversed(components))
+
+    # path function ends here.
+    # ------------------------
+
+    def excludePaths(self, trie):
+        '''
+        Function which returns the sorted directory paths to be excluded
+        because of the directories of the table, according to the given
+        include trie.
+        '''
+
+        # Local variables
+        excluded_by = array.array('l', [-1]) * len(self.parents)
+        excluded = set()
+        exclude_paths = set()
+        components = []
+        length = None
+        ancestor = 0
+        parent = 0
+
+        for index in range(len(self.parents)):
+
+            # Subdirectories of an excluded directory are excluded by the
+            # same directory.
+            parent = self.parents[index]
+            if parent >= 0 and excluded_by[parent] >= 0:
+                excluded_by[index] = excluded_by[parent]
+                continue
+
+            components = self.componentList(index)
+            length = trie.excludeLength(components)
+
+            if length is None:
+                continue
+
+            ancestor = index
+            for position in range(len(components) - length):
+                if self.parents[ancestor] < 0:
+                    break
+                ancestor = self.parents[ancestor]
+            else:
+                excluded_by[index] = ancestor
+                excluded.add(ancestor)
+                continue
+
+            # The directory to exclude lies above the directories of the
+            # table.
+            exclude_paths.add(os.sep + os.sep.join(components[:length]))
+
+        exclude_paths.update(self.path(index) for index in excluded)
+
+        return sorted(exclude_paths)
+
+    # excludePaths function ends here.
+    # --------------------------------
+
+
+# PathTable class definition ends here.
+# -------------------------------------
+
+
+class DropboxCommandError(Exception):
+    '''
+    Exception raised when the dropbox daemon rejects a command.
+    '''
+
+
+# DropboxCommandError class definition ends here.
+# -----------------------------------------------
+
+
+class DropboxClient(object):
+    '''
+    Class which talks to the dropbox daemon command socket, as the dropbox-cli
+    script does, but keeping a single connection open. Each command is a
+    name line, one line per argument with its tab separated values and a
+    done line. The daemon answers ok or notok, followed by the returned
+    values in the same format and a done line. The connection is opened
+    again whenever it fails.
+    '''
+
+    kinds = {'get_ignore_set': 'list',
+             'ignore_set_add': 'add',
+             'ignore_set_remove': 'remove'}
+
+    def __init__(self, path, timeout):
+
+        self.path = os.path.expanduser(path)
+        self.timeout = timeout
+        self.socket = None
+        self.file = None
+        self.lock = threading.Lock()
+
+    # __init__ function ends here.
+    # ----------------------------
+
+    def connect(self):
+        '''
+        Function which opens the connection to the command socket.
+        '''
+
+        logger.debug('Connect to dropbox command socket: ' + str(self.path))
+
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.settimeout(self.timeout)
+        try:
+            self.socket.connect(self.path)
+        except OSError:
+            self.close()
+            raise
+        self.file = self.socket.makefile('rwb')
+
+    # connect function ends here.
+    # ---------------------------
+
+    def close(self):
+        '''
+        Function which closes the connection to the command socket.
+        '''
+
+        for resource in (self.file, self.socket):
+            if resource is not None:
+                try:
+                    resource.close()
+                except OSError:
+                    pass
+
+        self.file = None
+        self.socket = None
+
+    # close function ends here.
+    # -------------------------
+
+    def readLine(self):
+        '''
+        Function which reads a line of the answer.
+        '''
+
+        # Local variables
+        line = self.file.readline()
+
+        if not line:
+            raise OSError('Dropbox command socket closed')
+
+        return line.decode('utf-8').rstrip('\n')
+
+    # readLine function ends here.
+    # ----------------------------
+
+    def exchange(self, name, arguments):
+        '''
+        Function which sends a command over the open connection and returns
+        the values of the answer as a dictionary of lists.
+        '''
+
+        # Local variables
+        lines = [name]
+        values = {}
+        line = ''
+
+        for key, value in arguments.items():
+            lines.append('\t'.join([key] + list(value)))
+        lines.append('done')
+
+        self.file.write(('\n'.join(lines) + '\n').encode('utf-8'))
+        self.file.flush()
+
+        line = self.readLine()
+
+        if line == 'ok':
+            for line in iter(self.readLine, 'done'):
+                line = line.split('\t')
+                values[line[0]] = line[1:]
+            return values
+
+        raise DropboxCommandError('\n'.join(iter(self.readLine, 'done')))
+
+    # exchange function ends here.
+    # ----------------------------
+
+    def command(self, name, **arguments):
+        '''
+        Function which sends a command to the dropbox daemon, connecting
+        first if needed and connecting again once if the connection was
+        lost.
+        '''
+
+        # Local variables
+        kind = self.kinds.get(name, 'other')
+        status = 'error'
+        values = {}
+        start = time.monotonic()
+
+        try:
+            with self.lock:
+                for attempt in range(2):
+                    try:
+                        if self.file is None:
+                            self.connect()
+                        values = self.exchange(name, arguments)
+                        status = '0'
+                        return values
+                    except DropboxCommandError:
+                        status = 'notok'
+                        raise
+                    except (OSError, ValueError) as error:
+                        self.close()
+                        if attempt:
+                            raise OSError(str(error))
+                        logger.debug('Dropbox command socket failed, '
+                                     'connect again: ' + str(error))
+        finally:
+            observeMetric('dropbox_include_command_duration_seconds',
+                          time.monotonic() - start,
+                          command=kind, method='socket')
+            countMetric('dropbox_include_commands_total',
+                        command=kind, method='socket', status=status)
+
+    # command function ends here.
+    # ---------------------------
+
+    def getIgnoreSet(self):
+        '''
+        Function which returns the absolute paths of the excluded
+        directories.
+        '''
+
+        return self.command('get_ignore_set').get('ignore_set', [])
+
+    # getIgnoreSet function ends here.
+    # --------------------------------
+
+    def ignoreSetAdd(self, directory_list):
+        '''
+        Function which adds the given absolute paths to the excluded
+        directories.
+        '''
+
+        self.command('ignore_set_add', paths=directory_list)
+
+    # ignoreSetAdd function ends here.
+    # --------------------------------
+
+    def ignoreSetRemove(self, directory_list):
+        '''
+        Function which removes the given absolute paths from the excluded
+        directories.
+        '''
+
+        self.command('ignore_set_remove', paths=directory_list)
+
+    # ignoreSetRemove function ends here.
+    # -----------------------------------
+
+    def relativePath(self, directory, path):
+        '''
+        Function which converts an excluded directory into the format
+        dropbox_exclude_list_command prints it: lower case and relative to
+        the given dropbox path.
+        '''
+
+        # Local variables
+        root = os.path.expanduser(path).rstrip(os.sep) + os.sep
+
+        if directory.lower().startswith(root.lower()):
+            return directory[len(root):].lower()
+
+        return os.path.relpath(directory, root).lower()
+
+    # relativePath function ends here.
+    # --------------------------------
+
+
+# DropboxClient class definition ends here.
+# -----------------------------------------
+
+
+class CommandLimiter(object):
+    '''
+    Class which limits the number of dropbox commands running at once. The
+    limit starts at the given maximum, is halved whenever a command times
+    out or takes longer than the given latency target, as the dropbox daemon
+    is then busy, and grows by one again after as many fast commands as the
+    limit. Commands which were already running when the limit was halved do
+    not halve it again. A latency target of 0 keeps the limit at the
+    maximum. Commands run with command_priority set may run one above the
+    limit, and no other command starts while any of them waits.
+    '''
+
+    def __init__(self, maximum, target):
+
+        self.maximum = max(1, int(maximum))
+        self.target = float(target)
+        self.limit = self.maximum
+        self.running = 0
+        self.waiting = 0
+        self.fast = 0
+        self.decreased = 0.0
+        self.loop = asyncio.get_running_loop()
+        self.condition = asyncio.Condition()
+
+    # __init__ function ends here.
+    # ----------------------------
+
+    async def __aenter__(self):
+
+        # Local variables
+        priority = command_priority.get()
+
+        async with self.condition:
+            if priority:
+                self.waiting += 1
+                try:
+                    await self.condition.wait_for(
+                        lambda: self.running <= self.limit)
+                finally:
+                    self.waiting -= 1
+                    self.condition.notify_all()
+            else:
+                await self.condition.wait_for(
+                    lambda: self.running < self.limit and not self.waiting)
+            self.running += 1
+
+    # __aenter__ function ends here.
+    # ------------------------------
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+
+        async with self.condition:
+            self.running -= 1
+            self.condition.notify_all()
+
+    # __aexit__ function ends here.
+    # -----------------------------
+
+    def observe(self, latency, completed):
+        '''
+        Function which adapts the limit to the latency of a command and to
+        whether it completed before timing out.
+        '''
+
+        # Local variables
+        now = time.monotonic()
+
+        if not completed or (self.target > 0 and latency > self.target):
+            self.fast = 0
+            if self.limit > 1 and now - latency >= self.decreased:
+                self.decreased = now
+                self.limit = max(1, self.limit // 2)
+                logger.info('Dropbox commands are slow, run up to %d at '
+                            'once', self.limit)
+
+        elif self.limit < self.maximum:
+            self.fast += 1
+            if self.fast >= self.limit:
+                self.fast = 0
+                self.limit += 1
+                logger.debug('Run up to %d dropbox commands at once',
+                             self.limit)
+
+    # observe function ends here.
+    # ---------------------------
+
+
+# CommandLimiter class definition ends here.
+# ------------------------------------------
+
+
+class EventBatcher(object):
+    '''
+    Class which collects new directories and hands them over in batches, so
+    that a single exclude and unexclude sequence is run for all directories
+    created within a time window. A batch is handed over once the window
+    since its first directory has elapsed or once it reaches the size limit.
+    Directories whose ancestor is already queued are dropped, as evaluating
+    the ancestor covers them. Batches go through two stages: the planner
+    evaluates a batch while the executor runs the commands of the previous
+    one. While a batch waits for the planner, new directories stay queued,
+    so that the slower the commands are, the fewer and larger the batches.
+    The batcher is full once the given limit of queued directories, if any,
+    is reached. Directories of batches which failed, or which the executor
+    returns as failed, are queued again after a growing delay. Urgent
+    directories skip the window and the queued batches: they are evaluated
+    and applied right away by a task of their own, which runs its dropbox
+    commands ahead of the other ones once the batch being applied, if any,
+    is done.
+    '''
+
+    def __init__(self, planner, executor, window, size, limit=0):
+
+        self.planner = planner
+        self.executor = executor
+        self.window = float(window)
+        self.size = max(1, int(size))
+        self.limit = max(0, int(limit))
+        self.queue = {}
+        self.urgent = {}
+        self.expediting = None
+        self.timer = None
+        self.deferred = False
+        self.attempts = {}
+        self.retrying = {}
+        self.batches = asyncio.Queue()
+        self.plans = asyncio.Queue(maxsize=1)
+        self.tasks = []
+
+    # __init__ function ends here.
+    # ----------------------------
+
+    def start(self):
+        '''
+        Function which starts the planner and executor tasks.
+        '''
+
+        self.tasks = [asyncio.ensure_future(self.plan()),
+                      asyncio.ensure_future(self.execute())]
+
+    # start function ends here.
+    # -------------------------
+
+    async def stop(self):
+        '''
+        Function which stops the planner and executor tasks. Directories
+        still queued are discarded.
+        '''
+
+        # Local variables
+        pending = self.backlog()
+
+        if self.timer is not None:
+            self.timer.cancel()
+
+        for timer, batch in self.retrying.values():
+            timer.cancel()
+
+        if pending:
+            logger.warning('Discarding ' + str(pending)
+                           + ' queued directories and batches')
+
+        if self.expediting is not None:
+            self.tasks.append(self.expediting)
+
+        for task in self.tasks:
+            task.cancel()
+
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    # stop function ends here.
+    # ------------------------
+
+    def backlog(self):
+        '''
+        Function which returns the number of queued directories plus the
+        number of batches waiting to be evaluated, applied or retried.
+        '''
+
+        return len(self.queue) + len(self.urgent) + self.batches.qsize() \
+            + self.plans.qsize() + len(self.retrying)
+
+    # backlog function ends here.
+    # ---------------------------
+
+    def isFull(self):
+        '''
+        Function which returns whether the limit of queued directories is
+        reached.
+        '''
+
+        return self.limit > 0 and len(self.queue) >= self.limit
+
+    # isFull function ends here.
+    # --------------------------
+
+    def isQueued(self, path):
+        '''
+        Function which returns whether the given path or any of its ancestors
+        is already queued.
+        '''
+
+        # Local variables
+        parent = os.path.dirname(path)
+
+        while True:
+            if path in self.queue or path in self.urgent:
+                return True
+            if parent == path:
+                return False
+            path = parent
+            parent = os.path.dirname(path)
+
+    # isQueued function ends here.
+    # ----------------------------
+
+    def add(self, path, urgent=False):
+        '''
+        Function which queues a new directory, keeping the time it was
+        queued at. Urgent directories are evaluated right away.
+        '''
+
+        if self.isQueued(path):
+            logger.debug('Directory already queued: %s', path)
+            countMetric('dropbox_include_events_merged_total')
+            return
+
+        if urgent:
+            logger.debug('Directory evaluated right away: %s', path)
+            countMetric('dropbox_include_events_expedited_total')
+            self.urgent[path] = time.monotonic()
+            if self.expediting is None or self.expediting.done():
+                self.expediting = asyncio.ensure_future(self.expedite())
+            return
+
+        self.queue[path] = time.monotonic()
+
+        if len(self.queue) >= self.size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(
+                self.window, self.flush)
+
+    # add function ends here.
+    # -----------------------
+
+    def discard(self, path):
+        '''
+        Function which drops the given directory and its subdirectories from
+        the queue, as they are not there anymore.
+        '''
+
+        # Local variables
+        prefix = path + os.sep
+
+        for pending in (self.queue, self.urgent):
+            for queued in [queued for queued in pending
+                           if queued == path or queued.startswith(prefix)]:
+                logger.debug('Directory not queued anymore: %s', queued)
+                del pending[queued]
+
+    # discard function ends here.
+    # ---------------------------
+
+    def flush(self):
+        '''
+        Function which hands over up to size queued directories as a batch,
+        unless the previous batch still waits for the planner, which then
+        hands over the next batch as soon as it takes the previous one.
+        '''
+
+        # Local variables
+        batch = {}
+
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        if not self.queue:
+            return
+
+        if not self.batches.empty():
+            self.deferred = True
+            return
+
+        batch = dict(itertools.islice(self.queue.items(), self.size))
+
+        for path in batch:
+            del self.queue[path]
+
+        logger.debug('Hand over a batch of %d directories', len(batch))
+
+        self.batches.put_nowait(batch)
+        self.deferred = bool(self.queue)
+
+    # flush function ends here.
+    # -------------------------
+
+    def retry(self, batch):
+        '''
+        Function which queues the directories of a failed batch again after
+        a delay which grows with each failure, up to
+        exclude_list_refresh_interval seconds.
+        '''
+
+        # Global variables
+        global exclude_list_refresh_interval
+
+        # Local variables
+        attempt = 1 + max(self.attempts.pop(path, 0) for path in batch)
+        delay = retryDelay(attempt, exclude_list_refresh_interval)
+
+        logger.warning('Retry %d directories in %.1f seconds', len(batch),
+                       delay)
+        countMetric('dropbox_include_events_retried_total', len(batch))
+
+        self.retrying[id(batch)] = (
+            asyncio.get_running_loop().call_later(delay, self.requeue,
+                                                  batch, attempt),
+            batch)
+
+    # retry function ends here.
+    # -------------------------
+
+    def requeue(self, batch, attempt):
+        '''
+        Function which queues the directories of a failed batch again,
+        keeping the time they were first queued at.
+        '''
+
+        self.retrying.pop(id(batch), None)
+
+        for path, queued in batch.items():
+            if self.isQueued(path):
+                continue
+            self.queue[path] = queued
+            self.attempts[path] = attempt
+
+        self.flush()
+
+    # requeue function ends here.
+    # ---------------------------
+
+    async def plan(self):
+        '''
+        Function which evaluates each batch.
+        '''
+
+        # Local variables
+        batch = {}
+
+        while True:
+            batch = await self.batches.get()
+
+            if self.deferred:
+                self.flush()
+
+            try:
+                await self.plans.put((batch,
+                                      await self.planner(sorted(batch))))
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Unable to evaluate a batch of directories')
+                countMetric('dropbox_include_events_failed_total',
+                            len(batch))
+                self.retry(batch)
+
+    # plan function ends here.
+    # ------------------------
+
+    def complete(self, batch, failed):
+        '''
+        Function which accounts for an applied batch, queueing again the
+        directories the executor returned as failed.
+        '''
+
+        # Local variables
+        now = time.monotonic()
+
+        if failed:
+            countMetric('dropbox_include_events_failed_total', len(failed))
+            self.retry(dict.fromkeys(failed, min(batch.values())))
+
+        for path in batch:
+            self.attempts.pop(path, None)
+
+        countMetric('dropbox_include_events_processed_total', len(batch))
+        for queued in batch.values():
+            observeMetric('dropbox_include_event_latency_seconds',
+                          now - queued)
+
+    # complete function ends here.
+    # ----------------------------
+
+    async def execute(self):
+        '''
+        Function which runs the commands of each evaluated batch.
+        '''
+
+        # Local variables
+        batch = {}
+        plan = None
+
+        while True:
+            batch, plan = await self.plans.get()
+            try:
+                self.complete(batch, await self.executor(plan))
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Unable to exclude a batch of directories')
+                countMetric('dropbox_include_events_failed_total',
+                            len(batch))
+                self.retry(batch)
+
+    # execute function ends here.
+    # ---------------------------
+
+    async def expedite(self):
+        '''
+        Function which evaluates and applies the urgent directories, while
+        the queued batches go on through the planner and the executor.
+        Directories which turn urgent meanwhile make up the next batch.
+        '''
+
+        # Local variables
+        batch = {}
+
+        command_priority.set(True)
+
+        while self.urgent:
+            batch, self.urgent = self.urgent, {}
+            try:
+                self.complete(batch, await self.executor(
+                    await self.planner(sorted(batch))))
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Unable to exclude a batch of directories '
+                                 'right away')
+                countMetric('dropbox_include_events_failed_total',
+                            len(batch))
+                self.retry(batch)
+
+    # expedite function ends here.
+    # ----------------------------
+
+
+# EventBatcher class definition ends here.
+# ----------------------------------------
+
+
+class DirectoryTable(object):
+    '''
+    Class which keeps the subdirectories of each scanned directory together
+    with the inode and modification time the directory had when it was
+    scanned, so that directories which did not change are not scanned again.
+    Directories modified less than two seconds before being scanned are
+    always scanned again, as a later change could leave the same
+    modification time.
+    '''
+
+    def __init__(self, entries):
+
+        self.entries = {}
+        self.visited = set()
+        self.scanned = 0
+        self.reused = 0
+        self.lock = threading.Lock()
+
+        for path, inode, mtime, names in entries:
+            self.entries[path] = (inode, mtime, names)
+
+    # __init__ function ends here.
+    # ----------------------------
+
+    def scan(self, path):
+        '''
+        Function which returns the subdirectories of the given directory,
+        scanning it only if it changed.
+        '''
+
+        # Local variables
+        stat = None
+        entry = None
+        mtime = None
+        subdirectories = []
+
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return scanDirectory(path)
+
+        with self.lock:
+            self.visited.add(path)
+            entry = self.entries.get(path)
+            if entry is not None and entry[0] == stat.st_ino \
+               and entry[1] == stat.st_mtime_ns:
+                self.reused += 1
+                return [os.path.join(path, name) for name in entry[2]]
+
+        subdirectories = scanDirectory(path)
+
+        if stat.st_mtime_ns < time.time_ns() - 2000000000:
+            mtime = stat.st_mtime_ns
+
+        with self.lock:
+            self.entries[path] = (
+                stat.st_ino, mtime,
+                [os.path.basename(subdirectory)
+                 for subdirectory in subdirectories])
+            self.scanned += 1
+
+        return subdirectories
+
+    # scan function ends here.
+    # ------------------------
+
+    def dump(self):
+        '''
+        Function which returns the directories visited by the last scans
+        which may be trusted by a later run.
+        '''
+
+        with self.lock:
+            return [[path] + list(self.entries[path])
+                    for path in sorted(self.visited)
+                    if path in self.entries
+                    and self.entries[path][1] is not None]
+
+    # dump function ends here.
+    # ------------------------
+
+    def count(self):
+        '''
+        Function which returns the number of scanned directories.
+        '''
+
+        with self.lock:
+            return len(self.entries)
+
+    # count function ends here.
+    # -------------------------
+
+    def inode(self, path):
+        '''
+        Function which returns the inode the given directory had when it was
+        last scanned, or None if it was never scanned.
+        '''
+
+        # Local variables
+        entry = None
+
+        with self.lock:
+            entry = self.entries.get(path)
+
+        return entry[0] if entry is not None else None
+
+    # inode function ends here.
+    # -------------------------
+
+    def names(self, path):
+        '''
+        Function which returns the subdirectory names the given directory
+        had when it was last scanned, or None if it was never scanned.
+        '''
+
+        # Local variables
+        entry = None
+
+        with self.lock:
+            entry = self.entries.get(path)
+
+        return set(entry[2]) if entry is not None else None
+
+    # names function ends here.
+    # -------------------------
+
+    def detach(self, path):
+        '''
+        Function which removes the entries of the given directory and of its
+        known subdirectories, following the subdirectory names of each
+        entry, and returns them keyed by their path relative to the given
+        directory.
+        '''
+
+        # Local variables
+        detached = {}
+        pending = [os.curdir]
+        relative = ''
+        entry = None
+
+        with self.lock:
+            while pending:
+                relative = pending.pop()
+                entry = self.entries.pop(
+                    os.path.normpath(os.path.join(path, relative)), None)
+                if entry is None:
+                    continue
+                detached[relative] = entry
+                pending.extend(os.path.join(relative, name)
+                               for name in entry[2])
+
+        return detached
+
+    # detach function ends here.
+    # --------------------------
+
+    def attach(self, path, detached):
+        '''
+        Function which places entries returned by detach under the given
+        directory, so that a moved directory is not scanned again unless it
+        changed.
+        '''
+
+        # Local variables
+        relative = ''
+        entry = None
+
+        with self.lock:
+            for relative, entry in detached.items():
+                self.entries[os.path.normpath(
+                    os.path.join(path, relative))] = entry
+
+    # attach function ends here.
+    # --------------------------
+
+
+# DirectoryTable class definition ends here.
+# ------------------------------------------
+
+
+class ExcludeState(object):
+    '''
+    Class which keeps an in memory copy of the dropbox exclude list, in the
+    same format dropbox_exclude_list_command prints it: lower case paths
+    relative to dropbox_path. It is seeded once and then updated with the
+    directories added and removed by this program, so that the exclude list
+    command is not run on every event. A background task checks it against
+    the real dropbox exclude list, read by the given coroutine function,
+    every given number of seconds. The ancestors of the excluded directories
+    are counted, so that excluding a directory only looks for entries of its
+    subdirectories when there are any.
+    '''
+
+    def __init__(self, path, reader):
+
+        self.path = os.path.expanduser(path)
+        self.reader = reader
+        self.excluded = set()
+        self.ancestors = collections.Counter()
+        self.generation = 0
+        self.condition = threading.RLock()
+
+    # __init__ function ends here.
+    # ----------------------------
+
+    def relativePath(self, directory):
+        '''
+        Function which converts an absolute directory path into an exclude
+        list entry.
+        '''
+
+        if os.path.isabs(directory):
+            directory = os.path.relpath(directory, self.path)
+
+        return directory.lower()
+
+    # relativePath function ends here.
+    # --------------------------------
+
+    def isExcluded(self, directory, ignored=()):
+        '''
+        Function which returns whether the given directory or any of its
+        ancestors is excluded, leaving out the given entries, which are
+        about to be unexcluded.
+        '''
+
+        # Local variables
+        entry = self.relativePath(directory)
+
+        with self.condition:
+            while entry:
+                if entry in self.excluded and entry not in ignored:
+                    return True
+                entry = os.path.dirname(entry)
+
+        return False
+
+    # isExcluded function ends here.
+    # ------------------------------
+
+    def count(self):
+        '''
+        Function which returns the number of excluded directories.
+        '''
+
+        with self.condition:
+            return len(self.excluded)
+
+    # count function ends here.
+    # -------------------------
+
+    def list(self):
+        '''
+        Function which returns the sorted list of excluded directories.
+        '''
+
+        with self.condition:
+            return sorted(self.excluded)
+
+    # list function ends here.
+    # ------------------------
+
+    def countAncestors(self, entry, step):
+        '''
+        Function which adds the given step to the count of each ancestor of
+        the given entry.
+        '''
+
+        entry = os.path.dirname(entry)
+
+        while entry:
+            self.ancestors[entry] += step
+            if self.ancestors[entry] <= 0:
+                del self.ancestors[entry]
+            entry = os.path.dirname(entry)
+
+    # countAncestors function ends here.
+    # ----------------------------------
+
+    def replace(self, directories):
+        '''
+        Function which replaces the exclude list with the given one.
+        '''
+
+        with self.condition:
+            self.excluded = set(directories)
+            self.ancestors = collections.Counter()
+            for entry in self.excluded:
+                self.countAncestors(entry, 1)
+            self.generation += 1
+
+    # replace function ends here.
+    # ---------------------------
+
+    def add(self, directories):
+        '''
+        Function which records directories added to the exclude list.
+        Excluding a directory replaces the entries of its subdirectories,
+        which are looked for once for all the given directories.
+        '''
+
+        # Local variables
+        entries = sorted(set(self.relativePath(directory)
+                             for directory in directories))
+        entry = ''
+        parent = ''
+        covering = set()
+        covered = []
+
+        with self.condition:
+
+            # Ancestors sort before their subdirectories, so a directory
+            # covered by another given one is found already excluded.
+            for entry in entries:
+                if self.isExcluded(entry):
+                    continue
+                if entry in self.ancestors:
+                    covering.add(entry)
+                self.excluded.add(entry)
+                self.countAncestors(entry, 1)
+
+            if covering:
+                for entry in self.excluded:
+                    parent = os.path.dirname(entry)
+                    while parent:
+                        if parent in covering:
+                            covered.append(entry)
+                            break
+                        parent = os.path.dirname(parent)
+
+                for entry in covered:
+                    self.excluded.discard(entry)
+                    self.countAncestors(entry, -1)
+
+            self.generation += 1
+
+    # add function ends here.
+    # -----------------------
+
+    def remove(self, directories):
+        '''
+        Function which records directories removed from the exclude list.
+        '''
+
+        # Local variables
+        entry = ''
+
+        with self.condition:
+            for directory in directories:
+                entry = self.relativePath(directory)
+                if entry in self.excluded:
+                    self.excluded.discard(entry)
+                    self.countAncestors(entry, -1)
+            self.generation += 1
+
+    # remove function ends here.
+    # --------------------------
+
+    async def refresh(self):
+        '''
+        Function which checks the in memory exclude list against the dropbox
+        exclude list. If the in memory list changed while the dropbox list
+        was read, the read is discarded and checked again later. It returns
+        whether the in memory list was out of date.
+        '''
+
+        # Local variables
+        generation = 0
+        dropbox_exclude_list = []
+        missing = set()
+        unknown = set()
+
+        with self.condition:
+            generation = self.generation
+
+        dropbox_exclude_list = await self.reader()
+
+        if dropbox_exclude_list is None:
+            return False
+
+        with self.condition:
+            if not generation == self.generation:
+                logger.debug('Exclude list changed while being checked')
+                return False
+
+            missing = self.excluded.difference(dropbox_exclude_list)
+            unknown = set(dropbox_exclude_list).difference(self.excluded)
+
+            if missing or unknown:
+                logger.info('Exclude list out of date. Not excluded: %s '
+                            'Excluded: %s', LogSummary(missing),
+                            LogSummary(unknown))
+                self.replace(dropbox_exclude_list)
+                return True
+
+        return False
+
+    # refresh function ends here.
+    # ---------------------------
+
+    async def run(self, interval):
+        '''
+        Function which checks the exclude list every interval seconds.
+        '''
+
+        while True:
+            await asyncio.sleep(float(interval))
+
+            try:
+                await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Unable to check the exclude list')
+
+    # run function ends here.
+    # -----------------------
+
+
+# ExcludeState class definition ends here.
+# ----------------------------------------
+
+
+class OperationJournal(object):
+    '''
+    Class which keeps an append only journal of the exclude list operations
+    of a dropbox root since its state was last saved, one JSON record per
+    line. An operation is written as planned before its dropbox command runs
+    and as done, together with the directories it succeeded for, after it
+    finished. Records are synced to disk once per record however many
+    directories it holds: a planned record before its command runs, so
+    that an operation is never lost, and a done record right after, so
+    that a finished operation is not run again after a crash. Records are
+    counted, so that a sync running in an executor thread does not take a
+    record written meanwhile as synced.
+    '''
+
+    def __init__(self, path, limit=1048576):
+
+        self.path = os.path.expanduser(path)
+        self.limit = limit
+        self.file = None
+        self.next = 1
+        self.pending = {}
+        self.written = 0
+        self.synced = 0
+
+    # __init__ function ends here.
+    # ----------------------------
+
+    def write(self, record):
+        '''
+        Function which appends the given record to the journal. A journal
+        which can not be written does not stop the operation.
+        '''
+
+        try:
+            if self.file is None:
+                if not os.path.isdir(os.path.dirname(self.path)):
+                    os.makedirs(os.path.dirname(self.path))
+                self.file = open(self.path, 'a')
+            self.file.write(json.dumps(record, separators=(',', ':'))
+                            + '\n')
+            self.file.flush()
+            self.written += 1
+        except (IOError, OSError) as error:
+            logger.error('Unable to write journal ' + str(self.path) + ': '
+                         + str(error))
+
+    # write function ends here.
+    # -------------------------
+
+    def sync(self):
+        '''
+        Function which syncs the records written since the last sync to
+        disk.
+        '''
+
+        # Local variables
+        written = self.written
+
+        if written == self.synced or self.file is None:
+            return
+
+        try:
+            os.fsync(self.file.fileno())
+            self.synced = max(self.synced, written)
+        except (IOError, OSError) as error:
+            logger.error('Unable to sync journal ' + str(self.path) + ': '
+                         + str(error))
+
+    # sync function ends here.
+    # ------------------------
+
+    def plan(self, operation, directory_list):
+        '''
+        Function which records that the given operation, add or remove, is
+        about to run on the given directories. It returns the identifier of
+        the operation.
+        '''
+
+        # Local variables
+        identifier = self.next
+
+        self.next += 1
+        self.pending[identifier] = {'id': identifier, 'op': operation,
+                                    'paths': list(directory_list)}
+        self.write(self.pending[identifier])
+
+        return identifier
+
+    # plan function ends here.
+    # ------------------------
+
+    def complete(self, identifier, directory_list):
+        '''
+        Function which records that the given operation finished and the
+        directories it succeeded for.
+        '''
+
+        if self.pending.pop(identifier, None) is None:
+            return
+
+        self.write({'id': identifier, 'done': list(directory_list)})
+
+    # complete function ends here.
+    # ----------------------------
+
+    def load(self):
+        '''
+        Function which reads the journal left by the last run. It returns
+        its operations in order as (operation, directories, done
+        directories) tuples, where the done directories are None for the
+        operations which never finished. A record torn by a crash ends the
+        journal.
+        '''
+
+        # Local variables
+        operations = {}
+        record = {}
+
+        try:
+            with open(self.path, 'r') as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        logger.warning('Journal ends with a torn record: '
+                                       + str(self.path))
+                        break
+                    if 'done' in record:
+                        if record['id'] in operations:
+                            operations[record['id']][2] = record['done']
+                    else:
+                        operations[record['id']] = [
+                            record['op'], record['paths'], None]
+        except FileNotFoundError:
+            return []
+        except (IOError, OSError, KeyError, TypeError) as error:
+            logger.warning('Unable to load journal ' + str(self.path)
+                           + ': ' + str(error))
+            return []
+
+        self.next = max(self.next, max(operations, default=0) + 1)
+
+        return [tuple(operation) for operation in operations.values()]
+
+    # load function ends here.
+    # ------------------------
+
+    def isFull(self):
+        '''
+        Function which returns whether the journal grew over its limit, so
+        that the state should be saved again.
+        '''
+
+        return self.file is not None and self.file.tell() > self.limit
+
+    # isFull function ends here.
+    # --------------------------
+
+    def reset(self):
+        '''
+        Function which empties the journal once the state it applies to was
+        saved. The operations which did not finish yet are written again.
+        The journal is replaced at once, so that it is never read half
+        written.
+        '''
+
+        self.close()
+
+        if not self.pending and not os.path.exists(self.path):
+            return
+
+        try:
+            with open(self.path + '.tmp', 'w') as file:
+                for record in self.pending.values():
+                    file.write(json.dumps(record, separators=(',', ':'))
+                               + '\n')
+                file.flush()
+                os.fsync(file.fileno())
+            os.rename(self.path + '.tmp', self.path)
+        except (IOError, OSError) as error:
+            logger.error('Unable to reset journal ' + str(self.path) + ': '
+                         + str(error))
+
+    # reset function ends here.
+    # -------------------------
+
+    def close(self):
+        '''
+        Function which syncs and closes the journal.
+        '''
+
+        if self.file is None:
+            return
+
+        self.sync()
+
+        try:
+            self.file.close()
+        except (IOError, OSError):
+            pass
+
+        self.file = None
+        self.synced = self.written
+
+    # close function ends here.
+    # -------------------------
+
+
+# OperationJournal class definition ends here.
+# --------------------------------------------
+
+
+class DropboxRoot(object):
+    '''
+    Class which keeps the state of a monitored dropbox path apart from the
+    others: its configuration snapshot, dropbox command socket client, in
+    memory exclude list, scanned directories, watched directories and
+    batcher, together with the lock which applies its exclude list changes
+    one at a time. The root of the main configuration file has no
+    configuration file of its own and follows the global settings. The root
+    also keeps the last time all inotify events were known to be read, which
+    is where a rescan starts from after the event queue overflowed.
+    '''
+
+    def __init__(self, config_file, snapshot):
+
+        self.config_file = config_file
+        self.snapshot = snapshot
+        self.path = os.path.normpath(
+            os.path.expanduser(snapshot.dropbox_path))
+        self.changed = threading.Event()
+        self.client = None
+        self.exclude_state = ExcludeState(self.path, self.readExcludeList)
+        self.directory_table = None
+        self.watch_registry = None
+        self.batcher = None
+        self.reconciling = asyncio.Lock()
+        self.consistent = time.time_ns()
+        self.overflows = 0
+        self.rescan = None
+        self.journal = None
+
+        if snapshot.state_file:
+            self.journal = OperationJournal(snapshot.state_file + '.journal')
+
+        if snapshot.dropbox_command_method == 'socket':
+            logger.info('Use dropbox command socket: '
+                        + str(snapshot.dropbox_command_socket))
+            self.client = DropboxClient(snapshot.dropbox_command_socket,
+                                        float(command_timeout))
+
+    # __init__ function ends here.
+    # ----------------------------
+
+    def loadConfiguration(self):
+        '''
+        Function which returns the configuration snapshot of the root,
+        reloading its configuration files only if they changed, in the same
+        way loadConfiguration does for the main configuration file.
+        '''
+
+        # Local variables
+        signature = ()
+
+        if self.config_file is None:
+            self.snapshot = loadConfiguration()
+            return self.snapshot
+
+        if config_watched_directories and not self.changed.is_set():
+            return self.snapshot
+
+        self.changed.clear()
+
+        signature = configurationSignature(self.snapshot.files)
+
+        if signature == self.snapshot.signature:
+            return self.snapshot
+
+        if configurationDigest(self.snapshot.files) == self.snapshot.digest:
+            logger.debug('Root configuration files touched but not changed')
+            self.snapshot = self.snapshot._replace(signature=signature)
+            return self.snapshot
+
+        logger.info('Load root configuration file: '
+                    + str(self.config_file))
+
+        countMetric('dropbox_include_config_reloads_total')
+
+        self.snapshot = rootConfiguration(self.config_file)
+        watchConfiguration()
+
+        return self.snapshot
+
+    # loadConfiguration function ends here.
+    # -------------------------------------
+
+    async def readExcludeList(self):
+        '''
+        Function which reads the dropbox exclude list of the root.
+        '''
+
+        return await evalDropboxExcludeList(
+            self.snapshot.dropbox_exclude_list_command,
+            self.snapshot.dropbox_path,
+            self.client)
+
+    # readExcludeList function ends here.
+    # -----------------------------------
+
+    def close(self):
+        '''
+        Function which closes the dropbox command socket client and the
+        journal.
+        '''
+
+        if self.client is not None:
+            self.client.close()
+
+        if self.journal is not None:
+            self.journal.close()
+
+    # close function ends here.
+    # -------------------------
+
+
+# DropboxRoot class definition ends here.
+# ---------------------------------------
+
+
+class ConfigEventHandler(pyinotify.ProcessEvent):
+    '''
+    Class which is called by inotify whenever something changes on a
+    directory holding configuration files.
+    '''
+
+    def process_default(self, event):
+        '''
+        Function which invalidates the configuration snapshot if the event
+        concerns one of the configuration files.
+        '''
+
+        # Global variables
+        global config_snapshot
+        global config_changed
+        global dropbox_roots
+
+        if config_snapshot is None or event.pathname in config_snapshot.files:
+            logger.debug('Configuration file changed: '
+                         + str(event.pathname))
+            config_changed.set()
+
+        for root in dropbox_roots:
+            if event.pathname in root.snapshot.files:
+                logger.debug('Root configuration file changed: '
+                             + str(event.pathname))
+                root.changed.set()
+
+    # process_default function ends here.
+    # -----------------------------------
+
+
+# ConfigEventHandler class definition ends here.
+# ----------------------------------------------
+
+
+class OverflowHandler(pyinotify.ProcessEvent):
+    '''
+    Class which is called by inotify for events which do not belong to any
+    watch, such as the overflow of the event queue.
+    '''
+
+    def process_IN_Q_OVERFLOW(self, event):
+        '''
+        Function which is called by inotify whenever the event queue
+        overflowed and events were lost. Every root shares the queue, so
+        every root is rescanned, and configuration files are checked again.
+        '''
+
+        # Global variables
+        global config_changed
+        global dropbox_roots
+
+        logger.warning('Inotify event queue overflowed, rescan changed '
+                       'directories')
+
+        countMetric('dropbox_include_overflows_total')
+
+        config_changed.set()
+
+        for root in dropbox_roots:
+            root.changed.set()
+
+            if root.batcher is None or root.watch_registry is None:
+                continue
+
+            root.overflows += 1
+
+            if root.rescan is None:
+                root.rescan = asyncio.ensure_future(rescanRoot(root))
+
+    # process_IN_Q_OVERFLOW function ends here.
+    # -----------------------------------------
+
+
+# OverflowHandler class definition ends here.
+# -------------------------------------------
+
+
+class WatchRegistry(object):
+    '''
+    Class which keeps inotify watches only on directories where a new
+    subdirectory may have to be excluded: the dropbox root and every
+    directory lying on an include directory path with deeper include
+    directories under it. Excluded directories are never watched, and
+    neither are directories under an include directory with nothing deeper
+    to include, the dropbox cache directory among them, as nothing created
+    inside them is ever excluded. Shallower directories are watched first,
+    so once inotify runs out of watches, the directories left are polled
+    instead: each one is scanned again only when its modification time
+    changed, and polled less and less often, from interval_min up to
+    interval_max seconds, while it does not change. Polled directories are
+    watched again as soon as watches are released. Watches are only added
+    and removed from the event loop thread, which reads the inotify events,
+    as the watch manager is not thread safe, while directories are scanned
+    in executor threads.
+    '''
+
+    def __init__(self, watch_manager, mask, proc_fun, path,
+                 interval_min=2.0, interval_max=60.0):
+
+        self.watch_manager = watch_manager
+        self.mask = mask
+        self.proc_fun = proc_fun
+        self.path = os.path.normpath(os.path.expanduser(path))
+        self.interval_min = float(interval_min)
+        self.interval_max = max(self.interval_min, float(interval_max))
+        self.trie = None
+        self.watches = {}
+        self.polled = {}
+        self.exhausted = False
+        self.lock = threading.RLock()
+
+    # __init__ function ends here.
+    # ----------------------------
+
+    def count(self):
+        '''
+        Function which returns the number of watched directories.
+        '''
+
+        with self.lock:
+            return len(self.watches)
+
+    # count function ends here.
+    # -------------------------
+
+    def countPolled(self):
+        '''
+        Function which returns the number of polled directories.
+        '''
+
+        with self.lock:
+            return len(self.polled)
+
+    # countPolled function ends here.
+    # -------------------------------
+
+    def directories(self):
+        '''
+        Function which returns the sorted list of watched directories.
+        '''
+
+        with self.lock:
+            return sorted(self.watches)
+
+    # directories function ends here.
+    # -------------------------------
+
+    def isWatchable(self, path):
+        '''
+        Function which returns whether the given directory should be watched.
+        '''
+
+        if path == self.path:
+            return True
+
+        if self.trie is None:
+            return False
+
+        return self.trie.classify(pathToList(path)) == (None, True)
+
+    # isWatchable function ends here.
+    # -------------------------------
+
+    def addWatch(self, path):
+        '''
+        Function which adds a watch on the given directory if it is neither
+        watched nor polled yet. Once inotify runs out of watches, the
+        directory is polled instead, while directories which cannot be
+        watched for any other reason are left out. It returns whether a
+        watch was added.
+        '''
+
+        # Local variables
+        wd = -1
+        code = None
+
+        with self.lock:
+            if path in self.watches or path in self.polled:
+                return False
+
+            if not self.exhausted:
+                try:
+                    wd = self.watch_manager.add_watch(
+                        path, self.mask, proc_fun=self.proc_fun, rec=False,
+                        auto_add=False, quiet=False).get(path, -1)
+                except pyinotify.WatchManagerError as error:
+                    # pyinotify loads libc with use_errno, so ctypes keeps
+                    # the errno of the failed inotify_add_watch call.
+                    code = ctypes.get_errno()
+                    if code == errno.ENOENT:
+                        logger.debug('Directory gone before being watched: '
+                                     '%s', path)
+                        return False
+                    if not code == errno.ENOSPC:
+                        logger.error('Unable to watch directory: '
+                                     + str(error))
+                        return False
+
+            if wd >= 0:
+                self.watches[path] = wd
+                return True
+
+            if not self.exhausted:
+                logger.warning('Unable to watch more directories, poll '
+                               'them instead: ' + str(path))
+                self.exhausted = True
+
+            self.addPoll(path)
+
+        return False
+
+    # addWatch function ends here.
+    # ----------------------------
+
+    def addPoll(self, path):
+        '''
+        Function which starts polling the given directory, keeping its
+        modification time and subdirectory names. A modification time less
+        than two seconds old is not kept, as a later change could leave the
+        same one, so the directory is scanned again on the next poll.
+        '''
+
+        # Local variables
+        mtime = None
+        names = set()
+
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return
+
+        names = set(os.path.basename(subdirectory)
+                    for subdirectory in scanDirectory(path))
+
+        if mtime >= time.time_ns() - 2000000000:
+            mtime = None
+
+        with self.lock:
+            self.polled[path] = [mtime, names, self.interval_min,
+                                 time.monotonic() + self.interval_min]
+
+    # addPoll function ends here.
+    # ---------------------------
+
+    def nextPoll(self):
+        '''
+        Function which returns the seconds left until a polled directory is
+        due.
+        '''
+
+        with self.lock:
+            if not self.polled:
+                return self.interval_min
+            return max(0.1, min(entry[3] for entry in self.polled.values())
+                       - time.monotonic())
+
+    # nextPoll function ends here.
+    # ----------------------------
+
+    def promote(self):
+        '''
+        Function which watches the polled directories which are due again if
+        watches were released meanwhile, and stops polling the ones which
+        should not be watched anymore. It returns the directories which are
+        watched now, together with their polling entries, as they are
+        scanned a last time.
+        '''
+
+        # Local variables
+        now = time.monotonic()
+        due = []
+        promoted = []
+
+        with self.lock:
+            due = [(path, entry) for path, entry in self.polled.items()
+                   if entry[3] <= now]
+
+        # Shallower directories are watched first.
+        due.sort(key=lambda item: item[0].count(os.sep))
+
+        for path, entry in due:
+            with self.lock:
+                if not self.isWatchable(path):
+                    self.polled.pop(path, None)
+                    continue
+                if self.exhausted:
+                    continue
+                del self.polled[path]
+                if self.addWatch(path):
+                    logger.info('Directory watched instead of polled: '
+                                + str(path))
+                    promoted.append((path, entry))
+                else:
+                    self.polled[path] = entry
+
+        return promoted
+
+    # promote function ends here.
+    # ---------------------------
+
+    def poll(self, promoted=()):
+        '''
+        Function which polls the directories which are due, together with
+        the given directories watched instead of polled. A directory is
+        scanned only if its modification time changed, and then polled
+        again after interval_min seconds, while the interval of an unchanged
+        directory doubles up to interval_max seconds. It returns the
+        subdirectories created since the last poll and the subdirectories
+        which are gone.
+        '''
+
+        # Local variables
+        now = time.monotonic()
+        due = []
+        created = []
+        gone = []
+        mtime = None
+        names = set()
+
+        with self.lock:
+            due = [(path, entry) for path, entry in self.polled.items()
+                   if entry[3] <= now]
+
+        # Promoted directories were watched before their last scan, so that
+        # nothing created meanwhile is missed.
+        for path, entry in list(promoted) + due:
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except OSError:
+                with self.lock:
+                    self.polled.pop(path, None)
+                continue
+
+            if mtime == entry[0]:
+                entry[2] = min(entry[2] * 2, self.interval_max)
+                entry[3] = now + entry[2]
+                continue
+
+            names = set(os.path.basename(subdirectory)
+                        for subdirectory in scanDirectory(path))
+
+            created.extend(os.path.join(path, name)
+                           for name in sorted(names.difference(entry[1])))
+            gone.extend(os.path.join(path, name)
+                        for name in entry[1].difference(names))
+
+            entry[0] = mtime if mtime < time.time_ns() - 2000000000 else None
+            entry[1] = names
+            entry[2] = self.interval_min
+            entry[3] = now + entry[2]
+
+        return created, gone
+
+    # poll function ends here.
+    # ------------------------
+
+    async def run(self):
+        '''
+        Function which polls the directories which could not be watched and
+        hands the subdirectories created inside them over to the event
+        handler, as if inotify had reported them.
+        '''
+
+        # Local variables
+        loop = asyncio.get_running_loop()
+        created = []
+        gone = []
+
+        while True:
+            await asyncio.sleep(self.nextPoll())
+
+            try:
+                created, gone = await loop.run_in_executor(
+                    None, self.poll, self.promote())
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Unable to poll directories')
+                continue
+
+            # Subdirectories which are gone are neither watched nor polled.
+            for path in gone:
+                self.remove(path)
+
+            for path in created:
+                logger.debug('New directory polled: %s', path)
+                self.proc_fun.created(path)
+
+    # run function ends here.
+    # -----------------------
+
+    def watchTree(self, path):
+        '''
+        Function which watches the given directory and, if needed, its
+        subdirectories, from the event loop thread. Each directory is
+        watched before it is scanned, so that no subdirectory created
+        meanwhile is missed. It suits new directories, which hold few
+        subdirectories, while larger trees are watched with watch.
+        '''
+
+        # Local variables
+        count = self.count()
+        polled = self.countPolled()
+        pending = collections.deque([os.path.normpath(path)])
+        directory = ''
+
+        # Breadth first, so that shallower directories are watched first.
+        while pending:
+            directory = pending.popleft()
+            if not self.isWatchable(directory):
+                continue
+            self.addWatch(directory)
+            pending.extend(scanDirectory(directory))
+
+        if not count == self.count():
+            logger.info('Watching ' + str(self.count()) + ' directories')
+
+        if not polled == self.countPolled():
+            logger.info('Polling ' + str(self.countPolled()) + ' directories')
+
+    # watchTree function ends here.
+    # -----------------------------
+
+    def scanTree(self, path):
+        '''
+        Function which returns the given directory and those of its
+        subdirectories which should be watched, breadth first, each one
+        together with its modification time, unless it is less than two
+        seconds old, and its subdirectories. It only scans, so it may run in
+        an executor thread.
+        '''
+
+        # Local variables
+        pending = collections.deque([os.path.normpath(path)])
+        directory = ''
+        mtime = None
+        subdirectories = []
+        scanned = []
+
+        while pending:
+            directory = pending.popleft()
+            if not self.isWatchable(directory):
+                continue
+            try:
+                mtime = os.stat(directory).st_mtime_ns
+            except OSError:
+                continue
+            subdirectories = scanDirectory(directory)
+            if mtime >= time.time_ns() - 2000000000:
+                mtime = None
+            scanned.append((directory, mtime, subdirectories))
+            pending.extend(subdirectories)
+
+        return scanned
+
+    # scanTree function ends here.
+    # ----------------------------
+
+    def changedTree(self, scanned):
+        '''
+        Function which returns the subdirectories created inside the given
+        scanned directories since they were scanned. Only directories whose
+        modification time changed, or was too recent to rely on, are
+        scanned again, so it may run in an executor thread.
+        '''
+
+        # Local variables
+        created = []
+
+        for directory, mtime, subdirectories in scanned:
+            try:
+                if mtime is not None \
+                   and os.stat(directory).st_mtime_ns == mtime:
+                    continue
+            except OSError:
+                continue
+            created.extend(sorted(set(scanDirectory(directory)).difference(
+                subdirectories)))
+
+        return created
+
+    # changedTree function ends here.
+    # -------------------------------
+
+    async def watch(self, path):
+        '''
+        Function which watches the given directory and, if needed, its
+        subdirectories from the event loop thread, scanning them in an
+        executor thread. Directories are watched after they were scanned,
+        so the ones newly watched or polled are checked again afterwards
+        and the subdirectories created meanwhile are handed over to the
+        event handler, as if inotify had reported them.
+        '''
+
+        # Local variables
+        loop = asyncio.get_running_loop()
+        count = self.count()
+        polled = self.countPolled()
+        scanned = []
+        added = []
+
+        scanned = await loop.run_in_executor(None, self.scanTree, path)
+
+        for entry in scanned:
+            if entry[0] in self.watches or entry[0] in self.polled:
+                continue
+            self.addWatch(entry[0])
+            added.append(entry)
+
+        if not count == self.count():
+            logger.info('Watching ' + str(self.count()) + ' directories')
+
+        if not polled == self.countPolled():
+            logger.info('Polling ' + str(self.countPolled()) + ' directories')
+
+        for subdirectory in await loop.run_in_executor(
+                None, self.changedTree, added):
+            logger.debug('New directory found while watching: %s',
+                         subdirectory)
+            self.proc_fun.created(subdirectory)
+
+    # watch function ends here.
+    # -------------------------
+
+    def remove(self, path):
+        '''
+        Function which removes the watches on the given directory and its
+        subdirectories.
+        '''
+
+        # Local variables
+        path = os.path.normpath(path)
+        prefix = path + os.sep
+        directories = []
+
+        with self.lock:
+            for directory in [directory for directory in self.polled
+                              if directory == path
+                              or directory.startswith(prefix)]:
+                del self.polled[directory]
+
+            directories = [directory for directory in self.watches
+                           if directory == path
+                           or directory.startswith(prefix)]
+
+            if not directories:
+                return
+
+            self.watch_manager.rm_watch([self.watches.pop(directory)
+                                         for directory in directories],
+                                        quiet=True)
+
+            # Polled directories are watched again on their next poll.
+            self.exhausted = False
+
+        logger.info('Watching ' + str(self.count()) + ' directories')
+
+    # remove function ends here.
+    # --------------------------
+
+    async def update(self, trie):
+        '''
+        Function which applies a new include trie, removing the watches which
+        are not needed anymore and adding the missing ones.
+        '''
+
+        with self.lock:
+            self.trie = trie
+
+            for directory in list(self.watches) + list(self.polled):
+                if (directory in self.watches or directory in self.polled) \
+                   and not self.isWatchable(directory):
+                    self.remove(directory)
+
+        await self.watch(self.path)
+
+    # update function ends here.
+    # --------------------------
+
+
+# WatchRegistry class definition ends here.
+# -----------------------------------------
+
+
+class EventHandler(pyinotify.ProcessEvent):
+    '''
+    Class which is called by inotify. A directory moved from a watched
+    directory is kept pending until the directory it is moved to is known,
+    pairing both events by their cookie and by the inode the directory had
+    when it was scanned. Directories moved within the watched directories
+    keep their scanned entries, while directories moved in from elsewhere
+    are evaluated as new ones. Directories within an excluded directory are
+    left alone, and those up to priority_depth below the dropbox path are
+    evaluated right away.
+    '''
+
+    def my_init(self, batcher, registry=None, table=None, state=None,
+                path=None):
+        '''
+        Function which is called by pyinotify.ProcessEvent constructor with
+        the batcher new directories are queued on, the registry of watched
+        directories, the table of scanned directories, the in memory exclude
+        list and the dropbox path.
+        '''
+
+        self.batcher = batcher
+        self.registry = registry
+        self.table = table
+        self.state = state
+        self.path = path
+
+    # my_init function ends here.
+    # ---------------------------
+
+    def isExcluded(self, path):
+        '''
+        Function which returns whether the given directory lies within an
+        excluded directory which stays excluded, so that it does not need to
+        be evaluated.
+        '''
+
+        if self.state is None or self.registry is None \
+           or self.registry.trie is None \
+           or self.registry.trie.excludePath(path) is None \
+           or not self.state.isExcluded(path):
+            return False
+
+        logger.debug('Directory within an excluded directory: %s', path)
+        countMetric('dropbox_include_events_dropped_total')
+
+        return True
+
+    # isExcluded function ends here.
+    # ------------------------------
+
+    def isUrgent(self, path):
+        '''
+        Function which returns whether the given directory lies up to
+        priority_depth directories below the dropbox path.
+        '''
+
+        # Global variables
+        global priority_depth
+
+        # Local variables
+        relative = ''
+
+        if self.path is None or int(priority_depth) <= 0:
+            return False
+
+        relative = os.path.relpath(path, self.path)
+
+        return not relative.startswith(os.pardir) \
+            and relative.count(os.sep) < int(priority_depth)
+
+    # isUrgent function ends here.
+    # ----------------------------
+
+    # Define a function for folder and file creation process
+    def process_IN_CREATE(self, event):
+        '''
+        Function which is called by inotify whenever a new directory is
+        created.
+        '''
+
+        logger.debug('New directory detected: %s', event.pathname)
+
+        self.created(event.pathname, event.dir)
+
+    # process_IN_CREATE function ends here.
+    # -------------------------------------
+
+    def created(self, path, directory=True):
+        '''
+        Function which queues a new directory, found either by inotify or by
+        polling a directory which could not be watched.
+        '''
+
+        countMetric('dropbox_include_events_received_total')
+
+        if self.isExcluded(path):
+            return
+
+        self.batcher.add(path, self.isUrgent(path))
+
+        # Watch the new directory right away if it needs to be watched.
+        if self.registry is not None and directory \
+           and self.registry.isWatchable(path):
+            self.registry.watchTree(path)
+
+    # created function ends here.
+    # ---------------------------
+
+    def process_IN_MOVED_FROM(self, event):
+        '''
+        Function which is called by inotify whenever a directory is moved
+        away from a watched directory.
+        '''
+
+        # Global variables
+        global pending_moves
+
+        if not event.dir:
+            return
+
+        logger.debug('Directory moved away: %s', event.pathname)
+
+        self.batcher.discard(event.pathname)
+
+        if self.registry is not None:
+            self.registry.remove(event.pathname)
+
+        pending_moves[event.cookie] = (
+            self, event.pathname,
+            self.table.inode(event.pathname) if self.table is not None
+            else None)
+
+        # Both events of a move are queued together, so a directory whose
+        # destination is not known by then was moved out.
+        asyncio.get_running_loop().call_later(1.0, self.expireMove,
+                                              event.cookie)
+
+    # process_IN_MOVED_FROM function ends here.
+    # -----------------------------------------
+
+    def process_IN_MOVED_TO(self, event):
+        '''
+        Function which is called by inotify whenever a directory is moved
+        into a watched directory. The entries of a directory moved within
+        the watched directories are relocated, so that evaluating it does
+        not scan it again, and any other directory is evaluated as a new
+        one.
+        '''
+
+        # Global variables
+        global pending_moves
+
+        # Local variables
+        moved = pending_moves.pop(event.cookie, None)
+        handler = None
+        source = ''
+        inode = None
+
+        countMetric('dropbox_include_events_received_total')
+
+        if moved is not None:
+            handler, source, inode = moved
+            try:
+                if inode is None or handler.table is None \
+                   or self.table is None \
+                   or not os.stat(event.pathname).st_ino == inode:
+                    moved = None
+            except OSError:
+                moved = None
+
+        if moved is not None:
+            logger.info('Directory moved: ' + str(source) + ' -> '
+                        + str(event.pathname))
+            countMetric('dropbox_include_moves_total', kind='relocated')
+            self.table.attach(event.pathname, handler.table.detach(source))
+        elif event.dir:
+            logger.debug('Directory moved in: %s', event.pathname)
+            countMetric('dropbox_include_moves_total', kind='moved_in')
+
+        if self.isExcluded(event.pathname):
+            return
+
+        self.batcher.add(event.pathname, self.isUrgent(event.pathname))
+
+        if self.registry is not None and event.dir \
+           and self.registry.isWatchable(event.pathname):
+            self.registry.watchTree(event.pathname)
+
+    # process_IN_MOVED_TO function ends here.
+    # ---------------------------------------
+
+    def expireMove(self, cookie):
+        '''
+        Function which forgets the entries of a directory moved away from
+        the watched directories.
+        '''
+
+        # Global variables
+        global pending_moves
+
+        # Local variables
+        moved = pending_moves.pop(cookie, None)
+
+        if moved is None:
+            return
+
+        logger.debug('Directory moved out: %s', moved[1])
+        countMetric('dropbox_include_moves_total', kind='moved_out')
+
+        if self.table is not None:
+            self.table.detach(moved[1])
+
+    # expireMove function ends here.
+    # ------------------------------
+
+
+# EventHandler class definition ends here.
+# ----------------------------------------
+
+
+# -----------------------------------------------------------------------------
+#                                     Main
+# -----------------------------------------------------------------------------
+
+def readEvents(notifier, fd=None):
+    '''
+    Function which the event loop calls whenever inotify events are ready to
+    be read on the given descriptor. Every event queued before the read is
+    handled, so unless the queue overflowed, that is the last consistent
+    point of each root. Reading stops while too many directories are
+    queued.
+    '''
+
+    # Global variables
+    global dropbox_roots
+
+    # Local variables
+    now = time.time_ns()
+
+    notifier.read_events()
+    notifier.process_events()
+
+    for root in dropbox_roots:
+        if root.rescan is None:
+            root.consistent = now
+
+    if fd is not None and any(root.batcher is not None
+                              and root.batcher.isFull()
+                              for root in dropbox_roots):
+        pauseEvents(notifier, fd)
+
+    # readEvents function ends here.
+    # ------------------------------
+
+
+def pauseEvents(notifier, fd):
+    '''
+    Function which stops reading inotify events while too many directories
+    are queued, so that new events wait in the kernel queue until the
+    queued directories are evaluated. Should the kernel queue overflow
+    meanwhile, the changed directories are rescanned.
+    '''
+
+    # Local variables
+    loop = asyncio.get_running_loop()
+
+    loop.remove_reader(fd)
+
+    logger.warning('Too many directories queued, stop reading inotify '
+                   'events')
+    countMetric('dropbox_include_intake_pauses_total')
+
+    loop.call_later(max(0.1, float(event_batch_window)), resumeEvents,
+                    notifier, fd)
+
+    # pauseEvents function ends here.
+    # -------------------------------
+
+
+def resumeEvents(notifier, fd):
+    '''
+    Function which reads inotify events again once the queued directories
+    of every root are down to half of event_backlog_limit.
+    '''
+
+    # Global variables
+    global dropbox_roots
+    global walker_cancel
+
+    # Local variables
+    loop = asyncio.get_running_loop()
+
+    if walker_cancel.is_set():
+        return
+
+    if any(root.batcher is not None
+           and len(root.batcher.queue) * 2 >= root.batcher.limit > 0
+           for root in dropbox_roots):
+        loop.call_later(max(0.1, float(event_batch_window)), resumeEvents,
+                        notifier, fd)
+        return
+
+    logger.info('Read inotify events again')
+
+    loop.add_reader(fd, readEvents, notifier, fd)
+
+    # resumeEvents function ends here.
+    # --------------------------------
+
+
+def reloadConfiguration():
+    '''
+    Function which the event loop calls on SIGHUP. The configuration files
+    are checked again and the whole dropbox path of each root is evaluated
+    with the resulting settings.
+    '''
+
+    # Global variables
+    global config_changed
+    global dropbox_roots
+
+    logger.warning('Reloading due to SIGHUP')
+
+    config_changed.set()
+
+    for root in dropbox_roots:
+        root.changed.set()
+        if root.batcher is not None:
+            root.batcher.add(root.path)
+
+    # reloadConfiguration function ends here.
+    # ---------------------------------------
+
+
+def stopDaemon(task, reason):
+    '''
+    Function which the event loop calls on SIGTERM and SIGINT. Directory
+    scans are abandoned and the daemon task is cancelled. Further signals
+    are ignored, so that they do not interrupt the clean up.
+    '''
+
+    # Global variables
+    global walker_cancel
+
+    if walker_cancel.is_set():
+        return
+
+    logger.warning(reason)
+
+    walker_cancel.set()
+    task.cancel()
+
+    # stopDaemon function ends here.
+    # ------------------------------
+
+
+async def initialSequence(root):
+    '''
+    Function which seeds the in memory exclude list of the given dropbox
+    root and reconciles it with the directories which should be excluded.
+    If the state of the last run was saved, only the directories which
+    changed since are scanned and the exclude list is seeded from the saved
+    one instead of being read from dropbox. It returns whether the saved
+    state was used.
+    '''
+
+    # Local variables
+    snapshot = root.snapshot
+    path = os.path.expanduser(snapshot.dropbox_path)
+    state = None
+
+    if snapshot.state_file:
+        state = loadStateSnapshot(snapshot.state_file, snapshot.dropbox_path)
+
+    # A journal is only of use together with the state it applies to.
+    if state is None and root.journal is not None:
+        root.journal.reset()
+
+    logger.info('Entering initial exclude and unexclude sequence: '
+                + str(path))
+
+    root.directory_table = DirectoryTable(
+        state['directories'] if state is not None else [])
+
+    current_directories = await asyncio.get_running_loop().run_in_executor(
+        None, evalCurrentDirectories,
+        path, snapshot.include_trie, root.directory_table)
+
+    logger.info('Scanned ' + str(root.directory_table.scanned)
+                + ' directories, ' + str(root.directory_table.reused)
+                + ' unchanged since the last run')
+
+    logger.debug('Initial dropbox_path directories: %s',
+                 LogSummary(current_directories))
+
+    exclude_directories = evalToExcludeDirectories2(
+        snapshot.include_directory_list,
+        current_directories,
+        snapshot.include_trie)
+
+    if state is not None:
+        if not state.get('include_directories') == sorted(
+                snapshot.include_directory_list):
+            logger.info('Include directories changed since the last run')
+
+        # The saved exclude list is checked against dropbox in the
+        # background.
+        root.exclude_state.replace(state.get('exclude_list', []))
+
+        # Operations recorded after the state was saved are replayed, so
+        # that the work of a run which died is neither lost nor repeated.
+        if root.journal is not None:
+            exclude_directories = sorted(set(exclude_directories).union(
+                directory for directory in map(
+                    snapshot.include_trie.excludePath, replayJournal(root))
+                if directory is not None))
+
+    else:
+        dropbox_exclude_list = await root.readExcludeList()
+
+        if dropbox_exclude_list is None:
+            logger.error('Unable to read the dropbox exclude list')
+            dropbox_exclude_list = []
+
+        # From now on the exclude list is kept in memory
+        root.exclude_state.replace(dropbox_exclude_list)
+
+    logger.debug('To exclude directories: %s',
+                 LogSummary(exclude_directories))
+
+    logger.debug('Initial already excluded directories: %s',
+                 LogSummary(root.exclude_state.list()))
+
+    # Only directories which are not excluded yet are excluded.
+    await reconcileExcludeList(root, snapshot, exclude_directories)
+
+    logger.info('Leaving initial exclude and unexclude sequence: '
+                + str(path))
+
+    if snapshot.state_file:
+        saveStateSnapshot(root)
+
+    return state is not None
+
+    # initialSequence function ends here.
+    # -----------------------------------
+
+
+async def verifyExcludeList(root):
+    '''
+    Function which checks the exclude list of the given dropbox root seeded
+    from the saved state against the dropbox exclude list, and evaluates
+    the whole dropbox path again if they differ.
+    '''
+
+    if await root.exclude_state.refresh():
+        logger.warning('Exclude list changed since the last run, evaluate '
+                       'the dropbox path again: ' + str(root.path))
+        root.batcher.add(root.path)
+
+    # verifyExcludeList function ends here.
+    # -------------------------------------
+
+
+async def rescanRoot(root):
+    '''
+    Function which evaluates the directories created under the given
+    dropbox root since its last consistent point, as their events may have
+    been lost. It starts over while the event queue keeps overflowing.
+    '''
+
+    # Local variables
+    loop = asyncio.get_running_loop()
+    overflows = None
+    start = 0
+    since = 0
+
+    try:
+        while not overflows == root.overflows:
+            overflows = root.overflows
+            start = time.time_ns()
+
+            # Modification times are taken from a coarse clock, so look a
+            # second further back.
+            since = root.consistent - 1000000000
+
+            for directory in await loop.run_in_executor(
+                    None, evalChangedDirectories, root, since):
+                root.batcher.add(directory)
+
+                # New subdirectories which need to be watched are watched.
+                if root.watch_registry.isWatchable(directory):
+                    await root.watch_registry.watch(directory)
+
+    except asyncio.CancelledError:
+        raise
+
+    except Exception:
+        logger.exception('Unable to rescan changed directories, evaluate '
+                         'the dropbox path again: ' + str(root.path))
+        root.batcher.add(root.path)
+
+    root.consistent = start
+    root.rescan = None
+
+    # rescanRoot function ends here.
+    # ------------------------------
+
+
+def findRoot(path):
+    '''
+    Function which returns the dropbox root holding the given path, or None
+    if the path lies outside every dropbox path.
+    '''
+
+    # Global variables
+    global dropbox_roots
+
+    # Local variables
+    found = None
+
+    for root in dropbox_roots:
+        if (path == root.path or path.startswith(root.path + os.sep)) \
+           and (found is None or len(root.path) > len(found.path)):
+            found = root
+
+    return found
+
+    # findRoot function ends here.
+    # ----------------------------
+
+
+def answerControlRequest(request):
+    '''
+    Function which answers a control request from the in memory state of
+    the dropbox roots, without running any dropbox command. Requests are
+    dictionaries holding the command and, depending on it, a path:
+    classify classifies the path against the include directories and the
+    exclude list, excluded returns the exclude list of every root or of the
+    root holding the path, reconcile queues the path to be evaluated again,
+    status returns the state of every root and stats the metrics.
+    '''
+
+    # Global variables
+    global dropbox_roots
+    global command_limiter
+
+    # Local variables
+    command = request.get('command')
+    path = request.get('path')
+    root = None
+    exclude_path = None
+    roots = []
+    values = {}
+    stats = {}
+    name = ''
+
+    if path is not None:
+        if not isinstance(path, str) or not os.path.isabs(path):
+            return {'error': 'Path must be absolute: ' + str(path)}
+
+        path = os.path.normpath(path)
+        root = findRoot(path)
+
+        if root is None:
+            return {'error': 'Path outside every dropbox path: ' + path}
+
+    elif command in ('classify', 'reconcile'):
+        return {'error': 'Command needs a path: ' + str(command)}
+
+    if command == 'classify':
+        exclude_path = root.snapshot.include_trie.excludePath(path)
+        return {'path': path,
+                'root': root.path,
+                'included': exclude_path is None,
+                'exclude_path': exclude_path,
+                'excluded': root.exclude_state.isExcluded(path)}
+
+    elif command == 'excluded':
+        roots = [root] if root is not None else dropbox_roots
+        return {'roots': [{'path': root.path,
+                           'excluded': root.exclude_state.list()}
+                          for root in roots]}
+
+    elif command == 'reconcile':
+        if root.batcher is None:
+            return {'error': 'Not monitoring yet: ' + root.path}
+
+        if not os.path.isdir(path):
+            return {'error': 'Not a directory: ' + path}
+
+        logger.info('Reconcile requested: ' + str(path))
+
+        root.batcher.add(path)
+
+        return {'queued': path, 'backlog': root.batcher.backlog()}
+
+    elif command == 'status':
+        return {'version': __version__,
+                'pid': os.getpid(),
+                'command_workers': command_limiter.limit
+                if command_limiter is not None else int(command_workers),
+                'roots': [{
+                    'path': root.path,
+                    'excluded': root.exclude_state.count(),
+                    'directories': root.directory_table.count()
+                    if root.directory_table is not None else 0,
+                    'watches': root.watch_registry.count()
+                    if root.watch_registry is not None else 0,
+                    'polled': root.watch_registry.countPolled()
+                    if root.watch_registry is not None else 0,
+                    'backlog': root.batcher.backlog()
+                    if root.batcher is not None else 0,
+                    'journal': len(root.journal.pending)
+                    if root.journal is not None else 0,
+                    'overflows': root.overflows}
+                    for root in dropbox_roots]}
+
+    elif command == 'stats':
+        values = collectMetrics()
+        for key in sorted(values):
+            name = key[0]
+            if key[1]:
+                name += '{' + ','.join(label + '="' + str(value) + '"'
+                                       for label, value in key[1]) + '}'
+            if isinstance(values[key], list):
+                stats[name] = {'sum': values[key][1],
+                               'count': values[key][2]}
+            else:
+                stats[name] = values[key]
+        return {'stats': stats}
+
+    return {'error': 'Unknown command: ' + str(command)}
+
+    # answerControlRequest function ends here.
+    # ----------------------------------------
+
+
+async def answerControl(reader, writer):
+    '''
+    Function which answers the requests of a control socket connection, one
+    JSON object per line, until the client closes it.
+    '''
+
+    # Local variables
+    line = b''
+    request = None
+    answer = {}
+
+    try:
+        while True:
+            line = await asyncio.wait_for(reader.readline(), 60.0)
+            if not line:
+                break
+            if not line.strip():
+                continue
+
+            try:
+                request = json.loads(line.decode('utf-8'))
+            except ValueError:
+                request = None
+
+            if isinstance(request, dict):
+                answer = answerControlRequest(request)
+            else:
+                answer = {'error': 'Invalid request'}
+
+            writer.write(json.dumps(answer, separators=(',', ':'))
+                         .encode('utf-8') + b'\n')
+            await writer.drain()
+    except (OSError, ValueError, asyncio.TimeoutError) as error:
+        logger.debug('Control request failed: ' + str(error))
+    finally:
+        writer.close()
+
+    # answerControl function ends here.
+    # ---------------------------------
+
+
+async def serveControl(path):
+    '''
+    Function which starts answering control requests on the given unix
+    socket path, only reachable by the user running the daemon, and returns
+    the server.
+    '''
+
+    # Local variables
+    server = None
+    listener = None
+    umask = 0
+
+    path = os.path.expanduser(path)
+
+    logger.info('Answer control requests on ' + str(path))
+
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path), 0o700)
+
+    unlinkSocket(path)
+
+    # The socket is bound under a umask which leaves it only reachable by
+    # the user, so that no other user can connect before it is restricted.
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0o177)
+    try:
+        listener.bind(path)
+    except OSError:
+        listener.close()
+        raise
+    finally:
+        os.umask(umask)
+
+    server = await asyncio.start_unix_server(answerControl, sock=listener)
+
+    return server
+
+    # serveControl function ends here.
+    # --------------------------------
+
+
+def controlClient(path, arguments):
+    '''
+    Function which sends the request given as command line arguments, the
+    command followed by an optional path, to the control socket of the
+    running daemon and prints its answer. It returns the exit status.
+    '''
+
+    # Local variables
+    request = {'command': arguments[0]}
+    data = b''
+    chunk = b''
+    answer = {}
+
+    if len(arguments) > 1:
+        request['path'] = os.path.abspath(os.path.expanduser(arguments[1]))
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.settimeout(float(command_timeout))
+            client.connect(os.path.expanduser(path))
+            client.sendall(json.dumps(request).encode('utf-8') + b'\n')
+            client.shutdown(socket.SHUT_WR)
+            while True:
+                chunk = client.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+        answer = json.loads(data.decode('utf-8'))
+    except (OSError, ValueError) as error:
+        print('Unable to query ' + str(path) + ': ' + str(error),
+              file=sys.stderr)
+        return 1
+
+    print(json.dumps(answer, indent=2, sort_keys=True))
+
+    return 1 if 'error' in answer else 0
+
+    # controlClient function ends here.
+    # ---------------------------------
+
+
+def createRoots():
+    '''
+    Function which returns the dropbox roots to monitor: one per root line
+    of the configuration file, or the dropbox path of the configuration
+    file itself if it has none.
+    '''
+
+    # Global variables
+    global config_file
+    global config_snapshot
+    global root_config_files
+
+    # Local variables
+    directory = os.path.dirname(os.path.expanduser(config_file))
+
+    if not root_config_files:
+        return [DropboxRoot(None, config_snapshot)]
+
+    return [DropboxRoot(os.path.join(directory, root_config_file),
+                        rootConfiguration(os.path.join(directory,
+                                                       root_config_file)))
+            for root_config_file in root_config_files]
+
+    # createRoots function ends here.
+    # -------------------------------
+
+
+async def daemon():
+    '''
+    Function which runs the initial exclude and unexclude sequence of each
+    dropbox root and then evaluates new directories until it is cancelled.
+    All roots share the event loop, the inotify file descriptor and the
+    dropbox command workers.
+    '''
+
+    # Global variables
+    global config_watch_manager
+    global dropbox_roots
+    global profiler
+
+    # Local variables
+    loop = asyncio.get_running_loop()
+    task = asyncio.current_task()
+    wm = None
+    notifier = None
+    tasks = []
+    restored = {}
+    metrics_writer = None
+    metrics_server = None
+    control_server = None
+
+    loop.add_signal_handler(signal.SIGTERM, stopDaemon, task,
+                            'Leaving due to kill signal')
+    loop.add_signal_handler(signal.SIGINT, stopDaemon, task,
+                            'Leaving due to KeyboardInterrupt')
+    loop.add_signal_handler(signal.SIGHUP, reloadConfiguration)
+
+    dropbox_roots = createRoots()
+
+    if int(profile) > 0:
+        logger.info('Profile one in every ' + str(profile) + ' runs into '
+                    + str(profile_directory))
+        profiler = Profiler(profile, profile_directory)
+
+    watchMetric('dropbox_include_excluded_directories', lambda: sum(
+        root.exclude_state.count() for root in dropbox_roots))
+    watchMetric('dropbox_include_backlog', lambda: sum(
+        root.batcher.backlog() for root in dropbox_roots
+        if root.batcher is not None))
+    watchMetric('dropbox_include_command_workers', lambda: (
+        command_limiter.limit if command_limiter is not None
+        else int(command_workers)))
+    watchMetric('dropbox_include_watches', lambda: sum(
+        root.watch_registry.count() for root in dropbox_roots
+        if root.watch_registry is not None))
+    watchMetric('dropbox_include_polled_directories', lambda: sum(
+        root.watch_registry.countPolled() for root in dropbox_roots
+        if root.watch_registry is not None))
+
+    try:
+        if metrics_textfile:
+            metrics_writer = asyncio.ensure_future(
+                writeMetricsLoop(metrics_textfile, metrics_interval))
+
+        if metrics_listen:
+            try:
+                metrics_server = await serveMetrics(metrics_listen)
+            except (OSError, ValueError) as error:
+                logger.error('Unable to serve metrics on '
+                             + str(metrics_listen) + ': ' + str(error))
+
+        # The initial sequence of every root is profiled.
+        for position, root in enumerate(dropbox_roots):
+            restored[root] = await profileCall(
+                'initial' + str(position), initialSequence, root)
+
+            # Check the in memory exclude list against dropbox in the
+            # background
+            tasks.append(asyncio.ensure_future(
+                root.exclude_state.run(exclude_list_refresh_interval)))
+
+        # ---------------------------------------------------------------------
+
+        logger.info('Entering inotify setup')
+
+        # Continue running until user stops it
+        # If dropbox creates a new directory or subdirectory inside the main
+        # dropbox folder, check whether it should be excluded or not and do
+        # it so.
+
+        # The watch manager stores the watches and provides operations on
+        # watches. A single one serves every root.
+        wm = pyinotify.WatchManager()
+
+        # Watch configuration files so that they are reloaded only on changes
+        config_watch_manager = wm
+        watchConfiguration()
+
+        # Watched events: watch whether a new directory is created or a
+        # directory is moved
+        mask = pyinotify.IN_CREATE | pyinotify.IN_MOVED_FROM \
+            | pyinotify.IN_MOVED_TO | pyinotify.IN_ISDIR
+
+        # Read inotify events from the event loop. Events are handed to the
+        # handler of the root their watch belongs to.
+        notifier = pyinotify.Notifier(wm, OverflowHandler())
+        loop.add_reader(wm.get_fd(), readEvents, notifier, wm.get_fd())
+
+        for root in dropbox_roots:
+
+            # New directories are evaluated in batches, while the commands
+            # of the previous batch run.
+            root.batcher = EventBatcher(
+                functools.partial(profileCall, 'plan',
+                                  evalExcludeIncludePlan, root),
+                functools.partial(profileCall, 'apply',
+                                  evalExcludeIncludeApply, root),
+                event_batch_window,
+                event_batch_size,
+                event_backlog_limit)
+            root.batcher.start()
+
+            if restored[root]:
+                tasks.append(asyncio.ensure_future(verifyExcludeList(root)))
+
+            # Add a new watch on the dropbox folder and on the
+            # subdirectories where new directories may have to be excluded.
+            handler = EventHandler(batcher=root.batcher,
+                                   table=root.directory_table,
+                                   state=root.exclude_state,
+                                   path=root.path)
+            root.watch_registry = WatchRegistry(wm, mask, handler, root.path,
+                                                poll_interval_min,
+                                                poll_interval_max)
+            handler.registry = root.watch_registry
+            await root.watch_registry.update(root.snapshot.include_trie)
+
+            # Directories which could not be watched are polled instead.
+            tasks.append(asyncio.ensure_future(root.watch_registry.run()))
+
+        if control_socket:
+            try:
+                control_server = await serveControl(control_socket)
+            except OSError as error:
+                logger.error('Unable to answer control requests on '
+                             + str(control_socket) + ': ' + str(error))
+
+        logger.info('Entering inotify loop')
+
+        await asyncio.Event().wait()
+
+    except asyncio.CancelledError:
+        pass
+
+    finally:
+        if control_server is not None:
+            control_server.close()
+            await control_server.wait_closed()
+            if os.path.exists(os.path.expanduser(control_socket)):
+                os.unlink(os.path.expanduser(control_socket))
+        if notifier is not None:
+            loop.remove_reader(wm.get_fd())
+        for background_task in tasks:
+            background_task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for root in dropbox_roots:
+            if root.rescan is not None:
+                root.rescan.cancel()
+                await asyncio.gather(root.rescan, return_exceptions=True)
+            if root.batcher is not None:
+                await root.batcher.stop()
+            if root.snapshot.state_file:
+                saveStateSnapshot(root)
+            root.close()
+        if notifier is not None:
+            notifier.stop()
+        if metrics_server is not None:
+            metrics_server.close()
+            await metrics_server.wait_closed()
+            if metrics_listen.startswith('unix:') and os.path.exists(
+                    os.path.expanduser(metrics_listen[len('unix:'):])):
+                os.unlink(os.path.expanduser(metrics_listen[len('unix:'):]))
+        if metrics_writer is not None:
+            metrics_writer.cancel()
+            await asyncio.gather(metrics_writer, return_exceptions=True)
+
+    # daemon function ends here.
+    # --------------------------
+
+
+def main():
+
+    # Global variables
+    global config_snapshot
+
+    setLogger()
+
+    # Parse configuration file
+
+    logger.debug('Parse ' + str(config_file) + ' configuration file if exists')
+
+    configuration(config_file)
+
+    logger.debug('Set logger with default settings')
+    setLogger()
+
+    # argparse section
+
+    logger.debug('Parse command line arguments')
+    old_config_file = config_file
+    parse_arguments()
+
+    if not config_file == old_config_file:
+        logger.debug('Set logger with configuration file settings')
+        configuration(config_file)
+        setLogger()
+
+    # end of argparse section
+
+    # Answer a control request instead of running the daemon.
+    if control_request:
+        stopLogger()
+        sys.exit(controlClient(control_socket, control_request))
+
+    logger.warning('Starting ' + __app_name__ + ' ' + __version__)
+
+    # Keep the settings, command line arguments included, until the
+    # configuration files change.
+    config_snapshot = takeConfigurationSnapshot()
+
+    try:
+        asyncio.run(daemon())
+    finally:
+        stopLogger()
 
 
 if __name__ == '__main__':
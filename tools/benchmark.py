@@ -0,0 +1,561 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Iñaki Garitano (igaritano@garitano.org)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Benchmark of dropbox_include.py on a synthetic dropbox directory tree. The
+tree is generated under the work directory with the given number of
+directories, depth, fan out and symbolic links, together with a random
+include configuration, and it is reused by later runs with the same
+settings. Dropbox is replaced by fake_dropbox_cli.py, whose calls take the
+given latency. It measures:
+
+    * the initial exclude and unexclude sequence, and again as on a restart
+      with the state saved by the first one,
+    * a full scan of the tree and evalToExcludeDirectories2 on it,
+    * evalToUnexcludeDirectories on the resulting exclude list,
+    * the latency from the creation of each directory of an IN_CREATE storm
+      until it is excluded,
+    * the peak resident memory.
+
+Results are written as JSON and can be compared with a previous run:
+
+    tools/benchmark.py --preset 100k --output new.json --compare old.json
+'''
+
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import resource
+import argparse
+import platform
+
+
+# Global variables
+tools_path = os.path.dirname(os.path.abspath(__file__))
+presets = {
+    '10k': {'directories': 10000, 'depth': 6, 'fanout': 8},
+    '100k': {'directories': 100000, 'depth': 7, 'fanout': 10},
+    '1m': {'directories': 1000000, 'depth': 8, 'fanout': 12}}
+storm_prefix = 'benchmark_storm_'
+
+sys.path.insert(0, os.path.dirname(tools_path))
+
+import pyinotify  # noqa: E402
+import dropbox_include  # noqa: E402
+
+
+# Functions
+def generateTree(path, directories, depth, fanout, symlinks, seed):
+    '''
+    This function generates a directory tree with the given number of
+    directories, spread breadth first up to the given depth with a random
+    number of subdirectories around the given fan out. Symbolic links only
+    point to directories without subdirectories, so they never make a loop.
+    It returns the relative paths of the generated directories.
+    '''
+
+    # Local variables
+    rng = random.Random(seed)
+    pending = [('', 0)]
+    tree = []
+    leaves = []
+    parent = ''
+    level = 0
+    children = 0
+    directory = ''
+
+    os.makedirs(path)
+
+    while pending and len(tree) < directories:
+        parent, level = pending.pop(0)
+        if level >= depth:
+            leaves.append(parent)
+            continue
+        children = min(rng.randint(1, 2 * fanout - 1),
+                       directories - len(tree))
+        for child in range(children):
+            directory = os.path.join(parent, 'Dir' + str(child))
+            os.mkdir(os.path.join(path, directory))
+            tree.append(directory)
+            pending.append((directory, level + 1))
+
+    leaves.extend(directory for directory, level in pending)
+
+    if len(tree) < directories:
+        print('Only ' + str(len(tree)) + ' directories fit within depth '
+              + str(depth), file=sys.stderr)
+
+    for link in range(min(symlinks, len(leaves))):
+        parent = rng.choice(tree)
+        os.symlink(os.path.join(path, rng.choice(leaves)),
+                   os.path.join(path, parent, 'Link' + str(link)))
+
+    # The dropbox cache is never excluded nor entered.
+    for directory in range(fanout):
+        os.makedirs(os.path.join(path, '.dropbox.cache', str(directory)))
+
+    return tree
+
+    # generateTree function ends here.
+    # --------------------------------
+
+
+def prepareTree(args):
+    '''
+    This function generates the directory tree and the include configuration
+    under the work directory, unless they were generated with the same
+    settings before. It returns the settings.
+    '''
+
+    # Local variables
+    settings = {
+        'directories': args.directories,
+        'depth': args.depth,
+        'fanout': args.fanout,
+        'symlinks': args.symlinks,
+        'includes': args.includes,
+        'seed': args.seed}
+    path = os.path.join(args.work, 'Dropbox')
+    marker = os.path.join(args.work, 'tree.json')
+    tree = []
+    rng = random.Random(args.seed)
+
+    if os.path.exists(marker):
+        with open(marker, 'r') as file:
+            if json.load(file) == settings:
+                return settings
+
+    shutil.rmtree(args.work, ignore_errors=True)
+    os.makedirs(args.work)
+
+    print('Generating ' + str(args.directories) + ' directories in '
+          + str(path), file=sys.stderr)
+
+    tree = generateTree(path, args.directories, args.depth, args.fanout,
+                        args.symlinks, args.seed)
+
+    with open(os.path.join(args.work, 'include.conf'), 'w') as file:
+        for directory in rng.sample(tree, min(args.includes, len(tree))):
+            file.write(directory + '\n')
+
+    with open(marker, 'w') as file:
+        json.dump(settings, file)
+
+    return settings
+
+    # prepareTree function ends here.
+    # -------------------------------
+
+
+def writeConfiguration(args):
+    '''
+    This function writes the configuration file used by the benchmark and
+    returns its path.
+    '''
+
+    # Local variables
+    config_file = os.path.join(args.work, 'dropbox_include.conf')
+    command = ' '.join([sys.executable,
+                        os.path.join(tools_path, 'fake_dropbox_cli.py'),
+                        '--state', os.path.join(args.work, 'state.json'),
+                        '--latency', str(args.latency),
+                        'exclude'])
+
+    with open(config_file, 'w') as file:
+        file.write('include include.conf\n')
+        file.write('dropbox_path = ' + os.path.join(args.work, 'Dropbox')
+                   + '\n')
+        file.write('dropbox_exclude_add_command=' + command + ' add\n')
+        file.write('dropbox_exclude_list_command=' + command + ' list\n')
+        file.write('dropbox_exclude_remove_command=' + command + ' remove\n')
+        file.write('walker_threads = ' + str(args.walker_threads) + '\n')
+        file.write('event_batch_window = ' + str(args.event_batch_window)
+                   + '\n')
+        file.write('state_file = ' + os.path.join(args.work, 'snapshot.json')
+                   + '\n')
+        file.write('logger_method = console\n')
+        file.write('logger_level = ' + args.logger_level + '\n')
+
+    return config_file
+
+    # writeConfiguration function ends here.
+    # --------------------------------------
+
+
+def timed(function, *args):
+    '''
+    This function calls the given function and returns its result together
+    with the seconds it took.
+    '''
+
+    # Local variables
+    start = time.perf_counter()
+    result = function(*args)
+
+    return result, time.perf_counter() - start
+
+    # timed function ends here.
+    # -------------------------
+
+
+def percentile(values, fraction):
+    '''
+    This function returns the given percentile of a sorted list of values.
+    '''
+
+    if not values:
+        return None
+
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+    # percentile function ends here.
+    # ------------------------------
+
+
+def peakMemory():
+    '''
+    This function returns the peak resident memory of the benchmark, in
+    kilobytes.
+    '''
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # peakMemory function ends here.
+    # ------------------------------
+
+
+async def storm(root, count, timeout):
+    '''
+    This function creates the given number of directories at the top of the
+    given dropbox root as fast as possible while the daemon pipeline
+    evaluates them from inotify events, and returns the latency statistics
+    from each creation until the batch holding it is excluded.
+    '''
+
+    # Local variables
+    loop = asyncio.get_running_loop()
+    path = root.path
+    created = {}
+    done = {}
+    finished = asyncio.Event()
+    latencies = []
+    wm = None
+    handler = None
+    notifier = None
+    batcher = None
+    start = 0.0
+
+    async def planner(batch):
+        return batch, await dropbox_include.evalExcludeIncludePlan(root,
+                                                                    batch)
+
+    async def executor(plan):
+        failed = await dropbox_include.evalExcludeIncludeApply(root, plan[1])
+        for directory in plan[0]:
+            done[directory] = time.monotonic()
+        if len(done) >= count:
+            finished.set()
+        return failed
+
+    def create():
+        for directory in range(count):
+            directory = os.path.join(path, storm_prefix + str(directory))
+            created[directory] = time.monotonic()
+            os.mkdir(directory)
+
+    wm = pyinotify.WatchManager()
+    batcher = dropbox_include.EventBatcher(
+        planner, executor,
+        dropbox_include.event_batch_window,
+        dropbox_include.event_batch_size)
+    batcher.start()
+    handler = dropbox_include.EventHandler(batcher=batcher)
+    notifier = pyinotify.Notifier(wm, handler)
+    loop.add_reader(wm.get_fd(), dropbox_include.readEvents, notifier)
+
+    root.watch_registry = dropbox_include.WatchRegistry(
+        wm, pyinotify.IN_CREATE | pyinotify.IN_ISDIR, handler, path)
+    handler.registry = root.watch_registry
+    await root.watch_registry.update(root.snapshot.include_trie)
+
+    try:
+        start = time.monotonic()
+        await loop.run_in_executor(None, create)
+        try:
+            await asyncio.wait_for(finished.wait(), timeout)
+        except asyncio.TimeoutError:
+            print('Storm timed out, ' + str(len(done)) + ' of '
+                  + str(count) + ' directories excluded', file=sys.stderr)
+    finally:
+        loop.remove_reader(wm.get_fd())
+        await batcher.stop()
+        notifier.stop()
+        root.watch_registry = None
+
+    latencies = sorted(done[directory] - created[directory]
+                       for directory in done if directory in created)
+
+    return {
+        'directories': count,
+        'excluded': len(latencies),
+        'drain': (max(done.values()) - start) if done else None,
+        'latency_mean': (sum(latencies) / len(latencies)
+                         if latencies else None),
+        'latency_p50': percentile(latencies, 0.50),
+        'latency_p95': percentile(latencies, 0.95),
+        'latency_p99': percentile(latencies, 0.99),
+        'latency_max': latencies[-1] if latencies else None}
+
+    # storm function ends here.
+    # -------------------------
+
+
+def clean(args):
+    '''
+    This function removes the directories created by a previous storm, the
+    fake dropbox state and the saved state of dropbox_include.py.
+    '''
+
+    # Local variables
+    path = os.path.join(args.work, 'Dropbox')
+
+    for directory in os.listdir(path):
+        if directory.startswith(storm_prefix):
+            shutil.rmtree(os.path.join(path, directory))
+
+    for file in ('state.json', 'snapshot.json'):
+        if os.path.exists(os.path.join(args.work, file)):
+            os.unlink(os.path.join(args.work, file))
+
+    # clean function ends here.
+    # -------------------------
+
+
+def benchmark(args):
+    '''
+    This function runs each measurement and returns the results.
+    '''
+
+    # Local variables
+    results = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'settings': prepareTree(args),
+        'options': {
+            'latency': args.latency,
+            'walker_threads': args.walker_threads,
+            'event_batch_window': args.event_batch_window,
+            'storm': args.storm},
+        'seconds': {},
+        'sizes': {}}
+    current_directories = []
+    exclude_directories = []
+    unexclude_directories = []
+    exclude_list = []
+    dropbox_path = ''
+    root = None
+
+    clean(args)
+
+    dropbox_include.config_file = writeConfiguration(args)
+    dropbox_include.setLogger()
+    dropbox_include.configuration(dropbox_include.config_file)
+    dropbox_include.setLogger()
+    dropbox_include.config_snapshot = \
+        dropbox_include.takeConfigurationSnapshot()
+
+    dropbox_path = os.path.expanduser(dropbox_include.dropbox_path)
+
+    root = dropbox_include.DropboxRoot(None, dropbox_include.config_snapshot)
+    results['seconds']['initial_sequence'] = timed(
+        asyncio.run, dropbox_include.initialSequence(root))[1]
+    results['sizes']['initial_exclude_list'] = len(root.exclude_state.list())
+
+    # A restart on the unchanged tree, with the state saved by the first run.
+    root = dropbox_include.DropboxRoot(None, dropbox_include.config_snapshot)
+    results['seconds']['initial_sequence_restart'] = timed(
+        asyncio.run, dropbox_include.initialSequence(root))[1]
+
+    current_directories, results['seconds']['full_scan'] = timed(
+        dropbox_include.evalCurrentDirectories, dropbox_path)
+    results['sizes']['directories'] = len(current_directories)
+
+    exclude_directories, results['seconds']['eval_to_exclude'] = timed(
+        dropbox_include.evalToExcludeDirectories2,
+        dropbox_include.include_directory_list, current_directories)
+    results['sizes']['exclude_directories'] = len(exclude_directories)
+
+    # The exclude list as dropbox_exclude_list_command prints it, with the
+    # include directories on it as well so that some are unexcluded.
+    exclude_list = sorted(
+        os.path.relpath(directory, dropbox_path).lower()
+        for directory in exclude_directories
+        + list(dropbox_include.include_directory_list))
+
+    unexclude_directories, results['seconds']['eval_to_unexclude'] = timed(
+        dropbox_include.evalToUnexcludeDirectories,
+        exclude_list, dropbox_include.include_directory_list)
+    results['sizes']['unexclude_directories'] = len(unexclude_directories)
+
+    del current_directories, exclude_directories, exclude_list
+
+    if args.storm:
+        results['storm'] = asyncio.run(
+            storm(root, args.storm, args.storm_timeout))
+        results['seconds']['storm_drain'] = results['storm']['drain']
+
+    results['peak_rss_kb'] = peakMemory()
+
+    dropbox_include.stopLogger()
+
+    clean(args)
+
+    return results
+
+    # benchmark function ends here.
+    # -----------------------------
+
+
+def compare(old, new):
+    '''
+    This function prints the measurements of two runs side by side.
+    '''
+
+    # Local variables
+    line = '{:<28} {:>12} {:>12} {:>8}'
+    old_value = None
+    new_value = None
+
+    print(line.format('measurement', 'old', 'new', 'ratio'))
+
+    for section in ('seconds', 'sizes', 'storm'):
+        for key in sorted(set(old.get(section, {}))
+                          | set(new.get(section, {}))):
+            old_value = old.get(section, {}).get(key)
+            new_value = new.get(section, {}).get(key)
+            print(line.format(
+                section + '.' + key,
+                '-' if old_value is None else '{:.4g}'.format(old_value),
+                '-' if new_value is None else '{:.4g}'.format(new_value),
+                '{:.2f}'.format(new_value / old_value)
+                if old_value and new_value is not None else '-'))
+
+    print(line.format('peak_rss_kb', old.get('peak_rss_kb', '-'),
+                      new.get('peak_rss_kb', '-'),
+                      '{:.2f}'.format(new['peak_rss_kb']
+                                      / old['peak_rss_kb'])
+                      if old.get('peak_rss_kb') else '-'))
+
+    # compare function ends here.
+    # ---------------------------
+
+# Functions - END
+# ---------------
+
+
+# -----------------------------------------------------------------------------
+#                                     Main
+# -----------------------------------------------------------------------------
+
+def main():
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--preset', action='store',
+                        dest='preset', choices=sorted(presets),
+                        default='10k',
+                        help='Tree size preset: 10k, 100k, 1m')
+    parser.add_argument('--directories', action='store',
+                        dest='directories', type=int,
+                        help='Number of directories of the tree')
+    parser.add_argument('--depth', action='store',
+                        dest='depth', type=int,
+                        help='Maximum depth of the tree')
+    parser.add_argument('--fanout', action='store',
+                        dest='fanout', type=int,
+                        help='Average number of subdirectories')
+    parser.add_argument('--symlinks', action='store',
+                        dest='symlinks', type=int, default=0,
+                        help='Number of symbolic links to directories')
+    parser.add_argument('--includes', action='store',
+                        dest='includes', type=int, default=20,
+                        help='Number of include directories')
+    parser.add_argument('--seed', action='store',
+                        dest='seed', type=int, default=0,
+                        help='Random seed of the tree')
+    parser.add_argument('--work', action='store',
+                        dest='work', default='/tmp/dropbox_include_benchmark',
+                        help='Work directory holding the tree')
+    parser.add_argument('--latency', action='store',
+                        dest='latency', type=float, default=0.0,
+                        help='Seconds each fake dropbox command takes')
+    parser.add_argument('--walker_threads', action='store',
+                        dest='walker_threads', type=int, default=8,
+                        help='Number of threads scanning directories')
+    parser.add_argument('--event_batch_window', action='store',
+                        dest='event_batch_window', type=float, default=1.0,
+                        help='Seconds new directories are collected')
+    parser.add_argument('--storm', action='store',
+                        dest='storm', type=int, default=1000,
+                        help='Number of directories created by the storm, '
+                        '0 to skip it')
+    parser.add_argument('--storm_timeout', action='store',
+                        dest='storm_timeout', type=float, default=300.0,
+                        help='Seconds to wait for the storm to be excluded')
+    parser.add_argument('--logger_level', action='store',
+                        dest='logger_level', default='WARNING',
+                        help='Logger level of dropbox_include.py')
+    parser.add_argument('--output', action='store',
+                        dest='output',
+                        help='JSON file the results are written to')
+    parser.add_argument('--compare', action='store',
+                        dest='compare',
+                        help='JSON file of a previous run to compare with')
+
+    args = parser.parse_args()
+
+    for key, value in presets[args.preset].items():
+        if getattr(args, key) is None:
+            setattr(args, key, value)
+
+    args.work = os.path.abspath(os.path.expanduser(args.work))
+
+    results = benchmark(args)
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+    if args.compare:
+        with open(args.compare, 'r') as file:
+            compare(json.load(file), results)
+
+    return 0
+
+
+if __name__ == '__main__':
+
+    sys.exit(main())
@@ -0,0 +1,611 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Iñaki Garitano (igaritano@garitano.org)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Equivalence check of dropbox_include.py against straightforward reference
+implementations, on random include directories, directory trees, exclude
+lists and journals. The references follow the original per directory
+comparisons, so that the faster implementations can be checked to give the
+same results:
+
+    * evalToExcludeDirectories2 on a list of paths, on a path table and on a
+      pruned walk of a real tree, through the include trie. A path table and
+      a walk leave out the directories under another directory to exclude,
+      which the list of paths reports too,
+    * evalToUnexcludeDirectories and its include index,
+    * evalToExcludeDelta against the in memory exclude list,
+    * ExcludeState.add pruning the entries of excluded subdirectories,
+    * replayJournal on a journal cut at a random point, as a crash leaves it.
+
+It prints the number of trials of each check and exits with 1 on the first
+mismatch, printing its inputs:
+
+    tools/check_equivalence.py --trials 1000 --seed 1
+'''
+
+
+import os
+import sys
+import types
+import random
+import tempfile
+import argparse
+
+
+# Global variables
+tools_path = os.path.dirname(os.path.abspath(__file__))
+names = ['a', 'b', 'c', 'B', 'ab']
+root_path = '/dropbox'
+cache = '.dropbox.cache'
+
+sys.path.insert(0, os.path.dirname(tools_path))
+
+import dropbox_include  # noqa: E402
+
+
+# Functions
+def components(path):
+    '''
+    This function returns the components of the given absolute path.
+    '''
+
+    return [component for component in path.split(os.sep) if component]
+
+    # components function ends here.
+    # ------------------------------
+
+
+def isCovered(entry, entries):
+    '''
+    This function returns whether the given exclude list entry or any of its
+    ancestors is among the given entries.
+    '''
+
+    while entry:
+        if entry in entries:
+            return True
+        if os.path.dirname(entry) == entry:
+            break
+        entry = os.path.dirname(entry)
+
+    return False
+
+    # isCovered function ends here.
+    # -----------------------------
+
+
+def topmost(paths):
+    '''
+    This function returns the sorted given paths which have no ancestor
+    among them.
+    '''
+
+    # Local variables
+    path_set = set(paths)
+
+    return sorted(path for path in path_set
+                  if not isCovered(os.path.dirname(path), path_set))
+
+    # topmost function ends here.
+    # ---------------------------
+
+
+def referenceExcludeDirectories(include_directories, current_directories,
+                                path):
+    '''
+    This function returns the directories to exclude as the original
+    evalToExcludeDirectories2 did: each directory is compared with every
+    include directory, the dropbox cache among them, and the closest ones
+    decide how many of its components are excluded.
+    '''
+
+    # Local variables
+    includes = [components(include) for include in include_directories]
+    current = []
+    matches = []
+    common = 0
+    best = 0
+    shortest = 0
+    length = None
+    excluded = set()
+
+    includes.append(components(os.path.join(path, cache)))
+
+    for directory in current_directories:
+        current = components(directory)
+        matches = []
+
+        for include in includes:
+            common = 0
+            for component, include_component in zip(current, include):
+                if not component == include_component:
+                    break
+                common += 1
+            matches.append(common)
+
+        best = max(matches)
+        shortest = min(len(include) for include, common
+                       in zip(includes, matches) if common == best)
+        length = None
+
+        if best == 0:
+            length = len(current)
+        elif shortest < len(current):
+            if best < shortest:
+                length = best + 1
+        elif best < len(current):
+            length = len(current)
+
+        if length is not None:
+            excluded.add(os.sep + os.sep.join(current[:length]))
+
+    return sorted(excluded)
+
+    # referenceExcludeDirectories function ends here.
+    # -----------------------------------------------
+
+
+def referenceUnexcludeDirectories(excluded_directories,
+                                  include_directory_list, path):
+    '''
+    This function returns the exclude list entries to unexclude as the
+    original evalToUnexcludeDirectories did: entries which are an include
+    directory, lie under one or hold one.
+    '''
+
+    # Local variables
+    includes = [include[len(path) + 1:].lower()
+                for include in include_directory_list]
+    unexclude_set = set()
+    directory = ''
+
+    for directory in excluded_directories:
+        directory = directory.lower()
+        for include in includes:
+            if not include or not directory:
+                continue
+            if directory == include \
+               or directory.startswith(include + os.sep) \
+               or include.startswith(directory + os.sep):
+                unexclude_set.add(directory)
+
+    return sorted(unexclude_set)
+
+    # referenceUnexcludeDirectories function ends here.
+    # -------------------------------------------------
+
+
+def referenceExcludeAdd(excluded, directories):
+    '''
+    This function returns the given exclude list entries once the given
+    entries are added, one at a time, each one replacing the entries of its
+    subdirectories.
+    '''
+
+    for entry in directories:
+        if isCovered(entry, excluded):
+            continue
+        excluded = set(other for other in excluded
+                       if not other.startswith(entry + os.sep))
+        excluded.add(entry)
+
+    return excluded
+
+    # referenceExcludeAdd function ends here.
+    # ---------------------------------------
+
+
+def randomTree(rng, depth=4, size=40):
+    '''
+    This function returns a random set of relative directory paths, holding
+    the ancestors of every one of them.
+    '''
+
+    # Local variables
+    tree = set()
+    path = ''
+
+    for count in range(rng.randint(1, size)):
+        path = os.sep.join(rng.choice(names)
+                           for level in range(rng.randint(1, depth)))
+        while path:
+            tree.add(path)
+            path = os.path.dirname(path)
+
+    if rng.random() < 0.3:
+        tree.add(cache)
+
+    return tree
+
+    # randomTree function ends here.
+    # ------------------------------
+
+
+def randomIncludes(rng, tree, path):
+    '''
+    This function returns random include directories under the given path,
+    most of them in the given tree.
+    '''
+
+    # Local variables
+    includes = set()
+
+    for count in range(rng.randint(0, 4)):
+        if tree and rng.random() < 0.8:
+            includes.add(rng.choice(sorted(tree)))
+        else:
+            includes.add(os.sep.join(
+                rng.choice(names) for level in range(rng.randint(1, 4))))
+
+    return sorted(os.path.join(path, include) for include in includes)
+
+    # randomIncludes function ends here.
+    # ----------------------------------
+
+
+def mismatch(name, inputs, expected, result):
+    '''
+    This function prints a mismatch of the named check, with its inputs.
+    '''
+
+    print(name + ': mismatch', file=sys.stderr)
+    for key, value in sorted(inputs.items()):
+        print('  ' + key + ': ' + repr(value), file=sys.stderr)
+    print('  expected: ' + repr(expected), file=sys.stderr)
+    print('  result:   ' + repr(result), file=sys.stderr)
+
+    return False
+
+    # mismatch function ends here.
+    # ----------------------------
+
+
+def checkExcludeDirectories(rng):
+    '''
+    This function checks evalToExcludeDirectories2 on a list of paths and on
+    a path table filled breadth first, as the walker does.
+    '''
+
+    # Local variables
+    tree = randomTree(rng)
+    includes = randomIncludes(rng, tree, root_path)
+    directories = [root_path] + sorted(os.path.join(root_path, directory)
+                                       for directory in tree)
+    expected = referenceExcludeDirectories(includes, directories, root_path)
+    table = dropbox_include.PathTable()
+    index = {root_path: table.addPath(root_path)}
+    result = []
+
+    dropbox_include.dropbox_path = root_path
+
+    result = dropbox_include.evalToExcludeDirectories2(includes,
+                                                       directories)
+    if not result == expected:
+        return mismatch('list', {'includes': includes,
+                                 'directories': directories},
+                        expected, result)
+
+    for directory in sorted(directories[1:],
+                            key=lambda directory: directory.count(os.sep)):
+        index[directory] = table.add(index[os.path.dirname(directory)],
+                                     os.path.basename(directory))
+
+    result = dropbox_include.evalToExcludeDirectories2(includes, table)
+    if not result == topmost(expected):
+        return mismatch('table', {'includes': includes,
+                                  'directories': directories},
+                        topmost(expected), result)
+
+    return True
+
+    # checkExcludeDirectories function ends here.
+    # -------------------------------------------
+
+
+def checkWalk(rng):
+    '''
+    This function checks evalToExcludeDirectories2 on the pruned walk of a
+    real directory tree, through the include trie, against every directory
+    of the tree.
+    '''
+
+    # Local variables
+    tree = randomTree(rng)
+    includes = []
+    directories = []
+    expected = []
+    trie = None
+    result = []
+
+    with tempfile.TemporaryDirectory() as path:
+        for directory in tree:
+            os.makedirs(os.path.join(path, directory), exist_ok=True)
+
+        includes = randomIncludes(rng, tree, path)
+        directories = [path] + sorted(os.path.join(path, directory)
+                                      for directory in tree)
+        expected = topmost(referenceExcludeDirectories(includes,
+                                                       directories, path))
+
+        dropbox_include.dropbox_path = path
+        trie = dropbox_include.getDropboxIncludeTrie(includes)
+        result = dropbox_include.evalToExcludeDirectories2(
+            includes, dropbox_include.evalCurrentDirectories(path, trie),
+            trie)
+
+    if not result == expected:
+        return mismatch('walk', {'includes': includes,
+                                 'directories': directories},
+                        expected, result)
+
+    return True
+
+    # checkWalk function ends here.
+    # -----------------------------
+
+
+def checkUnexclude(rng):
+    '''
+    This function checks evalToUnexcludeDirectories.
+    '''
+
+    # Local variables
+    tree = randomTree(rng)
+    includes = randomIncludes(rng, tree, root_path)
+    excluded = sorted(rng.sample(sorted(tree), rng.randint(0, len(tree))))
+    expected = referenceUnexcludeDirectories(excluded, includes, root_path)
+    result = dropbox_include.evalToUnexcludeDirectories(excluded, includes,
+                                                        root_path)
+
+    if not result == expected:
+        return mismatch('unexclude', {'includes': includes,
+                                      'excluded': excluded},
+                        expected, result)
+
+    return True
+
+    # checkUnexclude function ends here.
+    # ----------------------------------
+
+
+def checkExcludeDelta(rng):
+    '''
+    This function checks evalToExcludeDelta: it returns the directories to
+    exclude which the exclude list, left without the entries to unexclude,
+    does not cover, leaving out those under another directory to exclude.
+    '''
+
+    # Local variables
+    tree = sorted(randomTree(rng))
+    excluded = set(directory.lower() for directory
+                   in rng.sample(tree, rng.randint(0, len(tree))))
+    unexclude_list = sorted(rng.sample(sorted(excluded),
+                                       rng.randint(0, len(excluded))))
+    exclude_directories = [os.path.join(root_path, directory) for directory
+                           in rng.sample(tree, rng.randint(0, len(tree)))]
+    left = excluded.difference(unexclude_list)
+    state = dropbox_include.ExcludeState(root_path, None)
+    expected = []
+    result = []
+
+    state.replace(excluded)
+
+    expected = sorted(
+        directory for directory in set(exclude_directories)
+        if not isCovered(os.path.relpath(directory, root_path).lower(), left)
+        and not isCovered(os.path.dirname(directory),
+                          set(exclude_directories)))
+
+    result = dropbox_include.evalToExcludeDelta(state, exclude_directories,
+                                                unexclude_list)
+
+    if not result == expected:
+        return mismatch('delta', {'excluded': sorted(excluded),
+                                  'unexclude_list': unexclude_list,
+                                  'exclude_directories':
+                                  exclude_directories},
+                        expected, result)
+
+    return True
+
+    # checkExcludeDelta function ends here.
+    # -------------------------------------
+
+
+def checkExcludeState(rng):
+    '''
+    This function checks ExcludeState.add and remove over a few batches.
+    '''
+
+    # Local variables
+    tree = sorted(directory.lower() for directory in randomTree(rng))
+    state = dropbox_include.ExcludeState(root_path, None)
+    expected = set()
+    batch = []
+    removed = []
+
+    for count in range(rng.randint(1, 6)):
+        batch = [rng.choice(tree) for size in range(rng.randint(1, 6))]
+        state.add(batch)
+        expected = referenceExcludeAdd(expected, batch)
+
+        if expected and rng.random() < 0.3:
+            removed = rng.sample(sorted(expected), rng.randint(1, 2)
+                                 if len(expected) > 1 else 1)
+            state.remove(removed)
+            expected.difference_update(removed)
+
+        if not set(state.list()) == expected:
+            return mismatch('state', {'batch': batch},
+                            sorted(expected), state.list())
+
+    return True
+
+    # checkExcludeState function ends here.
+    # -------------------------------------
+
+
+def checkJournal(rng):
+    '''
+    This function checks replayJournal on a journal cut at a random byte:
+    operations whose done record was written are applied to the exclude
+    list, and the directories which unfinished or partly failed additions
+    were to exclude are returned, if they exist.
+    '''
+
+    # Local variables
+    seed = set()
+    operations = []
+    journal = None
+    identifier = 0
+    operation = ''
+    paths = []
+    done = None
+    planned = 0
+    finished = 0
+    cut = 0
+    excluded = set()
+    replay = []
+    root = None
+    result = []
+
+    with tempfile.TemporaryDirectory() as path:
+        tree = sorted(randomTree(rng))
+        for directory in rng.sample(tree, rng.randint(0, len(tree))):
+            os.makedirs(os.path.join(path, directory), exist_ok=True)
+        seed = set(directory.lower() for directory
+                   in rng.sample(tree, rng.randint(0, len(tree))))
+
+        journal = dropbox_include.OperationJournal(
+            os.path.join(path, 'state.journal'))
+
+        # Offsets are those of the end of each record, without its newline.
+        for count in range(rng.randint(1, 6)):
+            operation = rng.choice(['add', 'remove'])
+            paths = sorted(set(rng.choice(tree)
+                               for size in range(rng.randint(1, 4))))
+            if operation == 'add':
+                paths = [os.path.join(path, directory)
+                         for directory in paths]
+            else:
+                paths = [directory.lower() for directory in paths]
+
+            identifier = journal.plan(operation, paths)
+            planned = os.path.getsize(journal.path) - 1
+            done = None
+            finished = None
+            if rng.random() < 0.8:
+                done = rng.sample(paths, rng.randint(0, len(paths)))
+                journal.complete(identifier, done)
+                finished = os.path.getsize(journal.path) - 1
+            operations.append((operation, paths, done, planned, finished))
+
+        journal.close()
+
+        cut = rng.randint(0, os.path.getsize(journal.path))
+        with open(journal.path, 'r+') as file:
+            file.truncate(cut)
+
+        excluded = set(seed)
+        for operation, paths, done, planned, finished in operations:
+            if planned > cut:
+                break
+            if done is None or finished > cut:
+                done = []
+            elif operation == 'add':
+                excluded = referenceExcludeAdd(
+                    excluded, [os.path.relpath(directory, path).lower()
+                               for directory in done])
+            else:
+                excluded.difference_update(done)
+            if operation == 'add':
+                replay.extend(directory for directory in paths
+                              if directory not in done
+                              and os.path.isdir(directory))
+
+        root = types.SimpleNamespace(
+            journal=dropbox_include.OperationJournal(journal.path),
+            exclude_state=dropbox_include.ExcludeState(path, None))
+        root.exclude_state.replace(seed)
+        result = dropbox_include.replayJournal(root)
+
+        if not (result == replay
+                and set(root.exclude_state.list()) == excluded):
+            return mismatch('journal', {'seed': sorted(seed),
+                                        'operations': operations,
+                                        'cut': cut},
+                            (replay, sorted(excluded)),
+                            (result, root.exclude_state.list()))
+
+    return True
+
+    # checkJournal function ends here.
+    # --------------------------------
+
+# Functions - END
+# ---------------
+
+
+# -----------------------------------------------------------------------------
+#                                     Main
+# -----------------------------------------------------------------------------
+
+def main():
+
+    # Local variables
+    checks = [('exclude directories', checkExcludeDirectories),
+              ('walk', checkWalk),
+              ('unexclude directories', checkUnexclude),
+              ('exclude delta', checkExcludeDelta),
+              ('exclude state', checkExcludeState),
+              ('journal replay', checkJournal)]
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--trials', action='store',
+                        dest='trials', type=int, default=500,
+                        help='Number of random trials of each check')
+    parser.add_argument('--seed', action='store',
+                        dest='seed', type=int, default=0,
+                        help='Random seed')
+    parser.add_argument('--logger_level', action='store',
+                        dest='logger_level', default='CRITICAL',
+                        help='Logger level of dropbox_include.py')
+
+    args = parser.parse_args()
+
+    dropbox_include.logger_method = 'console'
+    dropbox_include.logger_level = args.logger_level
+    dropbox_include.logger_queue = 'no'
+    dropbox_include.setLogger()
+
+    for name, check in checks:
+        rng = random.Random(args.seed)
+        for trial in range(args.trials):
+            if not check(rng):
+                print(name + ': trial ' + str(trial) + ' of seed '
+                      + str(args.seed) + ' failed', file=sys.stderr)
+                return 1
+        print(name + ': ' + str(args.trials) + ' trials passed')
+
+    return 0
+
+
+if __name__ == '__main__':
+
+    sys.exit(main())
@@ -0,0 +1,147 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Iñaki Garitano (igaritano@garitano.org)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Stand-in for the dropbox-cli exclude commands. It keeps the excluded
+directories in a state file and prints them as dropbox-cli does: lower case
+and relative to the current working directory. Each call may be delayed to
+mimic the dropbox-cli start up cost. For example, with the state file given
+by the FAKE_DROPBOX_STATE environment variable or by --state:
+
+    dropbox_exclude_add_command=fake_dropbox_cli.py exclude add
+    dropbox_exclude_list_command=fake_dropbox_cli.py exclude list
+    dropbox_exclude_remove_command=fake_dropbox_cli.py exclude remove
+
+The latency may also be given with the FAKE_DROPBOX_LATENCY environment
+variable or by --latency.
+'''
+
+
+import os
+import sys
+import json
+import time
+import fcntl
+import argparse
+
+
+# Functions
+def isIgnored(ignore_set, path):
+    '''
+    This function returns whether the given path or any of its ancestors is
+    excluded.
+    '''
+
+    while path and not path == os.sep:
+        if path in ignore_set:
+            return True
+        path = os.path.dirname(path)
+
+    return False
+
+    # isIgnored function ends here.
+    # -----------------------------
+
+
+def relativePath(path):
+    '''
+    This function returns the given excluded directory relative to the
+    current working directory, keeping the case of the working directory.
+    '''
+
+    # Local variables
+    cwd = os.getcwd().rstrip(os.sep) + os.sep
+
+    if path.startswith(cwd.lower()):
+        return path[len(cwd):]
+
+    return os.path.relpath(path)
+
+    # relativePath function ends here.
+    # --------------------------------
+
+# Functions - END
+# ---------------
+
+
+# -----------------------------------------------------------------------------
+#                                     Main
+# -----------------------------------------------------------------------------
+
+def main():
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--state', action='store',
+                        dest='state',
+                        default=os.environ.get('FAKE_DROPBOX_STATE',
+                                               '/tmp/fake_dropbox_state'),
+                        help='File keeping the excluded directories')
+    parser.add_argument('--latency', action='store',
+                        dest='latency', type=float,
+                        default=float(os.environ.get('FAKE_DROPBOX_LATENCY',
+                                                     '0')),
+                        help='Seconds each call takes')
+    parser.add_argument('command', choices=['exclude'])
+    parser.add_argument('subcommand', choices=['add', 'list', 'remove'])
+    parser.add_argument('paths', nargs='*')
+
+    args = parser.parse_args()
+
+    if args.latency:
+        time.sleep(args.latency)
+
+    paths = [os.path.abspath(path).lower() for path in args.paths]
+
+    with open(args.state, 'a+') as file:
+        fcntl.flock(file, fcntl.LOCK_EX)
+        file.seek(0)
+        content = file.read()
+        ignore_set = set(json.loads(content)) if content else set()
+
+        if args.subcommand == 'add':
+            for path in paths:
+                if isIgnored(ignore_set, path):
+                    continue
+                ignore_set = set(ignored for ignored in ignore_set
+                                 if not ignored.startswith(path + os.sep))
+                ignore_set.add(path)
+
+        elif args.subcommand == 'remove':
+            ignore_set.difference_update(paths)
+
+        else:
+            if ignore_set:
+                print('Excluded: ')
+                for path in sorted(relativePath(path)
+                                   for path in ignore_set):
+                    print(path)
+            else:
+                print('No directories are being ignored.')
+
+        if not args.subcommand == 'list':
+            file.seek(0)
+            file.truncate()
+            json.dump(sorted(ignore_set), file)
+
+    return 0
+
+
+if __name__ == '__main__':
+
+    sys.exit(main())
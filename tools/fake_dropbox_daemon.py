@@ -0,0 +1,265 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Iñaki Garitano (igaritano@garitano.org)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Stand-in for the dropbox daemon command socket. It answers the exclude
+commands dropbox_include.py sends when dropbox_command_method is socket
+(get_ignore_set, ignore_set_add and ignore_set_remove), so the socket client
+can be tried without dropbox. For example:
+
+    tools/fake_dropbox_daemon.py --socket /tmp/command_socket
+    dropbox_include.py --dropbox_command_method socket \
+        --dropbox_command_socket /tmp/command_socket
+'''
+
+
+import os
+import json
+import time
+import argparse
+import threading
+import socketserver
+
+
+# Global variables
+ignore_set = set()
+ignore_set_lock = threading.Lock()
+state_file = None
+latency = 0.0
+
+
+# Functions
+def loadState():
+    '''
+    This function loads the excluded directories from the state file.
+    '''
+
+    # Global variables
+    global ignore_set
+
+    if state_file and os.path.exists(state_file):
+        with open(state_file, 'r') as file:
+            ignore_set = set(json.load(file))
+
+    # loadState function ends here.
+    # -----------------------------
+
+
+def saveState():
+    '''
+    This function saves the excluded directories into the state file.
+    '''
+
+    if state_file:
+        with open(state_file + '.tmp', 'w') as file:
+            json.dump(sorted(ignore_set), file)
+        os.rename(state_file + '.tmp', state_file)
+
+    # saveState function ends here.
+    # -----------------------------
+
+
+def isIgnored(path):
+    '''
+    This function returns whether the given path or any of its ancestors is
+    excluded.
+    '''
+
+    while path and not path == os.sep:
+        if path in ignore_set:
+            return True
+        path = os.path.dirname(path)
+
+    return False
+
+    # isIgnored function ends here.
+    # -----------------------------
+
+
+def runCommand(name, arguments):
+    '''
+    This function runs a command and returns the values of the answer, or
+    raises ValueError for unknown commands.
+    '''
+
+    # Global variables
+    global ignore_set
+
+    # Local variables
+    paths = [os.path.normpath(path).lower()
+             for path in arguments.get('paths', [])]
+
+    with ignore_set_lock:
+        if name == 'get_ignore_set':
+            return {'ignore_set': sorted(ignore_set)}
+
+        elif name == 'ignore_set_add':
+            for path in paths:
+                if not isIgnored(path):
+                    ignore_set = set(ignored for ignored in ignore_set
+                                     if not ignored.startswith(path + os.sep))
+                    ignore_set.add(path)
+            saveState()
+            return {}
+
+        elif name == 'ignore_set_remove':
+            ignore_set.difference_update(paths)
+            saveState()
+            return {}
+
+    raise ValueError('Unknown command: ' + name)
+
+    # runCommand function ends here.
+    # ------------------------------
+
+# Functions - END
+# ---------------
+
+
+# Classes
+class CommandHandler(socketserver.StreamRequestHandler):
+    '''
+    Class which answers the commands sent over a connection.
+    '''
+
+    def readLine(self):
+        '''
+        Function which reads a line, or returns None when the connection is
+        closed.
+        '''
+
+        # Local variables
+        line = self.rfile.readline()
+
+        if not line:
+            return None
+
+        return line.decode('utf-8').rstrip('\n')
+
+    # readLine function ends here.
+    # ----------------------------
+
+    def handle(self):
+        '''
+        Function which reads each command and writes its answer.
+        '''
+
+        # Local variables
+        name = ''
+        line = ''
+        arguments = {}
+        lines = []
+
+        while True:
+            name = self.readLine()
+            if name is None:
+                return
+
+            arguments = {}
+            while True:
+                line = self.readLine()
+                if line is None:
+                    return
+                if line == 'done':
+                    break
+                line = line.split('\t')
+                arguments[line[0]] = line[1:]
+
+            if latency:
+                time.sleep(latency)
+
+            try:
+                lines = ['ok']
+                for key, value in runCommand(name, arguments).items():
+                    lines.append('\t'.join([key] + value))
+            except ValueError as error:
+                lines = ['notok', str(error)]
+            lines.append('done')
+
+            self.wfile.write(('\n'.join(lines) + '\n').encode('utf-8'))
+            self.wfile.flush()
+
+    # handle function ends here.
+    # --------------------------
+
+
+# CommandHandler class definition ends here.
+# ------------------------------------------
+
+
+class CommandServer(socketserver.ThreadingMixIn,
+                    socketserver.UnixStreamServer):
+    '''
+    Class which serves each connection on its own thread.
+    '''
+
+    daemon_threads = True
+
+
+# CommandServer class definition ends here.
+# -----------------------------------------
+
+
+# -----------------------------------------------------------------------------
+#                                     Main
+# -----------------------------------------------------------------------------
+
+def main():
+
+    # Global variables
+    global state_file
+    global latency
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--socket', action='store',
+                        dest='socket',
+                        default='~/.dropbox/command_socket',
+                        help='Command socket path')
+    parser.add_argument('--state', action='store',
+                        dest='state',
+                        help='File keeping the excluded directories')
+    parser.add_argument('--latency', action='store',
+                        dest='latency', type=float, default=0.0,
+                        help='Seconds each command takes')
+
+    args = parser.parse_args()
+
+    state_file = args.state
+    latency = args.latency
+    path = os.path.expanduser(args.socket)
+
+    loadState()
+
+    if os.path.exists(path):
+        os.unlink(path)
+
+    server = CommandServer(path, CommandHandler)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(path)
+
+
+if __name__ == '__main__':
+
+    main()